@@ -0,0 +1,136 @@
+""" bench_parsers.py - timing and regression checks for the report parsers
+
+Times `_tiered_file_parse` (via `tiered_file_parse_colon` and
+`tiered_file_parse_space`), `double_tap_tiered_file_parse`,
+`interchange_file_parse`, `global_iterations_parse`, and
+`CMAP_EMAT_Model.load_measures` over all measures, against the golden report
+files in `fixtures/Database/report` and the `model_run_timestamp.txt` in
+`fixtures/Database`.
+Every parser's output is compared with the recorded `fixtures/expected.json`,
+and the script exits with an error if anything differs, so a parser speedup
+can be checked for identical results in the same step that measures it.
+
+The fixture reports were written by `cmap_standin_batch.write_reports` at
+the scope default inputs, in the same formats as the real model reports, and
+the timestamp file is that of a run with the default four global loops, as
+the model's batch file writes it.
+If a parser's output is deliberately changed, re-record the expectations:
+
+	python benchmarks/bench_parsers.py --record
+"""
+import os
+import sys
+import json
+import timeit
+import argparse
+import warnings
+
+repo_directory = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, repo_directory)
+
+fixtures_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+expected_filename = os.path.join(fixtures_directory, 'expected.json')
+
+
+def _parsers():
+	import cmap_emat
+	return {
+		'run_vmt_statistics.rpt': cmap_emat.tiered_file_parse_colon,
+		'run_vht_statistics.rpt': cmap_emat.double_tap_tiered_file_parse,
+		'final_run_statistics.rpt': cmap_emat.tiered_file_parse_colon,
+		'report_ej.txt': cmap_emat.tiered_file_parse_space,
+		'interchange_times.txt': cmap_emat.interchange_file_parse,
+		'model_run_timestamp.txt': cmap_emat.global_iterations_parse,
+	}
+
+
+def _fixture(filename):
+	"""A fixture file, in the report folder unless the model writes it in Database."""
+	path = os.path.join(fixtures_directory, 'Database', filename)
+	if os.path.exists(path):
+		return path
+	return os.path.join(fixtures_directory, 'Database', 'report', filename)
+
+
+def _model():
+	import cmap_emat
+	os.chdir(repo_directory)
+	with warnings.catch_warnings():
+		warnings.simplefilter("ignore")
+		return cmap_emat.CMAP_EMAT_Model(db=False)
+
+
+def current_results(model=None):
+	"""Parse every fixture, returning {name: {key: value}}."""
+	if model is None:
+		model = _model()
+	results = {}
+	for filename, reader in _parsers().items():
+		results[filename] = reader(_fixture(filename))
+	results['load_measures'] = model.load_measures(abs_output_path=fixtures_directory)
+	return results
+
+
+def compare(results, expected):
+	"""List the differences between two sets of parser results."""
+	problems = []
+	for name, exp in expected.items():
+		got = results.get(name, {})
+		for k in sorted(set(exp) | set(got)):
+			if k not in got:
+				problems.append(f"{name}: missing {k}")
+			elif k not in exp:
+				problems.append(f"{name}: unexpected {k}")
+			elif got[k] != exp[k]:
+				problems.append(f"{name}: {k} = {got[k]!r}, expected {exp[k]!r}")
+	return problems
+
+
+def benchmark(number=200, repeat=5):
+	"""
+	Time each parser and `load_measures` on the fixtures.
+
+	Returns:
+		dict: Best-of-`repeat` milliseconds per call, by parser.
+	"""
+	model = _model()
+	timings = {}
+	for filename, reader in _parsers().items():
+		path = _fixture(filename)
+		best = min(timeit.repeat(lambda: reader(path), number=number, repeat=repeat))
+		timings[f"{reader.__name__}({filename})"] = 1000 * best / number
+	n = max(1, number // 10)
+	best = min(timeit.repeat(
+		lambda: model.load_measures(abs_output_path=fixtures_directory),
+		number=n, repeat=repeat,
+	))
+	timings[f"load_measures({len(model.scope.get_measure_names())} measures)"] = 1000 * best / n
+	return timings
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument('--number', type=int, default=200, help="calls per timing")
+	parser.add_argument('--repeat', type=int, default=5, help="timings per parser")
+	parser.add_argument('--record', action='store_true', help="re-record the expected results")
+	args = parser.parse_args()
+
+	results = current_results()
+	if args.record:
+		with open(expected_filename, 'wt') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+		print(f"recorded {sum(len(v) for v in results.values())} values to {expected_filename}")
+		sys.exit(0)
+
+	with open(expected_filename, 'rt') as f:
+		expected = json.load(f)
+	problems = compare(results, expected)
+
+	for name, ms in benchmark(args.number, args.repeat).items():
+		print(f"{name:<60} {ms:9.3f} ms")
+	if problems:
+		for p in problems[:50]:
+			print(p)
+		print(f"REGRESSION: {len(problems)} differences from {expected_filename}")
+		sys.exit(1)
+	print(f"OK: {sum(len(v) for v in expected.values())} values identical to recorded results")
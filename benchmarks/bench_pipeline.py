@@ -0,0 +1,141 @@
+""" bench_pipeline.py - end-to-end throughput of the CMAP EMAT pipeline
+
+Runs `setup -> run -> load_measures -> archive` against the synthetic
+stand-in model from `cmap_standin`, for several worker counts, and reports
+the throughput of each stage.  Runs on Linux without Emme.
+
+	python benchmarks/bench_pipeline.py --workers 1 2 4 --experiments 8 --runtime 1.0
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+repo_directory = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, repo_directory)
+
+STAGES = ['setup', 'run', 'load_measures', 'archive']
+
+_model = None
+
+
+def _init_worker(model_path, db_filename, runtime, matrix_megabytes):
+	global _model
+	warnings.simplefilter("ignore")
+	os.chdir(repo_directory)
+	from emat import SQLiteDB
+	from cmap_standin import CMAP_EMAT_StandIn
+	_model = CMAP_EMAT_StandIn(
+		model_path,
+		runtime=runtime,
+		matrix_megabytes=matrix_megabytes,
+		db=SQLiteDB(db_filename, initialize='skip'),
+	)
+
+
+def _run_one(item):
+	experiment_id, params = item
+	model = _model
+	model.run_id = None
+	params = dict(params, _experiment_id_=experiment_id)
+	timing = {}
+	t0 = time.perf_counter()
+	model.setup(params)
+	t1 = time.perf_counter()
+	model.run()
+	t2 = time.perf_counter()
+	measures = model.load_measures()
+	t3 = time.perf_counter()
+	model.archive(params, experiment_id=experiment_id)
+	t4 = time.perf_counter()
+	timing['setup'] = t1 - t0
+	timing['run'] = t2 - t1
+	timing['load_measures'] = t3 - t2
+	timing['archive'] = t4 - t3
+	timing['n_measures'] = len(measures)
+	shutil.rmtree(model.model_path, ignore_errors=True)
+	return timing
+
+
+def benchmark(workers=(1, 2, 4), n_experiments=8, runtime=1.0, n_bulk_files=400,
+			  bulk_megabytes=64, emmebank_megabytes=32, matrix_megabytes=0.5, directory=None):
+	"""
+	Run the stand-in pipeline benchmark.
+
+	Returns:
+		pandas.DataFrame: One row per worker count, with the wall time,
+		overall experiments per hour, and the mean seconds per experiment
+		and experiments per second for each stage.
+	"""
+	import pandas as pd
+	from emat import SQLiteDB
+	from cmap_standin import CMAP_EMAT_StandIn, make_standin_model
+
+	os.chdir(repo_directory)
+	with tempfile.TemporaryDirectory(dir=directory) as tmp:
+		t0 = time.perf_counter()
+		model_path = make_standin_model(
+			tmp,
+			n_bulk_files=n_bulk_files,
+			bulk_megabytes=bulk_megabytes,
+			emmebank_megabytes=emmebank_megabytes,
+			matrix_megabytes=matrix_megabytes,
+		)
+		print(f"stand-in model generated in {time.perf_counter()-t0:.1f}s")
+		db_filename = os.path.join(tmp, 'bench.sqlitedb')
+		model = CMAP_EMAT_StandIn(model_path, db=SQLiteDB(db_filename, initialize=True))
+		rows = []
+		for w in workers:
+			design = model.design_experiments(
+				n_samples=n_experiments,
+				design_name=f'bench_{w}',
+				random_seed=w,
+			)
+			items = [(i, dict(row)) for i, row in design.iterrows()]
+			t0 = time.perf_counter()
+			with ProcessPoolExecutor(
+					max_workers=w,
+					initializer=_init_worker,
+					initargs=(model_path, db_filename, runtime, matrix_megabytes),
+			) as pool:
+				timings = list(pool.map(_run_one, items))
+			wall = time.perf_counter() - t0
+			row = {'workers': w, 'wall_seconds': wall, 'experiments_per_hour': 3600 * len(items) / wall}
+			for stage in STAGES:
+				mean = sum(t[stage] for t in timings) / len(timings)
+				row[f'{stage}_seconds'] = mean
+				row[f'{stage}_per_second'] = w / mean if mean else float('inf')
+			row['n_measures'] = min(t['n_measures'] for t in timings)
+			rows.append(row)
+			print(f"{w} workers: {row['experiments_per_hour']:.0f} experiments/hour")
+		model.db.conn.close()
+	return pd.DataFrame(rows).set_index('workers')
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+	parser.add_argument('--experiments', type=int, default=8)
+	parser.add_argument('--runtime', type=float, default=1.0, help="fake model runtime, seconds")
+	parser.add_argument('--bulk-files', type=int, default=400)
+	parser.add_argument('--bulk-megabytes', type=float, default=64)
+	parser.add_argument('--emmebank-megabytes', type=float, default=32)
+	parser.add_argument('--matrix-megabytes', type=float, default=0.5)
+	parser.add_argument('--directory', default=None, help="where to build the stand-in (default TMP)")
+	args = parser.parse_args()
+	import pandas as pd
+	with pd.option_context('display.width', 200, 'display.max_columns', 20):
+		print(benchmark(
+			workers=args.workers,
+			n_experiments=args.experiments,
+			runtime=args.runtime,
+			n_bulk_files=args.bulk_files,
+			bulk_megabytes=args.bulk_megabytes,
+			emmebank_megabytes=args.emmebank_megabytes,
+			matrix_megabytes=args.matrix_megabytes,
+			directory=args.directory,
+		).round(3))
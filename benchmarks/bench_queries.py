@@ -0,0 +1,106 @@
+""" bench_queries.py - timing and regression checks for query translation
+
+`CMAP_SQLiteDB.invalidate_experiment_runs` evaluates its queries in SQL, as
+translated by `cmap_database.query_to_sql`, and they must select the same
+runs as `pandas.DataFrame.query` would.  This builds a table of random
+measures, with missing values in every column, evaluates a set of queries
+both ways, and exits with an error if any selects different rows; then it
+times each way.
+"""
+import os
+import sys
+import timeit
+import sqlite3
+import argparse
+
+import numpy as np
+import pandas as pd
+
+repo_directory = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, repo_directory)
+
+QUERIES = [
+	"Regionwide_VMT > 5",
+	"~(Regionwide_VMT > 5)",
+	"not Regionwide_VMT <= 5",
+	"Regionwide_VMT == 3",
+	"Regionwide_VMT != 3",
+	"~(Regionwide_VMT != 3)",
+	"2 < Regionwide_VMT <= 7",
+	"~(2 < Regionwide_VMT <= 7)",
+	"(Regionwide_VMT > 5) | (Transit_Trips < 4)",
+	"~((Regionwide_VMT > 5) & (Transit_Trips < 4))",
+	"Regionwide_VMT + Transit_Trips > 8",
+	"~(Regionwide_VMT - 2 * Transit_Trips >= 0)",
+	"-Regionwide_VMT < -5 and not (Transit_Trips == 1)",
+]
+
+
+def measures(n=10000, missing=0.1, seed=0):
+	"""A table of measures, with about `missing` of the values missing."""
+	rng = np.random.default_rng(seed)
+	data = pd.DataFrame({
+		'Regionwide_VMT': rng.integers(0, 10, n).astype(float),
+		'Transit_Trips': rng.integers(0, 10, n).astype(float),
+	})
+	return data.mask(rng.random(data.shape) < missing)
+
+
+def compare(data, queries=QUERIES):
+	"""List the queries that select different rows in SQL and in pandas."""
+	from cmap_database import query_to_sql
+	conn = sqlite3.connect(':memory:')
+	data.to_sql('measures', conn, index_label='row')
+	problems = []
+	for query in queries:
+		expected = list(data.query(query).index)
+		where = query_to_sql(query, lambda name: f'"{name}"')
+		got = [r[0] for r in conn.execute(f"SELECT row FROM measures WHERE {where} ORDER BY row")]
+		if got != expected:
+			problems.append(f"{query!r}: SQL selects {len(got)} rows, pandas {len(expected)}")
+	return problems
+
+
+def benchmark(data, queries=QUERIES, number=20, repeat=5):
+	"""
+	Time all the queries in SQL and in pandas.
+
+	Returns:
+		dict: Best-of-`repeat` milliseconds for all the queries.
+	"""
+	from cmap_database import query_to_sql
+	conn = sqlite3.connect(':memory:')
+	data.to_sql('measures', conn, index_label='row')
+	predicates = [query_to_sql(q, lambda name: f'"{name}"') for q in queries]
+
+	def sql():
+		for where in predicates:
+			conn.execute(f"SELECT row FROM measures WHERE {where}").fetchall()
+
+	def pandas():
+		for query in queries:
+			data.query(query).index.tolist()
+
+	return {
+		name: 1000 * min(timeit.repeat(f, number=number, repeat=repeat)) / number
+		for name, f in [('SQL', sql), ('pandas', pandas)]
+	}
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+	parser.add_argument('--rows', type=int, default=10000, help="rows in the table")
+	parser.add_argument('--number', type=int, default=20, help="calls per timing")
+	parser.add_argument('--repeat', type=int, default=5, help="timings per way")
+	args = parser.parse_args()
+
+	data = measures(args.rows)
+	problems = compare(data)
+	for name, ms in benchmark(data, number=args.number, repeat=args.repeat).items():
+		print(f"{len(QUERIES)} queries on {args.rows} rows in {name:<8} {ms:9.3f} ms")
+	if problems:
+		for p in problems:
+			print(p)
+		print(f"REGRESSION: {len(problems)} of {len(QUERIES)} queries select different rows")
+		sys.exit(1)
+	print(f"OK: {len(QUERIES)} queries select the same rows in SQL and in pandas")
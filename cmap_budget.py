@@ -0,0 +1,154 @@
+""" cmap_budget.py - a machine-wide budget of CPU slots for core model processes
+
+Each model run starts three PreDist, four ModeChoice and four VehOcc
+processes at once, so fifteen runs side by side can put sixty CPU-bound
+processes on one machine, all slowing each other down.  A `CPUBudget` is a
+fixed number of slots, shared by every process on the machine that uses the
+same slot directory; the stage runner takes a slot for each program it starts
+and gives it back when the program exits, so the number of model processes
+running at once never exceeds the budget, however many runs are in progress.
+Optionally, each process is pinned to the core of its slot.
+
+A slot is held as an exclusive lock on one of the slot files, so slots held
+by a process that dies are freed by the operating system.
+"""
+import os
+import time
+import tempfile
+
+from emat.util.loggers import get_module_logger
+
+from cmap_filelock import try_lock, unlock
+
+_logger = get_module_logger(__name__)
+
+def default_slot_directory():
+	"""The slot directory shared by default by every process on this machine."""
+	return os.path.join(tempfile.gettempdir(), 'cmap-emat-cpu-slots')
+
+
+def pin_process(pid, core):
+	"""
+	Restrict a process, and the processes it starts later, to one core.
+
+	Returns:
+		bool: Whether the process was pinned; pinning needs `psutil`
+		except on Linux, and is not possible on macOS.
+	"""
+	if hasattr(os, 'sched_setaffinity'):
+		try:
+			os.sched_setaffinity(pid, {core})
+			return True
+		except OSError:
+			return False
+	try:
+		import psutil
+	except ImportError:
+		return False
+	try:
+		psutil.Process(pid).cpu_affinity([core])
+		return True
+	except (AttributeError, psutil.Error):
+		return False
+
+
+class CPUBudget:
+	"""
+	A number of CPU slots shared by processes on one machine.
+
+	Args:
+		slots (int, optional): The number of slots, by default one per CPU.
+			Every process sharing a budget should use the same number.
+		directory (str, optional): Where the slot files are kept, by
+			default `default_slot_directory()`.  Processes share a budget
+			by using the same directory.
+		pin (bool, default False): Pin each process started in a slot to
+			one core, slot `i` to core `i` (modulo the number of cores).
+	"""
+
+	def __init__(self, slots=None, directory=None, pin=False):
+		self.slots = int(slots or os.cpu_count() or 1)
+		self.directory = directory or default_slot_directory()
+		self.pin = pin
+		os.makedirs(self.directory, exist_ok=True)
+		self._held = {}
+
+	def __repr__(self):
+		return f"<CPUBudget {self.slots} slots in {self.directory}>"
+
+	def try_acquire(self):
+		"""
+		Take a free slot, if there is one.
+
+		Returns:
+			int or None: The slot number, or None if all slots are taken.
+		"""
+		for slot in range(self.slots):
+			if slot in self._held:
+				continue
+			fd = os.open(os.path.join(self.directory, f"slot-{slot:03d}.lock"), os.O_RDWR | os.O_CREAT)
+			if try_lock(fd):
+				self._held[slot] = fd
+				return slot
+			os.close(fd)
+		return None
+
+	def acquire(self, timeout=None, poll=0.5, while_waiting=None):
+		"""
+		Take a slot, waiting for one to be freed if need be.
+
+		Args:
+			timeout (float, optional): Seconds to wait.
+			poll (float, default 0.5): Seconds between tries.
+			while_waiting (callable, optional): Called between tries, for
+				example to give back the slots of processes that have
+				finished.
+
+		Returns:
+			int or None: The slot number, or None on timeout.
+		"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		waited = False
+		while True:
+			slot = self.try_acquire()
+			if slot is not None:
+				return slot
+			if not waited:
+				_logger.debug(f"all {self.slots} CPU slots in use, waiting")
+				waited = True
+			if deadline is not None and time.monotonic() >= deadline:
+				return None
+			if while_waiting is not None:
+				while_waiting()
+			time.sleep(poll if deadline is None else max(0, min(poll, deadline - time.monotonic())))
+
+	def release(self, slot):
+		"""Give back a slot taken by this process."""
+		fd = self._held.pop(slot, None)
+		if fd is not None:
+			unlock(fd)
+			os.close(fd)
+
+	def assign(self, slot, pid):
+		"""Pin a process started in a slot to its core, if pinning."""
+		if self.pin:
+			core = slot % (os.cpu_count() or 1)
+			if not pin_process(pid, core):
+				_logger.debug(f"could not pin process {pid} to core {core}")
+
+	def in_use(self):
+		"""The number of slots taken, by any process."""
+		n = 0
+		for slot in range(self.slots):
+			if slot in self._held:
+				n += 1
+				continue
+			fd = os.open(os.path.join(self.directory, f"slot-{slot:03d}.lock"), os.O_RDWR | os.O_CREAT)
+			try:
+				if try_lock(fd):
+					unlock(fd)
+				else:
+					n += 1
+			finally:
+				os.close(fd)
+		return n
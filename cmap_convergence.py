@@ -0,0 +1,101 @@
+""" cmap_convergence.py - stop the global feedback loop once the skims settle
+
+The batch file always runs every global iteration, 0 to `global_loops`, even
+when the congested time skims have stopped changing after two or three.  When
+the model stages are run from Python (see `cmap_stages`), a `SkimConvergence`
+can be checked after each global iteration: it compares the congested time
+skim matrices with those of the previous iteration, and ends the feedback
+loop once their relative change falls below a threshold.  The last global
+iteration run is recorded in `model_run_timestamp.txt`, and read back as the
+`Global_Loops_Used` measure.
+"""
+import os
+import numpy as np
+
+from emat.util.loggers import get_module_logger
+
+_logger = get_module_logger(__name__)
+
+# The congested AM peak and midday time skims.
+DEFAULT_MATRICES = ('mf44', 'mf46')
+
+
+def read_emx(filename):
+	"""Read an Emme emx matrix file as a flat float32 array."""
+	return np.fromfile(filename, dtype=np.float32)
+
+
+def relative_change(previous, current):
+	"""
+	The total absolute change between two matrices, relative to the first.
+
+	Cells that are not finite in either matrix are left out.
+	"""
+	previous = previous.astype(np.float64)
+	current = current.astype(np.float64)
+	finite = np.isfinite(previous) & np.isfinite(current)
+	scale = np.abs(previous[finite]).sum()
+	if scale == 0:
+		return np.inf
+	return float(np.abs(current[finite] - previous[finite]).sum() / scale)
+
+
+class SkimConvergence:
+	"""
+	A convergence test on the congested time skims, for `cmap_stages.run_stages`.
+
+	Args:
+		database_dir (str): The model's Database directory.
+		threshold (float, default 0.005): The feedback loop ends when the
+			largest relative change of any of the matrices, from the
+			previous global iteration, is below this.
+		matrices (Collection[str]): The skim matrices compared, by name in
+			the `emmemat` directory.
+		min_loops (int, default 1): The earliest global iteration after
+			which the loop may end.
+	"""
+
+	def __init__(self, database_dir, threshold=0.005, matrices=DEFAULT_MATRICES, min_loops=1):
+		self.database_dir = database_dir
+		self.threshold = threshold
+		self.matrices = list(matrices)
+		self.min_loops = min_loops
+		self.history = {}
+		self._previous = None
+
+	def change(self):
+		"""
+		Read the skims, and compare them with those last read.
+
+		Returns:
+			float or None: The largest relative change of any matrix, or
+			None if there was nothing to compare with.
+		"""
+		current = {}
+		for name in self.matrices:
+			filename = os.path.join(self.database_dir, 'emmemat', f'{name}.emx')
+			try:
+				current[name] = read_emx(filename)
+			except FileNotFoundError:
+				_logger.warning(f"convergence: {filename} not found")
+				self._previous = None
+				return None
+		previous, self._previous = self._previous, current
+		if previous is None:
+			return None
+		changes = []
+		for name in self.matrices:
+			if previous[name].shape != current[name].shape:
+				return None
+			changes.append(relative_change(previous[name], current[name]))
+		return max(changes)
+
+	def __call__(self, counter):
+		"""Whether the feedback loop can end after global iteration `counter`."""
+		change = self.change()
+		self.history[counter] = change
+		if change is None:
+			return False
+		_logger.info(f"global iteration {counter}: relative skim change {change:.5f}")
+		return counter >= self.min_loops and change < self.threshold
+
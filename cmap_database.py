@@ -0,0 +1,1452 @@
+""" cmap_database.py - results database tools for the CMAP EMAT model """
+import io
+import os
+import re
+import ast
+import tokenize
+import time
+import uuid
+import queue
+import atexit
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+
+from emat import SQLiteDB
+from emat.database.sqlite import sql_queries as sq
+from emat.database.sqlite.sqlite_db import _to_uuid
+from emat.exceptions import ReadOnlyDatabaseError
+from emat.util.loggers import get_module_logger
+
+from cmap_derived import DerivedMeasures
+
+_logger = get_module_logger(__name__)
+
+
+def enable_wal(conn, busy_timeout=60000):
+	"""
+	Switch a SQLite connection to write-ahead logging.
+
+	In WAL mode readers never block the writer and the writer never blocks
+	readers, so only concurrent writers contend for the lock.  WAL requires
+	shared memory, and so does not work for a database file on a network
+	share; in that case SQLite leaves the journal mode unchanged.
+
+	Args:
+		conn (sqlite3.Connection): The connection.
+		busy_timeout (int): Milliseconds to wait on a locked database
+			before raising "database is locked".
+
+	Returns:
+		str: The journal mode now in effect.
+	"""
+	conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout)}")
+	mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+	if mode.lower() == 'wal':
+		conn.execute("PRAGMA synchronous = NORMAL")
+	else:
+		_logger.warning(f"WAL mode not available, journal_mode is {mode}")
+	return mode
+
+
+WIDE_TABLE = "cmap_wide_measure"
+WIDE_DIRTY_TABLE = "cmap_wide_measure_dirty"
+
+# Every change to a measure row marks its run as dirty, whichever process
+# or class made the change, so the wide table can be brought up to date
+# by re-pivoting just the dirty runs.
+_WIDE_SCHEMA = [
+	f"""CREATE TABLE IF NOT EXISTS {WIDE_TABLE} (
+		run_rowid        INTEGER NOT NULL,
+		experiment_id    INT NOT NULL,
+		PRIMARY KEY (run_rowid, experiment_id)
+	)""",
+	f"CREATE INDEX IF NOT EXISTS {WIDE_TABLE}_experiment ON {WIDE_TABLE} (experiment_id)",
+	f"CREATE TABLE IF NOT EXISTS {WIDE_DIRTY_TABLE} (run_rowid INTEGER PRIMARY KEY)",
+	f"""CREATE TRIGGER IF NOT EXISTS {WIDE_TABLE}_insert
+		AFTER INSERT ON ema_experiment_measure BEGIN
+			INSERT OR IGNORE INTO {WIDE_DIRTY_TABLE} (run_rowid) VALUES (NEW.measure_run);
+		END""",
+	f"""CREATE TRIGGER IF NOT EXISTS {WIDE_TABLE}_update
+		AFTER UPDATE ON ema_experiment_measure BEGIN
+			INSERT OR IGNORE INTO {WIDE_DIRTY_TABLE} (run_rowid) VALUES (OLD.measure_run);
+			INSERT OR IGNORE INTO {WIDE_DIRTY_TABLE} (run_rowid) VALUES (NEW.measure_run);
+		END""",
+	f"""CREATE TRIGGER IF NOT EXISTS {WIDE_TABLE}_delete
+		AFTER DELETE ON ema_experiment_measure BEGIN
+			INSERT OR IGNORE INTO {WIDE_DIRTY_TABLE} (run_rowid) VALUES (OLD.measure_run);
+		END""",
+]
+
+
+def _quote(name):
+	return '"' + str(name).replace('"', '""') + '"'
+
+
+def _has_table(conn, name):
+	return conn.execute(
+		"SELECT count(*) FROM sqlite_master WHERE type='table' AND name=?", [name]
+	).fetchone()[0] > 0
+
+
+def create_wide_measures(conn):
+	"""
+	Create the wide measure table and its change-tracking triggers.
+
+	The wide table holds one row per model run and experiment, and one
+	column per performance measure, the same layout `read_experiment_all`
+	returns.  A run has rows for several experiments when emat reuses a
+	model object's run_id for each experiment it runs.  When the table is
+	first created every existing run is marked dirty, so the next
+	`refresh_wide_measures` fills it from scratch.
+
+	Args:
+		conn (sqlite3.Connection): A writable connection.
+
+	Returns:
+		bool: Whether the table was newly created.
+	"""
+	if _has_table(conn, WIDE_TABLE):
+		return False
+	with conn:
+		for statement in _WIDE_SCHEMA:
+			conn.execute(statement)
+		conn.execute(f"""
+			INSERT OR IGNORE INTO {WIDE_DIRTY_TABLE} (run_rowid)
+			SELECT DISTINCT measure_run FROM ema_experiment_measure
+		""")
+	return True
+
+
+def refresh_wide_measures(conn, chunk_size=500):
+	"""
+	Bring the wide measure table up to date.
+
+	Only runs whose measure rows changed since the last refresh are
+	re-pivoted, `chunk_size` runs per transaction, so the cost of a
+	refresh scales with the number of new results, not the size of the
+	database.
+
+	Args:
+		conn (sqlite3.Connection): A writable connection.
+		chunk_size (int): Runs to re-pivot per transaction.
+
+	Returns:
+		int: The number of runs refreshed.
+	"""
+	create_wide_measures(conn)
+	n_refreshed = 0
+	# Within a caller's transaction, refresh as part of it.
+	own_transaction = not conn.in_transaction
+	while True:
+		if own_transaction:
+			conn.execute("BEGIN IMMEDIATE")
+		try:
+			dirty = [i[0] for i in conn.execute(
+				f"SELECT run_rowid FROM {WIDE_DIRTY_TABLE} LIMIT {int(chunk_size)}"
+			)]
+			if not dirty:
+				if own_transaction:
+					conn.commit()
+				break
+			marks = ",".join("?" * len(dirty))
+			conn.execute(f"DELETE FROM {WIDE_TABLE} WHERE run_rowid IN ({marks})", dirty)
+			rows = conn.execute(f"""
+				SELECT eem.measure_run, eem.experiment_id, ema_measure.name, eem.measure_value
+				FROM ema_experiment_measure eem
+					JOIN ema_measure ON eem.measure_id = ema_measure.measure_id
+				WHERE eem.measure_run IN ({marks})
+			""", dirty).fetchall()
+			if rows:
+				wide = pd.DataFrame(
+					rows, columns=['run_rowid', 'experiment_id', 'name', 'value'],
+				).pivot(index=['run_rowid', 'experiment_id'], columns='name', values='value')
+				existing = {i[1] for i in conn.execute(f"PRAGMA table_info({WIDE_TABLE})")}
+				for name in wide.columns:
+					if name not in existing:
+						conn.execute(f"ALTER TABLE {WIDE_TABLE} ADD COLUMN {_quote(name)} REAL")
+				wide = wide.reset_index().astype(object)
+				wide = wide.where(wide.notna(), None)
+				conn.executemany(
+					f"INSERT INTO {WIDE_TABLE} ({', '.join(_quote(c) for c in wide.columns)}) "
+					f"VALUES ({','.join('?' * len(wide.columns))})",
+					wide.itertuples(index=False, name=None),
+				)
+			conn.execute(f"DELETE FROM {WIDE_DIRTY_TABLE} WHERE run_rowid IN ({marks})", dirty)
+			if own_transaction:
+				conn.commit()
+		except:
+			if own_transaction:
+				conn.rollback()
+			raise
+		n_refreshed += len(dirty)
+	if n_refreshed:
+		_logger.debug(f"refreshed {n_refreshed} runs in {WIDE_TABLE}")
+	return n_refreshed
+
+
+FINGERPRINT_TABLE = "cmap_input_fingerprint"
+
+_FINGERPRINT_SCHEMA = [
+	f"""CREATE TABLE IF NOT EXISTS {FINGERPRINT_TABLE} (
+		experiment_id    INTEGER PRIMARY KEY,
+		fingerprint      TEXT NOT NULL,
+		reused_from      INTEGER
+	)""",
+	f"CREATE INDEX IF NOT EXISTS {FINGERPRINT_TABLE}_fingerprint ON {FINGERPRINT_TABLE} (fingerprint)",
+]
+
+
+def create_input_fingerprints(conn):
+	"""
+	Create the table of model input fingerprints.
+
+	Each experiment's fingerprint is a hash of the model input files
+	rendered for it, so experiments with the same fingerprint would
+	run the core model on identical inputs.
+
+	Args:
+		conn (sqlite3.Connection): A writable connection.
+
+	Returns:
+		bool: Whether the table was newly created.
+	"""
+	if _has_table(conn, FINGERPRINT_TABLE):
+		return False
+	with conn:
+		for statement in _FINGERPRINT_SCHEMA:
+			conn.execute(statement)
+	return True
+
+
+QUEUE_TABLE = "cmap_experiment_queue"
+
+_QUEUE_SCHEMA = [
+	f"""CREATE TABLE IF NOT EXISTS {QUEUE_TABLE} (
+		experiment_id    INTEGER PRIMARY KEY,
+		priority         INTEGER NOT NULL DEFAULT 0,
+		status           TEXT NOT NULL DEFAULT 'queued',
+		enqueued         REAL NOT NULL,
+		started          REAL,
+		finished         REAL,
+		worker           TEXT,
+		attempts         INTEGER NOT NULL DEFAULT 0,
+		note             TEXT
+	)""",
+	f"CREATE INDEX IF NOT EXISTS {QUEUE_TABLE}_next ON {QUEUE_TABLE} (status, priority DESC, enqueued)",
+]
+
+# The states of an experiment in the queue.  'preempted' experiments are
+# waiting to run again, like 'queued' ones.
+QUEUE_WAITING = ('queued', 'preempted')
+QUEUE_STATES = QUEUE_WAITING + ('running', 'done', 'failed', 'cancelled')
+
+
+def create_experiment_queue(conn):
+	"""
+	Create the persistent experiment queue table.
+
+	Args:
+		conn (sqlite3.Connection): A writable connection.
+
+	Returns:
+		bool: Whether the table was newly created.
+	"""
+	if _has_table(conn, QUEUE_TABLE):
+		return False
+	with conn:
+		for statement in _QUEUE_SCHEMA:
+			conn.execute(statement)
+	return True
+
+
+FAILURE_TABLE = "cmap_run_failure"
+
+_FAILURE_SCHEMA = [
+	f"""CREATE TABLE IF NOT EXISTS {FAILURE_TABLE} (
+		failure_id       INTEGER PRIMARY KEY,
+		run_id           TEXT,
+		experiment_id    INTEGER,
+		failure_class    TEXT NOT NULL,
+		message          TEXT,
+		source           TEXT,
+		detected         REAL NOT NULL
+	)""",
+	f"CREATE INDEX IF NOT EXISTS {FAILURE_TABLE}_experiment ON {FAILURE_TABLE} (experiment_id)",
+	f"CREATE INDEX IF NOT EXISTS {FAILURE_TABLE}_class ON {FAILURE_TABLE} (failure_class)",
+]
+
+
+def create_run_failures(conn):
+	"""
+	Create the table of classified core model run failures.
+
+	Args:
+		conn (sqlite3.Connection): A writable connection.
+
+	Returns:
+		bool: Whether the table was newly created.
+	"""
+	if _has_table(conn, FAILURE_TABLE):
+		return False
+	with conn:
+		for statement in _FAILURE_SCHEMA:
+			conn.execute(statement)
+	return True
+
+
+_SQL_COMPARE = {
+	ast.Eq: "=", ast.NotEq: "=",
+	ast.Lt: "<", ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">=",
+}
+_SQL_ARITHMETIC = {ast.Add: "+", ast.Sub: "-", ast.Mult: "*", ast.Div: "/"}
+_SQL_LOGICAL = {ast.And: "AND", ast.Or: "OR"}
+_PANDAS_BOOLEANS = {"&": "and", "|": "or", "~": "not"}
+
+
+def query_to_sql(query, column):
+	"""
+	Translate a simple pandas query string into an SQL expression.
+
+	The query may use comparisons (including chained comparisons),
+	arithmetic, `and`, `or`, `not` (or `&`, `|`, `~`) and numeric or
+	boolean constants.  As in pandas, a comparison with a missing value
+	is false, except `!=`, which is true; so `not` (or `~`) of a
+	comparison matches the runs with a missing value, where SQL alone
+	would give NULL and match nothing.
+
+	Args:
+		query (str): The query, as for `pandas.DataFrame.query`.
+		column (Callable[[str], str]): Gives the SQL expression for a
+			name used in the query.  It should raise ValueError for
+			unknown names.
+
+	Returns:
+		str
+
+	Raises:
+		ValueError: If the query uses anything else.
+	"""
+	def sql(node):
+		if isinstance(node, ast.Expression):
+			return sql(node.body)
+		if isinstance(node, ast.BoolOp):
+			return "(" + f" {_SQL_LOGICAL[type(node.op)]} ".join(sql(i) for i in node.values) + ")"
+		if isinstance(node, ast.BinOp) and type(node.op) in _SQL_ARITHMETIC:
+			return f"({sql(node.left)} {_SQL_ARITHMETIC[type(node.op)]} {sql(node.right)})"
+		if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+			return f"(NOT {sql(node.operand)})"
+		if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+			return f"(-{sql(node.operand)})"
+		if isinstance(node, ast.Compare):
+			terms = []
+			left = node.left
+			for op, right in zip(node.ops, node.comparators):
+				if type(op) not in _SQL_COMPARE:
+					raise ValueError(f"cannot translate {type(op).__name__} to SQL")
+				term = f"COALESCE({sql(left)} {_SQL_COMPARE[type(op)]} {sql(right)}, 0)"
+				terms.append(f"(NOT {term})" if isinstance(op, ast.NotEq) else term)
+				left = right
+			return "(" + " AND ".join(terms) + ")"
+		if isinstance(node, ast.Name):
+			return column(node.id)
+		if isinstance(node, ast.Constant) and isinstance(node.value, bool):
+			return str(int(node.value))
+		if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+			return repr(float(node.value))
+		raise ValueError(f"cannot translate {type(node).__name__} to SQL")
+
+	try:
+		# as in pandas, `&`, `|` and `~` bind like `and`, `or` and `not`
+		tokens = [
+			(tokenize.NAME, _PANDAS_BOOLEANS[t.string]) if t.string in _PANDAS_BOOLEANS else (t.type, t.string)
+			for t in tokenize.generate_tokens(io.StringIO(query.strip()).readline)
+		]
+		tree = ast.parse(tokenize.untokenize(tokens), mode='eval')
+	except (SyntaxError, tokenize.TokenError) as err:
+		raise ValueError(f"cannot parse query {query!r}") from err
+	return sql(tree)
+
+
+# Registers a run, unless it is already.
+INSERT_EXPERIMENT_RUN = sq.NEW_EXPERIMENT_RUN.replace("INSERT", "INSERT OR IGNORE", 1)
+
+
+class MeasureWriter:
+	"""
+	The writer thread for performance measure rows, one per process.
+
+	Rows put on the queue are committed in batches, each batch in one
+	`executemany` transaction, by a background thread with its own
+	connection.  The runs the rows belong to are registered in the same
+	transaction, so a run is never stored without its measures.  Every
+	thread of a process writing to the database shares the one writer,
+	so the rows of runs finishing together are committed together; locked
+	batches are retried with backoff, instead of failing the run.
+
+	This is not a writer for all processes: separate processes each have
+	their own writer, and take turns with the database's write lock.
+
+	`put` returns a `MeasureWrite`, which a caller can wait on to learn
+	whether its own rows were committed.
+
+	Use `get_measure_writer` to share one writer per database file within
+	a process.
+
+	Args:
+		database_path (str): The SQLite database file.
+		batch_size (int): Rows per transaction, short of a single `put`
+			with more rows, which is committed in one transaction.
+		flush_interval (float): Seconds to wait for more rows before
+			committing a partial batch.
+		wal (bool): Enable write-ahead logging on the database.
+		wide (bool): Refresh the wide measure table after each batch.
+	"""
+
+	def __init__(self, database_path, batch_size=5000, flush_interval=0.25, wal=True, wide=True):
+		self.database_path = database_path
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.wal = wal
+		self.wide = wide
+		self.n_written = 0
+		self._queue = queue.Queue()
+		self._thread = threading.Thread(
+			target=self._writer_loop,
+			name=f"MeasureWriter({os.path.basename(database_path)})",
+			daemon=True,
+		)
+		self._thread.start()
+
+	def put(self, rows, runs=()):
+		"""
+		Queue measure rows for writing.
+
+		Args:
+			rows (list[dict]): Bindings for `INSERT_EX_M`, with keys
+				experiment_id, measure_name, measure_value, measure_run.
+			runs (list[dict], optional): Bindings for `NEW_EXPERIMENT_RUN`,
+				with keys run_id, experiment_id, run_location, run_source,
+				for the runs to register with the rows, unless they are
+				already.
+
+		Returns:
+			MeasureWrite: To wait on the rows being committed.
+		"""
+		write = MeasureWrite(len(rows), list(runs))
+		if rows or runs:
+			self._queue.put((list(rows), write))
+		else:
+			write.done.set()
+		return write
+
+	def flush(self, timeout=None):
+		"""
+		Block until every row queued so far is committed, or has failed.
+
+		Errors are reported to the `MeasureWrite` of the rows that failed,
+		not here.
+		"""
+		done = threading.Event()
+		self._queue.put(done)
+		if not done.wait(timeout):
+			raise TimeoutError(f"measure writer did not flush within {timeout} seconds")
+
+	def close(self):
+		"""Flush, then stop the writer thread."""
+		if self._thread.is_alive():
+			self._queue.put(None)
+			self._thread.join()
+
+	def _commit(self, conn, rows, runs=()):
+		delay = 0.1
+		while True:
+			try:
+				with conn:
+					conn.executemany(INSERT_EXPERIMENT_RUN, runs)
+					conn.executemany(sq.INSERT_EX_M, rows)
+			except sqlite3.OperationalError as err:
+				if 'locked' not in str(err) and 'busy' not in str(err):
+					raise
+				_logger.warning(f"measure writer: {err}, retrying {len(rows)} rows in {delay:.1f}s")
+				time.sleep(delay)
+				delay = min(delay * 2, 10.0)
+			else:
+				self.n_written += len(rows)
+				return
+
+	def _writer_loop(self):
+		conn = sqlite3.connect(self.database_path, check_same_thread=False)
+		conn.execute("PRAGMA foreign_keys = ON")
+		if self.wal:
+			enable_wal(conn)
+		pending = []  # (rows, MeasureWrite) of each put not yet committed
+		n_pending = 0
+		waiters = []
+		stop = False
+		while not stop:
+			try:
+				item = self._queue.get(timeout=self.flush_interval if pending else None)
+			except queue.Empty:
+				item = ()
+			if item is None:
+				stop = True
+			elif isinstance(item, threading.Event):
+				waiters.append(item)
+			elif item:
+				pending.append(item)
+				n_pending += len(item[0])
+				if n_pending < self.batch_size and not self._queue.empty():
+					continue
+			committed = False
+			while pending and (stop or waiters or item == () or n_pending >= self.batch_size):
+				# Whole puts go in a batch, so each one commits or fails as a unit.
+				batch, n = [], 0
+				while pending and (not batch or n + len(pending[0][0]) <= self.batch_size):
+					rows, write = pending.pop(0)
+					batch.append(write)
+					n += len(rows)
+					write.rows = rows
+				n_pending -= n
+				try:
+					self._commit(
+						conn,
+						[row for write in batch for row in write.rows],
+						[run for write in batch for run in write.runs],
+					)
+					committed = True
+				except Exception as err:
+					_logger.exception(f"measure writer failed on {n} rows")
+					for write in batch:
+						write.error = err
+				for write in batch:
+					write.rows = None
+					write.done.set()
+			for w in waiters:
+				w.set()
+			waiters = []
+			if self.wide and committed:
+				try:
+					refresh_wide_measures(conn)
+				except Exception:
+					# readers refresh again, so this is not fatal
+					_logger.exception(f"measure writer could not refresh {WIDE_TABLE}")
+		conn.close()
+
+
+class MeasureWrite:
+	"""The rows of one `MeasureWriter.put`, to wait on."""
+
+	def __init__(self, n_rows, runs=()):
+		self.n_rows = n_rows
+		self.runs = list(runs)
+		self.rows = None
+		self.error = None
+		self.done = threading.Event()
+
+	def wait(self, timeout=None):
+		"""
+		Block until the rows are committed.
+
+		Raises:
+			sqlite3.Error: If they could not be written.
+			TimeoutError: If they are not written within `timeout` seconds.
+		"""
+		if not self.done.wait(timeout):
+			raise TimeoutError(f"{self.n_rows} measure rows not written within {timeout} seconds")
+		if self.error is not None:
+			raise self.error
+
+
+_measure_writers = {}
+_measure_writers_lock = threading.Lock()
+
+
+def get_measure_writer(database_path, **kwargs):
+	"""The shared MeasureWriter for a database file in this process."""
+	database_path = os.path.abspath(database_path)
+	with _measure_writers_lock:
+		writer = _measure_writers.get(database_path)
+		if writer is None or not writer._thread.is_alive():
+			writer = _measure_writers[database_path] = MeasureWriter(database_path, **kwargs)
+	return writer
+
+
+@atexit.register
+def _close_measure_writers():
+	for writer in list(_measure_writers.values()):
+		writer.close()
+
+
+class CMAP_SQLiteDB(SQLiteDB):
+	"""
+	A SQLiteDB that writes performance measures through a MeasureWriter.
+
+	The database is switched to WAL mode, and `write_experiment_measures`
+	hands the measure rows, and the runs they belong to, to the process's
+	shared writer thread, and returns once they are committed, raising
+	any error in writing them.  The writer batches the rows of all the
+	threads of a process into shared transactions, retrying while the
+	database is locked.  Each process has its own writer, so the workers
+	of a pool still take turns with the database's write lock, and each
+	waits for its own rows.  Written inside a transaction
+	on this connection, rows are inserted in that transaction instead, as
+	the writer could not commit until it ends.  Reads of measures flush
+	the writer first, so results written by any thread of this process
+	are visible to them.
+
+	Measures are also materialized in a wide table, one row per run and
+	one column per measure, which is kept up to date incrementally as
+	results arrive.  `read_experiment_all` reads from that table, loading
+	only the requested `columns`, instead of pivoting the long measure
+	table on every call.
+
+	Arguments are the same as for `emat.SQLiteDB`, plus:
+
+	Args:
+		wal (bool, default True): Enable write-ahead logging.
+		batch_size (int, default 5000): Rows per write transaction.
+		wide (bool, default True): Maintain the wide measure table.
+		mmap_megabytes (int, default 1024): Size of the memory map used
+			for reads, or 0 to read without memory mapping.
+	"""
+
+	def __init__(
+			self,
+			database_path=":memory:",
+			*args,
+			wal=True,
+			batch_size=5000,
+			wide=True,
+			mmap_megabytes=1024,
+			**kwargs,
+	):
+		super().__init__(database_path, *args, **kwargs)
+		self._measure_writer = None
+		self.wide = wide
+		if mmap_megabytes:
+			self.conn.execute(f"PRAGMA mmap_size = {int(mmap_megabytes) * 2**20}")
+		if not self.readonly:
+			create_input_fingerprints(self.conn)
+			create_experiment_queue(self.conn)
+			create_run_failures(self.conn)
+			if self.wide:
+				create_wide_measures(self.conn)
+			if self.database_path != ":memory:":
+				if wal:
+					enable_wal(self.conn)
+				self._measure_writer = get_measure_writer(
+					self.database_path, batch_size=batch_size, wal=wal, wide=wide,
+				)
+
+	def flush_measures(self, timeout=None):
+		"""
+		Block until the measures queued by every thread of this process are committed.
+
+		Inside a transaction on this connection this does nothing, as the
+		writer could not commit until it ends; the measures written by
+		this database object are committed already.
+		"""
+		if self._measure_writer is not None and not self.conn.in_transaction:
+			self._measure_writer.flush(timeout)
+
+	def write_experiment_measures(
+			self,
+			scope_name,
+			source,
+			m_df,
+			run_ids=None,
+			experiment_id=None,
+	):
+		if self._measure_writer is None:
+			return super().write_experiment_measures(scope_name, source, m_df, run_ids, experiment_id)
+		if self.readonly:
+			raise ReadOnlyDatabaseError
+		if experiment_id is not None:
+			if not isinstance(m_df, dict):
+				raise ValueError("only give an experiment_id with a dict as `m_df`")
+			m_df = pd.DataFrame(m_df, index=[experiment_id])
+
+		# split run_ids from multiindex
+		if m_df.index.nlevels == 2:
+			if run_ids is not None:
+				raise ValueError('run_ids cannot be given when they are embedded in m_df.index')
+			run_ids = m_df.index.get_level_values(1)
+			m_df.index = m_df.index.get_level_values(0)
+
+		scope_name = self._validate_scope(scope_name, None)
+		measure_names = [m[0] for m in self.conn.execute(sq.GET_SCOPE_M, [scope_name]).fetchall()]
+		if len(measure_names) == 0:
+			raise UserWarning(f'named scope {scope_name} not found - experiments will not be recorded')
+
+		# Run ids are registered with the measure rows, in the same
+		# transaction, as emat does.
+		if run_ids is None:
+			run_ids = [uuid.uuid1() for _ in m_df.index]
+		run_bytes = [_to_uuid(r).bytes for r in run_ids]
+		runs = [
+			dict(run_id=run, experiment_id=int(ex_id), run_location=None, run_source=source)
+			for run, ex_id in zip(run_bytes, m_df.index)
+		]
+
+		scope = None
+		rows = []
+		for measure_name in measure_names:
+			if measure_name in m_df.columns:
+				dataseries = m_df[measure_name]
+			else:
+				if scope is None:
+					scope = self.read_scope(scope_name)
+				formula = getattr(scope[measure_name], 'formula', None)
+				if not formula:
+					continue
+				try:
+					dataseries = m_df.eval(formula)
+				except pd.errors.UndefinedVariableError:
+					# computed on read instead, once all the inputs are stored
+					continue
+			for ex_id, value, run in zip(m_df.index, dataseries.to_numpy(), run_bytes):
+				if isinstance(value, np.generic):
+					value = value.item()
+				rows.append(dict(
+					experiment_id=int(ex_id),
+					measure_value=value,
+					measure_source=source,
+					measure_name=measure_name,
+					measure_run=run,
+				))
+		if self.conn.in_transaction:
+			self.conn.executemany(INSERT_EXPERIMENT_RUN, runs)
+			self.conn.executemany(sq.INSERT_EX_M, rows)
+		else:
+			self._measure_writer.put(rows, runs).wait()
+
+	def read_experiment_measures(self, *args, **kwargs):
+		self.flush_measures()
+		result = super().read_experiment_measures(*args, **kwargs)
+		if kwargs.get('formulas', True):
+			self._fill_derived_measures(result, args[0] if args else kwargs['scope_name'])
+		return result
+
+	def _fill_derived_measures(self, frame, scope):
+		"""Compute the derived measures of a scope that are not stored, in place."""
+		from emat import Scope
+		if not isinstance(scope, Scope):
+			scope = self.read_scope(scope)
+		DerivedMeasures().fill(frame, scope.get_measure_names())
+
+	def read_experiment_parameters(self, *args, **kwargs):
+		self.flush_measures()
+		return super().read_experiment_parameters(*args, **kwargs)
+
+	def refresh_wide_measures(self):
+		"""
+		Bring the wide measure table up to date.
+
+		Returns:
+			bool: Whether the wide table is current and can be read.
+		"""
+		if not self.wide:
+			return False
+		self.flush_measures()
+		if self.readonly:
+			if not _has_table(self.conn, WIDE_TABLE):
+				return False
+			return self.conn.execute(f"SELECT count(*) FROM {WIDE_DIRTY_TABLE}").fetchone()[0] == 0
+		refresh_wide_measures(self.conn)
+		return True
+
+	def read_wide_measures(
+			self,
+			scope_name,
+			design_name=None,
+			source=None,
+			*,
+			runs=None,
+			measures=None,
+			formulas=True,
+	):
+		"""
+		Read performance measures from the wide measure table.
+
+		This returns the same results as `read_experiment_measures`, but
+		reads only the requested measure columns from the pre-pivoted wide
+		table.
+
+		Args:
+			scope_name (str or Scope): The scope name.
+			design_name (str or Collection[str], optional): The design
+				name or names to read.
+			source (int, optional): The source identifier of the
+				results to load.
+			runs ({None, 'all', 'valid', 'invalid'}, default None): As
+				for `read_experiment_measures`.
+			measures (Collection[str], optional): The measures to read,
+				by default all the measures in the scope.
+			formulas (bool, default True): Compute formulaic measures, and
+				derived measures (see `cmap_derived`) that are not stored.
+
+		Returns:
+			pandas.DataFrame: Measures, indexed by experiment and run.
+		"""
+		assert runs in (None, 'all', 'valid', 'invalid')
+		from emat import Scope
+		if isinstance(scope_name, Scope):
+			scope = scope_name
+			scope_name = scope.name
+		else:
+			scope = self.read_scope(scope_name)
+		scope_name = self._validate_scope(scope_name, 'design_name')
+		if measures is None:
+			measures = scope.get_measure_names()
+		else:
+			measures = [m for m in scope.get_measure_names() if m in set(measures)]
+
+		available = {i[1] for i in self.conn.execute(f"PRAGMA table_info({WIDE_TABLE})")}
+		derived = DerivedMeasures()
+		load = []
+		for name in measures:
+			formula = getattr(scope[name], 'formula', None)
+			if formula and formulas:
+				load.extend(i for i in re.findall(r"\w+", formula) if i in available)
+			elif name in available:
+				load.append(name)
+			if formulas and name in derived.expressions:
+				# to compute it where it is not stored
+				load.extend(i for i in derived.dependencies([name]) if i in available)
+		load = list(dict.fromkeys(load))
+
+		design_where = ["es.name = ?"]
+		run_where = []
+		args = [scope_name]
+		if design_name is not None:
+			if isinstance(design_name, str):
+				design_name = [design_name]
+			design_where.append(f"ed.design IN ({','.join('?' * len(design_name))})")
+			args.extend(design_name)
+		if source is not None:
+			run_where.append("r.run_source = ?")
+			args.append(source)
+		if runs in (None, 'valid'):
+			run_where.append("r.run_valid = 1")
+		elif runs == 'invalid':
+			run_where.append("r.run_valid = 0")
+		sql = f"""
+			SELECT
+				w.experiment_id AS experiment,
+				r.run_id AS run,
+				r.run_source AS _source,
+				r.run_timestamp AS _timestamp,
+				r.run_rowid AS _rowid
+				{''.join(', w.' + _quote(i) for i in load)}
+			FROM {WIDE_TABLE} w
+				JOIN ema_experiment_run r ON r.run_rowid = w.run_rowid
+			WHERE w.experiment_id IN (
+				SELECT ede.experiment_id
+				FROM ema_design_experiment ede
+					JOIN ema_design ed ON ed.design_id = ede.design_id
+					JOIN ema_scope es ON es.scope_id = ed.scope_id
+				WHERE {' AND '.join(design_where)}
+			) {''.join(' AND ' + i for i in run_where)}
+		"""
+		ex_m = pd.read_sql_query(sql, self.conn, params=args)
+		ex_m[load] = ex_m[load].astype(np.float64)
+		if runs is None:
+			# the most recent valid run from each source, as in emat
+			ex_m = ex_m.sort_values(['_timestamp', '_rowid']).drop_duplicates(['experiment', '_source'], keep='last')
+			if ex_m['experiment'].duplicated().any():
+				raise ValueError("duplicate experiment ids suggest results "
+								 "from more than one model source are stored\n"
+								 "set `runs='valid'` to return results from all "
+								 "sources or set the `source` argument.")
+		ex_m['run'] = [_to_uuid(i) for i in ex_m['run']]
+		ex_m = ex_m.drop(columns=['_source', '_timestamp', '_rowid']).set_index(['experiment', 'run']).sort_index()
+		ex_m.columns.name = None
+		if formulas:
+			for name in measures:
+				formula = getattr(scope[name], 'formula', None)
+				if formula:
+					ex_m[name] = ex_m.eval(formula)
+			derived.fill(ex_m, measures)
+		return ex_m[[i for i in measures if i in ex_m.columns]]
+
+	def write_derived_measures(self, scope, derived, design_name=None, *, overwrite=False):
+		"""
+		Compute derived measures for stored runs, and write them.
+
+		The inputs of every run are read in one query, the derived
+		measures are computed for all of them at once, and the results
+		are written back to the same runs.  This backfills runs made
+		before a derived measure was declared.
+
+		Args:
+			scope (emat.Scope): The scope.
+			derived (cmap_derived.DerivedMeasures): The derived measures.
+				Only those that are measures in `scope` are written.
+			design_name (str or Collection[str], optional): Limit the
+				backfill to these designs.
+			overwrite (bool, default False): Recompute values that are
+				already stored, instead of only filling in missing ones.
+
+		Returns:
+			int: The number of values written.
+		"""
+		if self.readonly:
+			raise ReadOnlyDatabaseError
+		names = [i for i in derived.measure_names if i in scope.get_measure_names()]
+		inputs = derived.dependencies(names)
+		columns = list(dict.fromkeys(inputs + names))
+		if self.refresh_wide_measures():
+			stored = self.read_wide_measures(
+				scope, design_name, runs='all', measures=columns, formulas=False,
+			)
+		else:
+			stored = super().read_experiment_measures(
+				scope.name, design_name, runs='all', formulas=False,
+			)
+		stored = stored.reindex(columns=columns)
+		computed = derived.compute(stored[inputs], names)
+
+		run_source = dict(self.conn.execute(
+			"SELECT run_id, run_source FROM ema_experiment_run"
+		).fetchall())
+		sources = pd.Series(
+			[run_source[_to_uuid(r).bytes] for r in computed.index.get_level_values('run')],
+			index=computed.index,
+		)
+		n = 0
+		for name in computed.columns:
+			values = computed[name]
+			keep = values.notna()
+			if not overwrite:
+				keep &= stored[name].isna()
+			for source, group in values[keep].groupby(sources[keep]):
+				self.write_experiment_measures(scope.name, int(source), group.to_frame())
+				n += len(group)
+		self.flush_measures()
+		_logger.info(f"wrote {n} derived measure values")
+		return n
+
+	def write_input_fingerprints(self, fingerprints, reused_from=None):
+		"""
+		Store the model input fingerprints of some experiments.
+
+		Args:
+			fingerprints (Mapping[int, str]): Fingerprints by experiment id.
+			reused_from (int, optional): The experiment whose results
+				were reused for these experiments, instead of running
+				the core model.
+		"""
+		if self.readonly:
+			raise ReadOnlyDatabaseError
+		with self.conn:
+			self.conn.executemany(
+				f"INSERT OR REPLACE INTO {FINGERPRINT_TABLE} "
+				f"(experiment_id, fingerprint, reused_from) VALUES (?, ?, ?)",
+				[(int(k), v, reused_from) for k, v in fingerprints.items()],
+			)
+
+	def read_input_fingerprints(self, scope_name=None, design_name=None):
+		"""
+		Read stored model input fingerprints.
+
+		Args:
+			scope_name (str, optional): Only experiments in this scope.
+			design_name (str, optional): Only experiments in this design.
+
+		Returns:
+			pandas.DataFrame: `fingerprint` and `reused_from`, indexed
+			by experiment id.
+		"""
+		query = f"SELECT f.experiment_id, f.fingerprint, f.reused_from FROM {FINGERPRINT_TABLE} f"
+		args = {}
+		if scope_name is not None:
+			query += """
+				JOIN ema_experiment ee ON ee.experiment_id = f.experiment_id
+				JOIN ema_scope es ON ee.scope_id = es.scope_id AND es.name = @scope_name
+			"""
+			args['scope_name'] = scope_name
+		if design_name is not None:
+			query += """
+				JOIN ema_design_experiment ede ON ede.experiment_id = f.experiment_id
+				JOIN ema_design ed ON ed.design_id = ede.design_id AND ed.design = @design_name
+			"""
+			args['design_name'] = design_name
+		if not _has_table(self.conn, FINGERPRINT_TABLE):
+			rows = []
+		else:
+			rows = self.conn.execute(query, args).fetchall()
+		result = pd.DataFrame(rows, columns=['experiment', 'fingerprint', 'reused_from'])
+		result['reused_from'] = result['reused_from'].astype('Int64')
+		return result.set_index('experiment')
+
+	def read_completed_experiment_ids(self, scope_name, source=0, since=None):
+		"""
+		The experiments with stored results from a valid run.
+
+		Args:
+			scope_name (str): The scope name.
+			source (int, default 0): The source of the results, 0 for
+				the core model or a metamodel_id.
+			since (float, optional): Only runs started at or after this
+				time, in seconds since the epoch, to the second.
+
+		Returns:
+			set[int]
+		"""
+		self.flush_measures()
+		newer = "" if since is None else "AND r.run_timestamp >= datetime(CAST(@since AS INTEGER), 'unixepoch')"
+		return {i[0] for i in self.conn.execute(f"""
+			SELECT DISTINCT r.experiment_id
+			FROM ema_experiment_run r
+				JOIN ema_experiment ee ON ee.experiment_id = r.experiment_id
+				JOIN ema_scope es ON ee.scope_id = es.scope_id
+			WHERE es.name = @scope_name
+				AND r.run_valid = 1
+				AND r.run_source = @source
+				{newer}
+				AND EXISTS (SELECT 1 FROM ema_experiment_measure eem WHERE eem.measure_run = r.run_rowid)
+		""", dict(scope_name=scope_name, source=source, since=since))}
+
+	def enqueue_experiments(self, experiment_ids, priority=0, note=None, requeue=False):
+		"""
+		Add experiments to the persistent experiment queue.
+
+		Experiments already waiting in the queue take the new priority.
+		Those that are running are left alone, and those that are done,
+		failed or cancelled are only queued again if `requeue` is set.
+
+		Args:
+			experiment_ids (Iterable[int]): The experiments.
+			priority (int, default 0): Higher priorities run first.
+			note (str, optional): A note, e.g. who asked for the runs.
+			requeue (bool, default False): Queue finished experiments again.
+
+		Returns:
+			int: The number of experiments queued or re-prioritized.
+		"""
+		if self.readonly:
+			raise ReadOnlyDatabaseError
+		now = time.time()
+		finished = "" if requeue else ", 'done', 'failed', 'cancelled'"
+		n = 0
+		with self.conn:
+			for experiment_id in experiment_ids:
+				n += self.conn.execute(f"""
+					INSERT INTO {QUEUE_TABLE} (experiment_id, priority, status, enqueued, note)
+					VALUES (@experiment_id, @priority, 'queued', @now, @note)
+					ON CONFLICT (experiment_id) DO UPDATE SET
+						priority = excluded.priority,
+						note = coalesce(excluded.note, note),
+						status = CASE WHEN status IN ('queued', 'preempted') THEN status ELSE 'queued' END,
+						enqueued = CASE WHEN status IN ('queued', 'preempted') THEN enqueued ELSE excluded.enqueued END
+					WHERE status NOT IN ('running'{finished})
+				""", dict(experiment_id=int(experiment_id), priority=int(priority), now=now, note=note)).rowcount
+		return n
+
+	def claim_queued_experiment(self, worker):
+		"""
+		Take the next experiment off the queue.
+
+		The experiment with the highest priority, and among those the
+		one queued first, is marked as running by `worker`, in one
+		transaction, so concurrent workers never claim the same one.
+
+		Args:
+			worker (str): Identifies the claiming worker.
+
+		Returns:
+			tuple or None: The (experiment_id, priority) claimed, or
+			None if nothing is waiting.
+		"""
+		if self.readonly:
+			raise ReadOnlyDatabaseError
+		self.conn.execute("BEGIN IMMEDIATE")
+		try:
+			row = self.conn.execute(f"""
+				SELECT experiment_id, priority FROM {QUEUE_TABLE}
+				WHERE status IN {QUEUE_WAITING}
+				ORDER BY priority DESC, enqueued, experiment_id
+				LIMIT 1
+			""").fetchone()
+			if row is not None:
+				self.conn.execute(f"""
+					UPDATE {QUEUE_TABLE}
+					SET status = 'running', started = ?, finished = NULL, worker = ?, attempts = attempts + 1
+					WHERE experiment_id = ?
+				""", [time.time(), worker, row[0]])
+			self.conn.commit()
+		except:
+			self.conn.rollback()
+			raise
+		return row
+
+	def finish_queued_experiment(self, experiment_id, status):
+		"""
+		Record how a queued experiment ended.
+
+		Args:
+			experiment_id (int): The experiment.
+			status (str): 'done', 'failed', 'preempted' (to be run
+				again) or 'cancelled'.
+		"""
+		if status not in QUEUE_STATES:
+			raise ValueError(f"unknown queue status {status!r}")
+		with self.conn:
+			self.conn.execute(
+				f"UPDATE {QUEUE_TABLE} SET status = ?, finished = ? WHERE experiment_id = ?",
+				[status, time.time(), int(experiment_id)],
+			)
+
+	def top_queued_priority(self):
+		"""The highest priority waiting in the queue, or None."""
+		if not _has_table(self.conn, QUEUE_TABLE):
+			return None
+		return self.conn.execute(
+			f"SELECT max(priority) FROM {QUEUE_TABLE} WHERE status IN {QUEUE_WAITING}"
+		).fetchone()[0]
+
+	def requeue_orphaned_experiments(self, is_alive):
+		"""
+		Put running experiments whose worker has gone back on the queue.
+
+		Args:
+			is_alive (callable): Given a worker, whether it is still
+				running; return None if that cannot be known, and the
+				experiment is left alone.
+
+		Returns:
+			list[int]: The experiments queued again.
+		"""
+		running = self.conn.execute(
+			f"SELECT experiment_id, worker FROM {QUEUE_TABLE} WHERE status = 'running'"
+		).fetchall()
+		orphans = [experiment_id for experiment_id, worker in running if is_alive(worker) is False]
+		with self.conn:
+			self.conn.executemany(
+				f"UPDATE {QUEUE_TABLE} SET status = 'queued', worker = NULL WHERE experiment_id = ?",
+				[(i,) for i in orphans],
+			)
+		return orphans
+
+	def read_experiment_queue(self, status=None):
+		"""
+		Read the experiment queue.
+
+		Args:
+			status (str or Collection[str], optional): Only these states.
+
+		Returns:
+			pandas.DataFrame: One row per experiment, in the order they
+			would run.
+		"""
+		columns = ['experiment', 'priority', 'status', 'enqueued', 'started', 'finished', 'worker', 'attempts', 'note']
+		if not _has_table(self.conn, QUEUE_TABLE):
+			return pd.DataFrame(columns=columns).set_index('experiment')
+		if isinstance(status, str):
+			status = [status]
+		where = "" if status is None else f"WHERE status IN ({','.join('?' * len(status))})"
+		rows = self.conn.execute(f"""
+			SELECT experiment_id, priority, status, enqueued, started, finished, worker, attempts, note
+			FROM {QUEUE_TABLE} {where}
+			ORDER BY status NOT IN {QUEUE_WAITING}, priority DESC, enqueued, experiment_id
+		""", list(status or [])).fetchall()
+		result = pd.DataFrame(rows, columns=columns).set_index('experiment')
+		for t in ('enqueued', 'started', 'finished'):
+			result[t] = pd.to_datetime(result[t], unit='s')
+		return result
+
+	def write_run_failure(self, run_id, experiment_id, failure_class, message=None, source=None):
+		"""
+		Record the class of failure of a core model run.
+
+		Args:
+			run_id (UUID or str): The run.
+			experiment_id (int, optional): Its experiment.
+			failure_class (str): The kind of failure, see `cmap_logwatch`.
+			message (str, optional): What was found.
+			source (str, optional): Where it was found.
+		"""
+		if self.readonly:
+			raise ReadOnlyDatabaseError
+		with self.conn:
+			self.conn.execute(
+				f"INSERT INTO {FAILURE_TABLE} "
+				f"(run_id, experiment_id, failure_class, message, source, detected) VALUES (?, ?, ?, ?, ?, ?)",
+				[
+					str(run_id),
+					None if experiment_id is None else int(experiment_id),
+					failure_class, message, source, time.time(),
+				],
+			)
+
+	def read_run_failures(self, experiment_id=None, failure_class=None):
+		"""
+		Read the classified failures of core model runs.
+
+		Args:
+			experiment_id (int, optional): Only runs of this experiment.
+			failure_class (str, optional): Only this kind of failure.
+
+		Returns:
+			pandas.DataFrame: One row per failure, oldest first.
+		"""
+		columns = ['failure_id', 'run_id', 'experiment', 'failure_class', 'message', 'source', 'detected']
+		if not _has_table(self.conn, FAILURE_TABLE):
+			return pd.DataFrame(columns=columns).set_index('failure_id')
+		where, args = [], []
+		if experiment_id is not None:
+			where.append("experiment_id = ?")
+			args.append(int(experiment_id))
+		if failure_class is not None:
+			where.append("failure_class = ?")
+			args.append(failure_class)
+		rows = self.conn.execute(f"""
+			SELECT failure_id, run_id, experiment_id, failure_class, message, source, detected
+			FROM {FAILURE_TABLE} {"WHERE " + " AND ".join(where) if where else ""}
+			ORDER BY failure_id
+		""", args).fetchall()
+		result = pd.DataFrame(rows, columns=columns).set_index('failure_id')
+		result['detected'] = pd.to_datetime(result['detected'], unit='s')
+		return result
+
+	def read_failure_counts(self, experiment_id=None):
+		"""
+		Count the failures of core model runs, by class of failure.
+
+		Args:
+			experiment_id (int, optional): Only runs of this experiment.
+
+		Returns:
+			pandas.DataFrame: Indexed by failure class, with the number
+			of `failures`, of distinct `experiments`, and the time of
+			the `last` failure, most frequent first.
+		"""
+		columns = ['failure_class', 'failures', 'experiments', 'last']
+		if not _has_table(self.conn, FAILURE_TABLE):
+			return pd.DataFrame(columns=columns).set_index('failure_class')
+		where = "" if experiment_id is None else "WHERE experiment_id = ?"
+		rows = self.conn.execute(f"""
+			SELECT failure_class, count(*), count(DISTINCT experiment_id), max(detected)
+			FROM {FAILURE_TABLE} {where}
+			GROUP BY failure_class
+			ORDER BY count(*) DESC, failure_class
+		""", [] if experiment_id is None else [int(experiment_id)]).fetchall()
+		result = pd.DataFrame(rows, columns=columns).set_index('failure_class')
+		result['last'] = pd.to_datetime(result['last'], unit='s')
+		return result
+
+	def find_input_twins(self, fingerprint, exclude=None):
+		"""
+		Find the experiments with a given model input fingerprint.
+
+		Args:
+			fingerprint (str): The fingerprint.
+			exclude (int, optional): An experiment id to leave out.
+
+		Returns:
+			list[int]: Experiment ids, oldest first.
+		"""
+		if not _has_table(self.conn, FINGERPRINT_TABLE):
+			return []
+		return [i[0] for i in self.conn.execute(
+			f"SELECT experiment_id FROM {FINGERPRINT_TABLE} "
+			f"WHERE fingerprint = ? AND experiment_id IS NOT ? ORDER BY experiment_id",
+			[fingerprint, exclude],
+		)]
+
+	def _wide_column_sql(self, scope):
+		"""A `query_to_sql` column function for the wide measure table."""
+		available = {i[1] for i in self.conn.execute(f"PRAGMA table_info({WIDE_TABLE})")}
+		parameters = set(scope.get_parameter_names())
+		measures = set(scope.get_measure_names())
+
+		def column(name):
+			if name in measures:
+				formula = getattr(scope[name], 'formula', None)
+				if formula:
+					return query_to_sql(formula, column)
+				if name in available:
+					return f"w.{_quote(name)}"
+				return "NULL"
+			if name in parameters:
+				return f"""(
+					SELECT eep.parameter_value
+					FROM ema_experiment_parameter eep
+						JOIN ema_parameter ep ON eep.parameter_id = ep.parameter_id
+					WHERE ep.name = '{name.replace("'", "''")}' AND eep.experiment_id = w.experiment_id
+				)"""
+			raise ValueError(f"unknown name {name!r}")
+
+		return column
+
+	def invalidate_experiment_runs(
+			self,
+			run_ids=None,
+			queries=None,
+			**kwargs,
+	):
+		if queries is None or run_ids is not None or set(kwargs) - {'scope_name'} or not self.wide:
+			return super().invalidate_experiment_runs(run_ids, queries, **kwargs)
+		if self.readonly:
+			raise ReadOnlyDatabaseError
+		if isinstance(queries, str):
+			queries = [queries]
+		scope_name = self._validate_scope(kwargs.get('scope_name', None), None)
+		scope = self.read_scope(scope_name)
+		self.refresh_wide_measures()
+		column = self._wide_column_sql(scope)
+		try:
+			predicates = [query_to_sql(q, column) for q in queries]
+		except ValueError as err:
+			_logger.info(f"invalidate_experiment_runs: {err}, evaluating queries in pandas")
+			return super().invalidate_experiment_runs(queries=queries, **kwargs)
+		if not predicates:
+			return []
+
+		# Each run is attributed to the first query it matches, as if
+		# the queries were run one after another.
+		first_match = "CASE " + " ".join(
+			f"WHEN {p} THEN {n}" for n, p in enumerate(predicates)
+		) + " END"
+		matching_runs = f"""
+			SELECT w.run_rowid, {first_match} AS query_number
+			FROM {WIDE_TABLE} w
+				JOIN ema_experiment_run r ON r.run_rowid = w.run_rowid
+			WHERE r.run_valid = 1
+				AND w.experiment_id IN (
+					SELECT ee.experiment_id
+					FROM ema_experiment ee
+						JOIN ema_scope es ON ee.scope_id = es.scope_id
+					WHERE es.name = @scope_name
+				)
+		"""
+		n_runs_invalidated = [0] * len(predicates)
+		args = dict(scope_name=scope_name)
+		own_transaction = not self.conn.in_transaction
+		if own_transaction:
+			self.conn.execute("BEGIN IMMEDIATE")
+		try:
+			for query_number, n in self.conn.execute(f"""
+				SELECT query_number, count(*) FROM ({matching_runs})
+				WHERE query_number IS NOT NULL GROUP BY query_number
+			""", args):
+				n_runs_invalidated[query_number] = n
+			self.conn.execute(f"""
+				UPDATE ema_experiment_run SET run_valid = 0
+				WHERE run_rowid IN (
+					SELECT run_rowid FROM ({matching_runs}) WHERE query_number IS NOT NULL
+				)
+			""", args)
+			if own_transaction:
+				self.conn.commit()
+		except:
+			if own_transaction:
+				self.conn.rollback()
+			raise
+		return n_runs_invalidated
+
+	def read_experiment_all(
+			self,
+			scope_name,
+			design_name=None,
+			source=None,
+			*,
+			columns=None,
+			only_pending=False,
+			only_incomplete=False,
+			only_complete=False,
+			only_with_measures=False,
+			ensure_dtypes=True,
+			with_run_ids=False,
+			runs=None,
+			formulas=True,
+	):
+		uses_wide = (
+			not (only_pending or only_incomplete or only_complete or only_with_measures)
+			and runs != 'valid_mean'
+			and self.refresh_wide_measures()
+		)
+		if not uses_wide:
+			result = super().read_experiment_all(
+				scope_name,
+				design_name,
+				source,
+				only_pending=only_pending,
+				only_incomplete=only_incomplete,
+				only_complete=only_complete,
+				only_with_measures=only_with_measures,
+				ensure_dtypes=ensure_dtypes,
+				with_run_ids=with_run_ids,
+				runs=runs,
+				formulas=formulas,
+			)
+			if formulas:
+				self._fill_derived_measures(result, scope_name)
+			if columns is not None:
+				design_name = result.design_name
+				result = result[[i for i in result.columns if i in set(columns)]]
+				result.design_name = design_name
+			return result
+
+		from emat import Scope
+		from emat.experiment.experimental_design import ExperimentalDesign
+		if isinstance(scope_name, Scope):
+			scope = scope_name
+			scope_name = scope.name
+		else:
+			scope = self.read_scope(scope_name)
+		column_order = (
+			scope.get_constant_names()
+			+ scope.get_uncertainty_names()
+			+ scope.get_lever_names()
+			+ scope.get_measure_names()
+		)
+		if columns is not None:
+			column_order = [i for i in column_order if i in set(columns)]
+		df_p = self.read_experiment_parameters(
+			scope_name=scope_name,
+			design_name=design_name,
+			ensure_dtypes=ensure_dtypes,
+		)
+		df_p = df_p[[i for i in df_p.columns if i in set(column_order)]]
+		df_m = self.read_wide_measures(
+			scope,
+			design_name,
+			source,
+			runs=runs,
+			measures=[i for i in scope.get_measure_names() if i in set(column_order)],
+			formulas=formulas,
+		)
+		ex_xlm = pd.merge(
+			df_p,
+			df_m.reset_index().set_index('experiment'),
+			how='outer',
+			on='experiment',
+		).reset_index().set_index(['experiment', 'run'])
+		if not with_run_ids:
+			ex_xlm.index = ex_xlm.index.droplevel(1)
+		result = ex_xlm[[i for i in column_order if i in ex_xlm.columns]]
+		if ensure_dtypes:
+			result = scope.ensure_dtypes(result)
+		result = ExperimentalDesign(result)
+		result.design_name = design_name
+		return result
+
+	read_experiment_measures.__doc__ = SQLiteDB.read_experiment_measures.__doc__
+	read_experiment_all.__doc__ = SQLiteDB.read_experiment_all.__doc__.replace(
+		"            only_pending (bool",
+		"            columns (Collection[str], optional): The parameters and\n"
+		"                measures to read, by default all of them.  Only these\n"
+		"                columns are loaded from the wide measure table.\n"
+		"            only_pending (bool",
+	)
+	read_experiment_parameters.__doc__ = SQLiteDB.read_experiment_parameters.__doc__
+	write_experiment_measures.__doc__ = SQLiteDB.write_experiment_measures.__doc__
+	invalidate_experiment_runs.__doc__ = SQLiteDB.invalidate_experiment_runs.__doc__.replace(
+		"of parameters and measures.",
+		"of parameters and measures.  Simple comparisons and\n"
+		"                arithmetic on parameters and measures are evaluated\n"
+		"                together in SQL, in a single transaction.",
+	)
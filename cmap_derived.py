@@ -0,0 +1,230 @@
+""" cmap_derived.py - performance measures derived from other measures
+
+Some performance measures are not read from any report file, but are sums
+or ratios of measures that are: regionwide VMT is the sum of the district
+totals in `run_vmt_statistics.rpt`, the EJ trip duration ratio divides a
+value in `report_ej.txt` by one in `final_run_statistics.rpt`, and so on.
+These are declared here as arithmetic expressions over the parsed measure
+names.  Each expression is compiled once and evaluated on whatever the names
+are bound to, so the same declaration is computed on scalars for a single
+model run in `load_measures`, and on whole columns, for every stored run at
+once, when the database is backfilled.
+"""
+import re
+import warnings
+import itertools
+import collections
+import numpy as np
+import pandas as pd
+
+from emat.util.loggers import get_module_logger
+
+_logger = get_module_logger(__name__)
+
+# The districts of run_vmt_statistics.rpt, in report order.
+DISTRICTS = [
+	'Chicago',
+	'Cook_balance',
+	'DuPage',
+	'Kane',
+	'Kendall',
+	'Lake',
+	'McHenry',
+	'Will',
+	'Illinois_balance',
+	'Indiana',
+	'Wisconsin',
+]
+
+
+def sum_over(template, **levels):
+	"""
+	An expression summing a measure name template over some levels.
+
+	For example, `sum_over('{district}_Arterial_VMT', district=DISTRICTS)`
+	is the sum of the arterial VMT in every district.
+	"""
+	names = list(levels)
+	return " + ".join(
+		template.format(**dict(zip(names, values)))
+		for values in itertools.product(*levels.values())
+	)
+
+
+DERIVED_MEASURES = {
+	'Regionwide_VMT': sum_over('{district}_Total_District_VMT', district=DISTRICTS),
+	'Regionwide_Expressway_VMT': sum_over('{district}_Expressway_VMT', district=DISTRICTS),
+	'Regionwide_Arterial_VMT': sum_over('{district}_Arterial_VMT', district=DISTRICTS),
+	'Trip_Duration_Ratio_EJ_to_Global_HW': (
+		'EJ_Average_Trip_Time_HWej_Aut_Avg_Min / ENTIRE_NETWORK_Trip_Duration_HW_Trip_Average_Minutes'
+	),
+}
+
+# Names in an expression, other than those of functions being called.
+_NAME = re.compile(r"\b([A-Za-z_]\w*)\b(?!\s*\()")
+
+# The functions an expression may call; they work on scalars and arrays alike.
+_FUNCTIONS = {
+	'__builtins__': {},
+	'abs': np.abs,
+	'sqrt': np.sqrt,
+	'log': np.log,
+	'exp': np.exp,
+	'minimum': np.minimum,
+	'maximum': np.maximum,
+	'where': np.where,
+}
+
+
+class DerivedMeasures:
+	"""
+	Performance measures computed from other performance measures.
+
+	Args:
+		expressions (Mapping[str, str]): An expression for each derived
+			measure, in terms of other measure names, using arithmetic
+			and the functions abs, sqrt, log, exp, minimum, maximum and
+			where.  An expression may use derived measures declared
+			before it.
+	"""
+
+	def __init__(self, expressions=None):
+		self.expressions = dict(DERIVED_MEASURES if expressions is None else expressions)
+		self._inputs = {
+			name: [i for i in dict.fromkeys(_NAME.findall(expr))]
+			for name, expr in self.expressions.items()
+		}
+		self._code = {
+			name: compile(expr, f"<derived measure {name}>", 'eval')
+			for name, expr in self.expressions.items()
+		}
+
+	def __getstate__(self):
+		# code objects do not pickle
+		return {'expressions': self.expressions}
+
+	def __setstate__(self, state):
+		self.__init__(state['expressions'])
+
+	def __repr__(self):
+		return f"<DerivedMeasures: {', '.join(self.expressions)}>"
+
+	@property
+	def measure_names(self):
+		"""List: the names of the derived measures."""
+		return list(self.expressions)
+
+	def dependencies(self, measure_names=None):
+		"""
+		The parsed measures needed to compute some derived measures.
+
+		Args:
+			measure_names (Collection[str], optional): Derived measures,
+				by default all of them.  Other names are ignored.
+
+		Returns:
+			list[str]
+		"""
+		wanted = self._closure(measure_names)
+		result = {}
+		for name in self.expressions:
+			if name in wanted:
+				for i in self._inputs[name]:
+					if i not in self.expressions:
+						result[i] = None
+		return list(result)
+
+	def _closure(self, measure_names):
+		"""Derived measures in `measure_names`, and those they are derived from."""
+		if measure_names is None:
+			return set(self.expressions)
+		wanted = set(measure_names) & set(self.expressions)
+		pending = list(wanted)
+		while pending:
+			for i in self._inputs[pending.pop()]:
+				if i in self.expressions and i not in wanted:
+					wanted.add(i)
+					pending.append(i)
+		return wanted
+
+	def fill(self, data, measure_names=None):
+		"""
+		Fill in derived measures missing from stored results.
+
+		Derived measures once came from formulas in the scope, computed
+		when they were read, so results stored before they were declared
+		here have none until they are backfilled.  Each missing value
+		whose inputs are present is computed.
+
+		Args:
+			data (pandas.DataFrame): Measures, one row per model run.
+			measure_names (Sequence[str], optional): The measures `data`
+				should have, in order.  Derived measures among them that
+				are not columns of `data` are added, after the measure
+				before them; otherwise they are left out.
+
+		Returns:
+			pandas.DataFrame: `data`, filled in place.
+		"""
+		def computable(name):
+			return all(i in data.columns for i in self.dependencies([name]))
+
+		for k, name in enumerate(measure_names or []):
+			if name in self.expressions and name not in data.columns and computable(name):
+				before = [i for i in measure_names[:k] if i in data.columns]
+				loc = data.columns.get_loc(before[-1]) + 1 if before else len(data.columns)
+				data.insert(loc, name, np.nan)
+		names = [name for name in self.expressions if name in data.columns and computable(name)]
+		if not names:
+			return data
+		missing = data[names].isna().any(axis=1)
+		if missing.any():
+			computed = self.compute(data.loc[missing], names)
+			for name in names:
+				data.loc[missing, name] = data.loc[missing, name].fillna(computed[name])
+		return data
+
+	def compute(self, data, measure_names=None):
+		"""
+		Compute derived measures.
+
+		Args:
+			data (pandas.DataFrame or Mapping): Parsed measures, either a
+				DataFrame with one row per model run, or a mapping of
+				measure values for a single run.
+			measure_names (Collection[str], optional): The derived
+				measures to compute, by default all of them.
+
+		Returns:
+			pandas.DataFrame or dict: The derived measures, as a DataFrame
+			with the same index as `data` or as a dict.  A measure whose
+			inputs are not all in `data` is left out, with a warning.
+			Division by zero gives inf or NaN, as in numpy, and a measure
+			that cannot be computed otherwise is NaN, with a warning.
+		"""
+		wanted = self._closure(measure_names)
+		scalar = not isinstance(data, pd.DataFrame)
+		values = {}
+		names = collections.ChainMap(values, data)
+		with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+			for name in self.expressions:
+				if name not in wanted:
+					continue
+				missing = [i for i in self._inputs[name] if i not in names]
+				if missing:
+					warnings.warn(f"{name} unavailable, missing {', '.join(missing)}")
+					continue
+				inputs = {i: names[i] for i in self._inputs[name]}
+				if scalar:
+					# numpy scalars divide by zero as the columns do, not raise
+					inputs = {i: np.float64(v) for i, v in inputs.items()}
+				try:
+					values[name] = eval(self._code[name], _FUNCTIONS, inputs)
+				except ArithmeticError as err:
+					warnings.warn(f"{name} not computed, {err}")
+					values[name] = np.nan
+		if measure_names is not None:
+			values = {k: v for k, v in values.items() if k in measure_names}
+		if isinstance(data, pd.DataFrame):
+			return pd.DataFrame(values, index=data.index, columns=list(values), dtype=np.float64)
+		return {k: float(v) for k, v in values.items()}
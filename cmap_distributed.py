@@ -0,0 +1,248 @@
+""" cmap_distributed.py - shared-nothing core model runs across several machines
+
+The dask setup in `univariate-sensitivity-tests.ipynb` assumes every worker is
+on one machine, copying from one `EMAT-WORKING` directory and writing to one
+SQLite file.  Here each node keeps its own workspace on local disk: a cached
+copy of the base and alt1 land use source models, refreshed from the share
+only when it changes, and the scratch model copies for its runs.  A node is
+sent nothing but experiment parameters, and sends back the parsed measures
+and a zipped archive bundle; only the coordinating process touches the
+results database and the archive directory.
+
+Any executor with a `submit` method works: a `dask.distributed.Client`
+connected to workers on several machines, or, for testing on one box, a
+`concurrent.futures.ProcessPoolExecutor` whose processes stand in for nodes,
+each with its own workspace.
+"""
+import os
+import io
+import time
+import shutil
+import zipfile
+import platform
+import tempfile
+import traceback
+import concurrent.futures
+import pandas as pd
+
+from emat.util.loggers import get_module_logger
+
+from cmap_emat import CMAP_EMAT_Model, join_norm
+from cmap_land_use import land_use_sources
+from cmap_source_cache import SourceCache
+
+_logger = get_module_logger(__name__)
+
+
+def source_paths(model):
+	"""The source model directory, or overlay, of each land use scenario."""
+	return {
+		land_use: overlay or source
+		for land_use, (source, overlay) in land_use_sources(model.config, model.source_model_path).items()
+	}
+
+
+def resolve_workspace(workspace):
+	"""The workspace path on this node, with `{node}` and `{pid}` filled in."""
+	return os.path.abspath(workspace.format(node=platform.node(), pid=os.getpid()))
+
+
+def prepare_workspace(config, sources, workspace):
+	"""
+	Cache the source models in a node's workspace.
+
+	Each source model, or land use overlay, is kept in a `SourceCache` in
+	`<workspace>/source`, shared by the processes of the node, so after the
+	first experiment on a node only the files that change on the share are
+	copied again.
+
+	Args:
+		config (dict): The core model configuration.
+		sources (dict): Source model directory, or overlay, by land use,
+			from `source_paths`.
+		workspace (str): The node's workspace directory.
+
+	Returns:
+		dict: The core model configuration for this node, reading from
+		the cached source models and archiving into the workspace.
+	"""
+	cache = SourceCache(os.path.join(workspace, 'source'))
+	local = {}
+	for land_use, source in sources.items():
+		t = time.time()
+		local[land_use] = cache.refresh(source)
+		_logger.debug(f"{land_use} source model cached in {local[land_use]} ({time.time() - t:.0f}s)")
+	node_config = dict(config)
+	node_config['model_path'] = local['base']
+	node_config['model_path_land_use_base'] = '.'
+	if config.get('land_use_overlays'):
+		node_config['land_use_overlays'] = {
+			land_use: os.path.relpath(local[land_use], local['base'])
+			for land_use in config['land_use_overlays']
+		}
+	else:
+		node_config['model_path_land_use_alt1'] = os.path.relpath(local['alt1'], local['base'])
+	node_config['model_archive'] = os.path.join(workspace, 'archive')
+	node_config.pop('source_cache', None)
+	node_config.pop('report_values', None)
+	return node_config
+
+
+_node = {}
+
+
+def _node_model(config, sources, workspace, factory):
+	"""The model for this node, created on its first experiment; its cached source models are kept up to date."""
+	key = (workspace, repr(factory))
+	node_config = prepare_workspace(config, sources, workspace)
+	if key not in _node:
+		_node[key] = (factory or CMAP_EMAT_Model)(configuration=node_config, db=False)
+	return _node[key]
+
+
+def _bundle(directory):
+	"""Zip a directory into bytes."""
+	buffer = io.BytesIO()
+	with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as z:
+		for dirpath, _, filenames in os.walk(directory):
+			for filename in filenames:
+				path = os.path.join(dirpath, filename)
+				z.write(path, os.path.relpath(path, directory))
+	return buffer.getvalue()
+
+
+def run_on_node(experiment_id, params, config, sources, workspace, factory=None, archive=True):
+	"""
+	Run one experiment on this node, in its own workspace.
+
+	Args:
+		experiment_id (int): The experiment id.
+		params (dict): The experiment parameters.
+		config (dict): The coordinator's core model configuration.
+		sources (dict): The source model directory of each land use.
+		workspace (str): The node workspace, which may contain `{node}`
+			or `{pid}`.
+		factory (callable, optional): Called with `configuration` and
+			`db` keywords to create the model, by default
+			`CMAP_EMAT_Model`.
+		archive (bool, default True): Return an archive bundle.
+
+	Returns:
+		dict: The `experiment_id`, the `node` and `seconds` it ran,
+		the `measures`, every `report_values` parsed, the `archive`
+		bundle as zip bytes, and an `error` message if it failed.
+	"""
+	t = time.time()
+	result = dict(
+		experiment_id=experiment_id,
+		node=f"{platform.node()}:{os.getpid()}",
+		measures=None,
+		report_values=None,
+		archive=None,
+		error=None,
+	)
+	workspace = resolve_workspace(workspace)
+	model = None
+	try:
+		model = _node_model(config, sources, workspace, factory)
+		model.run_id = None
+		model.setup(dict(params, _experiment_id_=experiment_id))
+		model.run()
+		killed = model.config.get('killed_indicator')
+		if killed and os.path.exists(join_norm(model.resolved_model_path, killed)):
+			raise ValueError(f"killed_indicator present: {killed}")
+		m_names = model.scope.get_measure_names()
+		model.post_process(params, m_names)
+		if config.get('report_values'):
+			# Sent back for the coordinator's store.
+			result['report_values'] = {}
+		result['measures'] = model.load_measures(m_names, report_values=result['report_values'])
+		if archive:
+			outbox = os.path.join(workspace, 'outbox')
+			os.makedirs(outbox, exist_ok=True)
+			with tempfile.TemporaryDirectory(dir=outbox) as archive_path:
+				model.archive(params, archive_path, experiment_id)
+				result['archive'] = _bundle(archive_path)
+	except Exception:
+		result['error'] = traceback.format_exc()
+	finally:
+		if model is not None:
+			copy_path = getattr(model, 'model_copy_path', None)
+			if copy_path and not model.ephemeral:
+				shutil.rmtree(copy_path, ignore_errors=True)
+			elif getattr(model, 'temporary_directory', None) is not None:
+				model.temporary_directory.cleanup()
+			model._release_scratch()
+	result['seconds'] = time.time() - t
+	return result
+
+
+def _as_completed(executor, futures):
+	if hasattr(executor, 'gather'):
+		# a dask.distributed Client
+		from dask.distributed import as_completed
+		return as_completed(futures)
+	return concurrent.futures.as_completed(futures)
+
+
+def run_distributed(model, design, executor, workspace, *, factory=None, archive=True):
+	"""
+	Run experiments on several nodes that share nothing but the source model.
+
+	Args:
+		model (CMAP_EMAT_Model): The coordinating core model, with the
+			results database.
+		design (pandas.DataFrame): Experiment parameters, indexed by
+			experiment id.
+		executor: Where to run the experiments: a `dask.distributed`
+			Client or a `concurrent.futures` executor.
+		workspace (str): The workspace directory on each node.  It may
+			contain `{node}` or `{pid}`, to give processes on one machine
+			separate workspaces.
+		factory (callable, optional): Creates the model on each node,
+			see `run_on_node`.
+		archive (bool, default True): Store an archive of each run,
+			zipped, in the coordinator's archive directory.
+
+	Returns:
+		pandas.DataFrame: The `node`, `seconds` and `status` of each
+		experiment.
+	"""
+	config = dict(model.config)
+	sources = source_paths(model)
+	futures = [
+		executor.submit(
+			run_on_node, experiment_id, dict(row), config, sources, workspace,
+			factory=factory, archive=archive,
+		)
+		for experiment_id, row in design.iterrows()
+	]
+	db = model.db
+	m_names = model.scope.get_measure_names()
+	summary = []
+	for future in _as_completed(executor, futures):
+		result = future.result()
+		experiment_id = result['experiment_id']
+		run_id, _ = db.new_run_id(model.scope.name, experiment_id=experiment_id, source=0)
+		if result['error']:
+			status = "FAILED"
+			_logger.error(f"experiment {experiment_id} failed on {result['node']}:\n{result['error']}")
+		else:
+			status = "COMPLETE"
+			measures = {k: result['measures'].get(k) for k in m_names}
+			db.write_experiment_measures(
+				model.scope.name, 0, pd.DataFrame(measures, index=[experiment_id]), [run_id],
+			)
+			if model.report_values is not None and result['report_values']:
+				model.report_values.append(run_id, experiment_id, result['report_values'])
+			if result['archive'] is not None:
+				archive_path = model.get_experiment_archive_path(experiment_id, run_id=run_id)
+				os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+				with open(archive_path.rstrip("/\\") + ".zip", 'wb') as f:
+					f.write(result['archive'])
+		db.write_experiment_run_status(model.scope.name, run_id, experiment_id, status)
+		summary.append(dict(
+			experiment=experiment_id, node=result['node'], seconds=result['seconds'], status=status,
+		))
+	db.flush_measures()
+	return pd.DataFrame(summary).set_index('experiment').sort_index()
@@ -0,0 +1,208 @@
+""" cmap_dry_setup.py - check a whole design's model inputs without running it
+
+`setup` copies the full 15 GB source model before it writes the templated
+input files, so it is a slow way to find out that an experiment's inputs
+are bad.  A dry setup renders the templated files for every experiment in a
+design, in a process pool, straight from the templates, and checks them:
+parameters inside the scope, every template token replaced, fares the
+transit macros can use, and the source model files the templates were
+written against.  Nothing is copied; the rendered files can be written to a
+small staging tree, one folder per experiment, for inspection.
+"""
+import os
+import math
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from emat.util.loggers import get_module_logger
+
+from cmap_emat import CMAP_EMAT_Model, filehash, join_norm, to_simple_python, transit_fare_tokens
+from cmap_land_use import land_use_sources, source_file
+
+_logger = get_module_logger(__name__)
+
+TOKEN_PREFIX = "__EMAT_PROVIDES"
+
+
+def parameter_bounds(scope):
+	"""
+	The allowed values of each scope parameter.
+
+	Returns:
+		dict: For numeric parameters a (min, max) tuple, for categorical
+		ones a list of values.  Constants are not included, as `setup`
+		accepts other values for some of them.
+	"""
+	bounds = {}
+	for p in scope.get_parameters():
+		if p.ptype == 'constant':
+			continue
+		if p.dtype in ('real', 'int'):
+			bounds[p.name] = (p.min, p.max)
+		else:
+			bounds[p.name] = list(p.values)
+	return bounds
+
+
+def source_model_problems(model):
+	"""
+	Check the source model for each land use scenario.
+
+	Args:
+		model (CMAP_EMAT_Model): The core model.
+
+	Returns:
+		dict[str, list[str]]: Problems with the source model, by land use.
+	"""
+	result = {}
+	for land_use, (path, overlay) in land_use_sources(model.config, model.source_model_path).items():
+		problems = result[land_use] = []
+		if not os.path.isdir(path):
+			problems.append(f"source model not found at {path}")
+			continue
+		if overlay is not None and not os.path.isdir(overlay):
+			problems.append(f"land use overlay not found at {overlay}")
+			continue
+		for file_relpath, checkvalue in model.source_file_hashes.items():
+			filename = source_file(os.path.join(*file_relpath), path, overlay) or join_norm(path, *file_relpath)
+			try:
+				filehash(filename, checkvalue)
+			except (OSError, ValueError) as err:
+				problems.append(str(err).replace("\n", " "))
+	return result
+
+
+def check_experiment(params, bounds=None):
+	"""
+	Render and check the templated input files for one experiment.
+
+	Args:
+		params (dict): Experiment variables.
+		bounds (dict, optional): From `parameter_bounds`.
+
+	Returns:
+		problems (list[tuple[str, str]]): (check, message) pairs.
+		rendered (dict[tuple[str], str]): The rendered files.
+	"""
+	problems = []
+	for name, allowed in (bounds or {}).items():
+		value = params.get(name)
+		if value is None:
+			continue
+		if isinstance(allowed, tuple):
+			if not allowed[0] <= value <= allowed[1]:
+				problems.append(('bounds', f"{name}={value} outside [{allowed[0]}, {allowed[1]}]"))
+		elif value not in allowed:
+			problems.append(('bounds', f"{name}={value!r} not one of {allowed}"))
+
+	rendered = {}
+	for renderer in CMAP_EMAT_Model.input_renderers:
+		try:
+			rendered.update(getattr(CMAP_EMAT_Model, renderer)(params))
+		except (KeyError, ValueError, TypeError, ZeroDivisionError) as err:
+			problems.append(('render', f"{renderer[len('_render_'):]}: {err!r}"))
+
+	for relpath, text in rendered.items():
+		n = text.count(TOKEN_PREFIX)
+		if n:
+			problems.append(('tokens', f"{'/'.join(relpath)}: {n} token(s) not replaced"))
+
+	if 'transit_fares' in params:
+		fares = transit_fare_tokens(params)
+		for n in ('__base__fare__cta__', '__base__fare__pace__', '__base__fare__metra__'):
+			if fares[n] < 0:
+				problems.append(('fares', f"{n.strip('_')}={fares[n]} is negative"))
+		if fares['__base__fare__trans__'] > 0:
+			problems.append(('fares', f"base__fare__trans={fares['__base__fare__trans__']} is not a discount"))
+		elif -fares['__base__fare__trans__'] > fares['__base__fare__cta__']:
+			problems.append(('fares', "the CTA transfer discount exceeds the CTA fare"))
+	return problems, rendered
+
+
+def _stage(staging_dir, experiment_id, params, rendered):
+	root = os.path.join(staging_dir, str(experiment_id))
+	for relpath, text in rendered.items():
+		filename = join_norm(root, *relpath)
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		with open(filename, 'wt') as f:
+			f.write(text)
+	try:
+		import yaml as serializer
+	except ImportError:
+		import json as serializer
+	with open(join_norm(root, "_emat_parameters_.yml"), 'w') as fstream:
+		serializer.dump({k: to_simple_python(v) for k, v in params.items()}, fstream)
+
+
+def _check_chunk(experiments, bounds, staging_dir):
+	result = []
+	for experiment_id, params in experiments:
+		problems, rendered = check_experiment(params, bounds)
+		if staging_dir is not None:
+			_stage(staging_dir, experiment_id, params, rendered)
+		result.extend((experiment_id, check, message) for check, message in problems)
+	return result
+
+
+def dry_setup(model, design, staging_dir=None, *, n_workers=None, check_source=True):
+	"""
+	Check the model inputs for every experiment in a design.
+
+	Args:
+		model (CMAP_EMAT_Model): The core model.
+		design (pandas.DataFrame): Experiment parameters, one row per
+			experiment.  Parameters not in the design take the scope
+			default.
+		staging_dir (str, optional): If given, the rendered files for
+			each experiment are written to a folder named for it here,
+			laid out as they would be in the model copy.
+		n_workers (int, optional): Number of worker processes.  By
+			default one per CPU; 0 or 1 checks in this process.
+		check_source (bool, default True): Also check the source model
+			files for each land use scenario the design uses.
+
+	Returns:
+		pandas.DataFrame: One row per problem found, with columns
+		`experiment`, `check` and `message`.  Problems with the source
+		model have no experiment.  Empty if the design is good to run.
+	"""
+	defaults = {p.name: p.default for p in model.scope.get_parameters()}
+	experiments = []
+	for experiment_id, row in design.iterrows():
+		params = dict(defaults)
+		params.update({k: to_simple_python(v) for k, v in row.items() if k in defaults})
+		experiments.append((experiment_id, params))
+	bounds = parameter_bounds(model.scope)
+
+	if n_workers is None:
+		n_workers = os.cpu_count() or 1
+	problems = []
+	if n_workers <= 1 or len(experiments) < 2:
+		problems.extend(_check_chunk(experiments, bounds, staging_dir))
+	else:
+		chunk_size = max(1, math.ceil(len(experiments) / (4 * n_workers)))
+		with ProcessPoolExecutor(n_workers) as pool:
+			futures = [
+				pool.submit(_check_chunk, experiments[i:i + chunk_size], bounds, staging_dir)
+				for i in range(0, len(experiments), chunk_size)
+			]
+			for fut in futures:
+				problems.extend(fut.result())
+
+	if check_source:
+		# These are problems for every experiment using that land use,
+		# so they are reported once each, with no experiment id.
+		used = {params.get('land_use') for _, params in experiments}
+		for land_use, messages in source_model_problems(model).items():
+			if land_use in used:
+				problems.extend((None, 'source', f"{land_use}: {message}") for message in messages)
+
+	result = pd.DataFrame(problems, columns=['experiment', 'check', 'message'])
+	n_bad = result['experiment'].nunique()
+	if len(result):
+		_logger.warning(
+			f"dry setup found {len(result)} problems, in {n_bad} of {len(experiments)} experiments"
+		)
+	else:
+		_logger.info(f"dry setup found no problems in {len(experiments)} experiments")
+	return result
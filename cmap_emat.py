@@ -9,6 +9,7 @@ import numpy as np
 import re
 import subprocess
 import warnings
+import time
 from uuid import uuid4 as uuid
 
 from distutils.dir_util import copy_tree
@@ -22,6 +23,13 @@ from emat.model.core_files import FilesCoreModel
 from emat.model.core_files.parsers import TableParser, MappingParser, loc, key
 from emat.util.show_dir import show_dir, show_file_contents
 from emat.util.loggers import get_module_logger
+from cmap_database import CMAP_SQLiteDB
+from cmap_derived import DerivedMeasures
+import cmap_retry
+import cmap_scratch
+import cmap_land_use
+import cmap_source_cache
+import cmap_report_values
 
 _logger = get_module_logger(__name__)
 
@@ -136,9 +144,98 @@ def filehash(filename, checkvalue=None):
 	return digest
 
 
+# Files in the source model that the templates were written against.  If
+# any of these do not match, the source model is probably an older version.
+SOURCE_FILE_HASHES = {
+	('Database', 'macros', 'call', 'amhwIOM_H.mac'): 'b64bff7404ac507c83f8d1ac454a73da9b12a265',
+	('Database', 'macros', 'call', 'amhwIOM_L.mac'): 'dfaca3e50935f1a44dde3e0dafd3e96e376ed674',
+	('Database', 'macros', 'call', 'skim5I_7c.mac'): '85534ca29036437a3413449f7f9a85d0696a32bd',
+	('Database', 'macros', 'call', 'net5I_7c.mac'): '7bbbc3fddab22cab59b1e7c2e3462c05292804cb',
+	('Database', 'data', 'toll_system_flag.csv'): '883b8c945787262a92a9f3deddc961141d746e8e',
+}
+
+
+# Base year fares in cents, by token in the transit macros.  The CTA
+# transfer is a discount, so its value is negative.
+BASE_FARES = {
+	'__base__fare__cta__':    150,
+	'__base__fare__pace__':   150,
+	'__base__fare__metra__':  136,
+	'__base__fare__trans__': -120,
+}
+
+
+def transit_fare_tokens(params):
+	"""
+	The base fares written into the transit skimming and assignment macros.
+
+	Fares are in cents, scaled from the base year fares by `transit_fares`.
+	"""
+	return {
+		n: int(np.round(fare * params['transit_fares']))
+		for n, fare in BASE_FARES.items()
+	}
+
+
+# The token in the batch file that `setup` replaces with the run token.  It
+# is not an `__EMAT_PROVIDES` token, as it is not rendered from the params,
+# so it is left out of input fingerprints and dry setup checks.
+RUN_TOKEN = "__EMAT_RUN_TOKEN__"
+
+
+def run_token(run_id):
+	"""
+	A label for a run's Fortran executables, unique to its run_id.
+
+	Run ids are UUIDs, so unlike the random number from 0 to 99 the batch
+	file used to pick, no two runs share a token.
+	"""
+	return str(run_id).replace('-', '')
+
+
+# Inverse fuel economy (gallons per mile) in each speed bin of the auto
+# operating cost files, 0-75 MPH by 5 MPH increments.
+INVERSE_FUEL_ECONOMY = np.array([
+	0.0639, 0.0522, 0.0442, 0.0382, 0.0342, 0.0322, 0.0318, 0.0322,
+	0.0319, 0.0313, 0.0309, 0.0313, 0.0330, 0.0357, 0.0388, 0.0424,
+])
+
+
+def auto_operating_costs(fuel_cost, vmt_charge):
+	"""
+	The auto operating costs written into the mode and destination choice files.
+
+	Fuel economy improves as fuel cost rises, from 60% better than today
+	at $2.50 per gallon to 80% better at $6.00.  Costs are per mile, in
+	hundredths of a cent, rounded to whole numbers as the model reads them.
+
+	Args:
+		fuel_cost (float or array-like): Fuel cost, $ per gallon.
+		vmt_charge (float or array-like): Charge per mile, $.
+
+	Returns:
+		numpy.ndarray: The cost in each speed bin, along a last axis of 16.
+	"""
+	fuel_cost = np.asarray(fuel_cost, dtype=np.float64)[..., np.newaxis]
+	vmt_charge = np.asarray(vmt_charge, dtype=np.float64)[..., np.newaxis]
+	# This replaces the perfect negative correlation for fuel economy with fuel cost
+	fuel_cost_within_range = ((fuel_cost - 2.5) / (6.0-2.5))
+	fuel_economy_min = 0.6
+	fuel_economy_max = 0.8
+	fuel_economy = fuel_economy_min + (fuel_economy_max-fuel_economy_min)*(1.0-fuel_cost_within_range)
+	return np.round(10000 * (fuel_cost/((1/INVERSE_FUEL_ECONOMY) * (1 + fuel_economy)) + 0.0533 + vmt_charge))
+
+
 class CMAP_EMAT_Model(FilesCoreModel):
 
-	def __init__(self, db=None, unique_id=None, ephemeral=False, db_filename=None):
+	source_file_hashes = SOURCE_FILE_HASHES
+
+	# Reuse the results of a completed experiment with identical model
+	# inputs, instead of running the core model again.  This only
+	# applies when `allow_short_circuit` is also set.
+	reuse_identical_inputs = True
+
+	def __init__(self, db=None, unique_id=None, ephemeral=False, db_filename=None, configuration=None):
 
 		emat_version = [int(i.replace('a','')) for i in emat.__version__.split('.')]
 		if db_filename is None:
@@ -161,7 +258,7 @@ class CMAP_EMAT_Model(FilesCoreModel):
 			else:
 				initialize = True
 				_logger.info(f"CMAP EMAT database file {db_filename} does not exist, initializing...")
-			db = SQLiteDB(
+			db = CMAP_SQLiteDB(
 				db_filename,
 				initialize=initialize,
 			)
@@ -174,9 +271,12 @@ class CMAP_EMAT_Model(FilesCoreModel):
 			except KeyError:
 				pass
 
+		if configuration is None:
+			configuration = "cmap-trip-model-config.yml"
+
 		# Initialize the super class (FilesCoreModel)
 		super().__init__(
-			configuration="cmap-trip-model-config.yml",
+			configuration=configuration,
 			scope=scope,
 			db=db,
 			name='CMAP_Trip_Based_Model',
@@ -187,18 +287,25 @@ class CMAP_EMAT_Model(FilesCoreModel):
 
 		self.source_model_path = self.resolved_model_path
 
-		source_model_paths = {
-			'base': join_norm(self.source_model_path, self.config['model_path_land_use_base']),
-			'alt': join_norm(self.source_model_path, self.config['model_path_land_use_alt1']),
-		}
+		land_use_sources = cmap_land_use.land_use_sources(self.config, self.source_model_path)
 
-		for k,v in source_model_paths.items():
+		for k,(v, overlay) in land_use_sources.items():
 			if not os.path.exists(v):
 				warnings.warn(f"{k} core model is not available at {v}")
+			if overlay is not None and not os.path.isdir(overlay):
+				warnings.warn(f"{k} land use overlay is not available at {overlay}")
 
-		if self.scope != self.db.read_scope(self.scope.name):
+		if self.db is not None and self.scope != self.db.read_scope(self.scope.name):
 			self.db.update_scope(self.scope)
 
+		# Measures computed from the parsed measures, after parsing.
+		self.derived_measures = DerivedMeasures()
+
+		# Every value the mapping parsers read, kept beside the results.
+		self.report_values = cmap_report_values.ReportValueStore.from_config(
+			self.config.get('report_values'), getattr(self, '_sqlitedb_path', None),
+		)
+
 		# Add parsers to instruct the load_measures function
 		# how to parse the outputs and get the measure values.
 
@@ -206,9 +313,8 @@ class CMAP_EMAT_Model(FilesCoreModel):
 			MappingParser(
 				os.path.join('Database', 'report', "run_vmt_statistics.rpt"),
 				{
-					# 'Full_Region_VMT': sum(key['Chicago.Expressway VMT'             ]),
-					#
-					#
+					# Regional totals such as Regionwide_VMT are derived
+					# measures, declared in cmap_derived.py.
 					'Chicago_Expressway_VMT':              key['Chicago.Expressway VMT'             ],
 					'Chicago_Arterial_VMT':                key['Chicago.Arterial VMT'               ],
 					'Chicago_RampToll_VMT':                key['Chicago.Ramp/Toll VMT'              ],
@@ -860,6 +966,16 @@ class CMAP_EMAT_Model(FilesCoreModel):
 			)
 		)
 
+		self.add_parser(
+			MappingParser(
+				os.path.join('Database', "model_run_timestamp.txt"),
+				{
+					'Global_Loops_Used': key['Global Loops Used'],
+				},
+				reader_method=global_iterations_parse,
+			)
+		)
+
 		# self.add_parser(
 		# 	TableParser(
 		# 		os.path.join('Database', "transit_report_100_nonwork.txt"),
@@ -1008,6 +1124,155 @@ class CMAP_EMAT_Model(FilesCoreModel):
 
 		_logger.info("CMAP EMAT Model INIT complete.")
 
+	def __setstate__(self, state):
+		# FilesCoreModel re-opens the database in a worker as a plain
+		# SQLiteDB; re-open it as a CMAP_SQLiteDB instead, so the worker
+		# writes measures through its own single writer queue.
+		super().__setstate__(state)
+		db = getattr(self, 'db', None)
+		if type(db) is SQLiteDB:
+			self.db = CMAP_SQLiteDB(
+				db.database_path,
+				initialize='skip',
+				readonly=db.readonly,
+				check_same_thread=False,
+			)
+			db.conn.close()
+
+
+	def run_model(self, scenario, policy):
+		"""
+		Run one experiment, retrying it if it fails.
+
+		If the configuration sets `retry_policy`, a run that fails in a
+		way the policy retries (see `cmap_retry`) is run again after a
+		wait, in the workspace of the failed run if it is still intact.
+		The class of every failure is recorded in the database.
+		"""
+		if self.reuse_identical_inputs and self.allow_short_circuit:
+			if self._reuse_identical_run(scenario, policy):
+				return
+		retry = cmap_retry.RetryPolicy.from_config(self.config.get('retry_policy'))
+		attempt = 1
+		try:
+			while True:
+				self.last_failure = None
+				super().run_model(scenario, policy)
+				failure_class = self._last_failure_class()
+				if retry is None or failure_class is None or not retry.should_retry(failure_class, attempt):
+					break
+				delay = retry.delay(attempt)
+				_logger.warning(
+					f"{failure_class} failure on attempt {attempt} of {retry.max_attempts}, "
+					f"trying again in {delay:.0f} seconds"
+				)
+				time.sleep(delay)
+				attempt += 1
+				# a new run, in the same workspace if it is intact
+				self.run_id = None
+				self._retry_workspace = getattr(self, '_workspace_manifest', None)
+		finally:
+			self._workspace_manifest = self._retry_workspace = None
+			# The outputs kept have been archived by now.
+			self._release_scratch()
+
+	def _release_scratch(self):
+		"""Give back the scratch space of the last ephemeral copy, if any."""
+		scratch, self.scratch_workspace = getattr(self, 'scratch_workspace', None), None
+		if scratch is not None:
+			scratch.release()
+
+	def _last_failure_class(self):
+		"""
+		The class of failure of the last run, or None if it did not fail.
+
+		Failures found after `run` returned, which emat describes only in
+		`comment_on_run`, are recorded in the database here.
+		"""
+		failure = getattr(self, 'last_failure', None)
+		if failure is not None:
+			return failure.failure_class
+		failure_class = cmap_retry.comment_failure_class(self.comment_on_run)
+		db = getattr(self, 'db', None)
+		if failure_class is not None and db is not None and not db.readonly:
+			db.write_run_failure(self.run_id, self._setup_experiment_id(), failure_class, self.comment_on_run)
+		return failure_class
+
+	def _reuse_identical_run(self, scenario, policy):
+		"""
+		Copy results from an experiment with identical model inputs.
+
+		Returns:
+			bool: Whether results were reused, so no run is needed.
+		"""
+		db = getattr(self, 'db', None)
+		if not isinstance(db, CMAP_SQLiteDB) or db.readonly:
+			return False
+		params = {}
+		params.update(scenario)
+		params.update(policy)
+		experiment_id = params.pop('_experiment_id_', None)
+		try:
+			if not experiment_id:
+				with warnings.catch_warnings():
+					warnings.simplefilter("ignore")
+					experiment_id = db.read_experiment_id(self.scope.name, params)
+			fingerprint = self.input_fingerprint(params)
+		except (KeyError, ValueError):
+			# let setup report the problem
+			return False
+		if not experiment_id:
+			return False
+		db.write_input_fingerprints({experiment_id: fingerprint})
+		if not db.read_experiment_measures(self.scope, experiment_id=experiment_id, source=0).empty:
+			# emat short-circuits this experiment on its own results
+			return False
+		m_names = self.scope.get_measure_names()
+		for twin in db.find_input_twins(fingerprint, exclude=experiment_id):
+			stored = db.read_experiment_measures(self.scope, experiment_id=twin, source=0)
+			if stored.empty:
+				continue
+			stored = stored.iloc[0]
+			measures = {k: stored.get(k, np.nan) for k in m_names}
+			run_id, _ = db.new_run_id(self.scope.name, experiment_id=experiment_id, source=0)
+			db.write_experiment_measures(
+				self.scope.name, 0, pd.DataFrame(measures, index=[experiment_id]), [run_id],
+			)
+			db.write_input_fingerprints({experiment_id: fingerprint}, reused_from=twin)
+			db.log(f"REUSE experiment_id {experiment_id} results from identical inputs of {twin}")
+			_logger.info(f"experiment {experiment_id} has the same inputs as {twin}, reusing its results")
+			self.outcomes_output = measures
+			return True
+		return False
+
+	def fingerprint_experiments(self, design_name=None):
+		"""
+		Compute and store the input fingerprints of stored experiments.
+
+		Fingerprints are stored for each experiment as it is run, so
+		this is only needed for experiments run before fingerprinting,
+		or to find which experiments in a design are duplicates.
+
+		Args:
+			design_name (str, optional): Only this design.
+
+		Returns:
+			pandas.Series: Fingerprints by experiment id.  Experiments
+			whose inputs cannot be rendered are left out.
+		"""
+		design = self.db.read_experiment_parameters(self.scope.name, design_name)
+		defaults = {p.name: p.default for p in self.scope.get_parameters()}
+		fingerprints = {}
+		for experiment_id, row in design.iterrows():
+			params = dict(defaults)
+			params.update(row)
+			try:
+				fingerprints[experiment_id] = self.input_fingerprint(params)
+			except (KeyError, ValueError) as err:
+				_logger.warning(f"no fingerprint for experiment {experiment_id}: {err}")
+		if not self.db.readonly:
+			self.db.write_input_fingerprints(fingerprints)
+		return pd.Series(fingerprints, name='fingerprint', dtype=object)
 
 	def setup(self, params: dict):
 		"""
@@ -1053,53 +1318,71 @@ class CMAP_EMAT_Model(FilesCoreModel):
 
 		super().setup(params)
 
-		if self.ephemeral:
-			_logger.debug("using an ephemeral copy of model files")
-			# Copy the model to a temp directory
-			self.temporary_directory = tempfile.TemporaryDirectory()
-			self.model_copy_path = self.temporary_directory.name
-		else:
-			_logger.debug("using a stable copy of model files")
-			# Copy the model to a working directory next to the original
-			copy_name = f"{os.path.basename(self.source_model_path.replace('_Clean',''))}-{self.run_id}"
-			self.model_copy_path = os.path.normpath(
-				os.path.join(self.source_model_path, '..', copy_name)
-			)
-		if params['land_use'] == 'base':
-			source_model_path_1 = join_norm(self.source_model_path, self.config['model_path_land_use_base'])
-		else:
-			source_model_path_1 = join_norm(self.source_model_path, self.config['model_path_land_use_alt1'])
-
-		# Check file hashes in source
-		filehash(
-			join_norm(source_model_path_1, 'Database', 'macros', 'call', 'amhwIOM_H.mac'),
-			'b64bff7404ac507c83f8d1ac454a73da9b12a265'
-		)
-		filehash(
-			join_norm(source_model_path_1, 'Database', 'macros', 'call', 'amhwIOM_L.mac'),
-			'dfaca3e50935f1a44dde3e0dafd3e96e376ed674'
-		)
-		filehash(
-			join_norm(source_model_path_1, 'Database', 'macros', 'call', 'skim5I_7c.mac'),
-			'85534ca29036437a3413449f7f9a85d0696a32bd'
-		)
-		filehash(
-			join_norm(source_model_path_1, 'Database', 'macros', 'call', 'net5I_7c.mac'),
-			'7bbbc3fddab22cab59b1e7c2e3462c05292804cb'
-		)
-		filehash(
-			join_norm(source_model_path_1, 'Database', 'data', 'toll_system_flag.csv'),
-			'883b8c945787262a92a9f3deddc961141d746e8e'
+		source_model_path_1, overlay = cmap_land_use.land_use_source(
+			self.config, self.source_model_path, params['land_use'],
 		)
+		other_overlays = [o for _, o in cmap_land_use.land_use_sources(self.config, self.source_model_path).values()]
+		cache = cmap_source_cache.SourceCache.from_config(self.config.get('source_cache'))
+		if cache is not None:
+			# Copy from a local cache of the source model, brought up to
+			# date with the share first.
+			source_model_path_1 = cache.refresh(source_model_path_1)
+			other_overlays = [o if o is None or not os.path.isdir(o) else cache.refresh(o) for o in other_overlays]
+			overlay = None if overlay is None else cache.refresh(overlay)
+		# Where each model file comes from, overlay first.
+		sources = [source_model_path_1] if overlay is None else [overlay, source_model_path_1]
+
+		# Cached source models are held unchanged until the copy is made.
+		with cmap_source_cache.reading(*sources, *other_overlays):
+			# A retry runs in the workspace of the failed run, if it is intact.
+			retry_workspace, self._retry_workspace = getattr(self, '_retry_workspace', None), None
+			if retry_workspace is not None and retry_workspace[1] == sources \
+					and cmap_retry.restore_workspace(*retry_workspace):
+				self.model_copy_path = retry_workspace[0]
+				_logger.info(f"reusing the workspace of the failed run: {self.model_copy_path}")
+			else:
+				if self.ephemeral:
+					_logger.debug("using an ephemeral copy of model files")
+					# Copy the model to a temp directory
+					self._release_scratch()
+					self.temporary_directory = tempfile.TemporaryDirectory()
+					self.model_copy_path = self.temporary_directory.name
+					scratch = cmap_scratch.ScratchTier.from_config(self.config.get('scratch'))
+					if scratch is not None:
+						# The hot paths go on fast storage, linked into the copy;
+						# copy_tree leaves them alone, and the overlay is applied
+						# through the links.
+						self.scratch_workspace = scratch.stage(source_model_path_1, self.model_copy_path)
+				else:
+					_logger.debug("using a stable copy of model files")
+					# Copy the model to a working directory next to the original
+					copy_name = f"{os.path.basename(self.source_model_path.replace('_Clean',''))}-{self.run_id}"
+					# ...or next to the source cache, to stay off the share.
+					beside = self.source_model_path if cache is None else cache.directory
+					self.model_copy_path = os.path.normpath(
+						os.path.join(beside, '..', copy_name)
+					)
 
-		_logger.info(f"copying from: {source_model_path_1}")
-		_logger.info(f"copying to: {self.model_copy_path}")
-		copy_tree(
-			source_model_path_1,
-			self.model_copy_path,
-			update=True,
-		)
-		_logger.info(f"copying complete")
+				workspace_record = getattr(self, 'workspace_record', None)
+				if workspace_record:
+					# Noted for a queue worker, to remove it if the run is stopped.
+					with open(workspace_record, 'at') as f:
+						f.write(self.model_copy_path + '\n')
+
+				# Check file hashes in source
+				for relpath, checkvalue in self.source_file_hashes.items():
+					filename = cmap_land_use.source_file(os.path.join(*relpath), source_model_path_1, overlay)
+					filehash(filename or join_norm(source_model_path_1, *relpath), checkvalue)
+
+				_logger.info(f"copying from: {source_model_path_1}")
+				_logger.info(f"copying to: {self.model_copy_path}")
+				cmap_land_use.build_workspace(
+					self.model_copy_path,
+					source_model_path_1,
+					overlay,
+					other_overlays,
+				)
+				_logger.info(f"copying complete")
 
 		# Write params and experiment_id to folder, if possible
 		try:
@@ -1131,9 +1414,97 @@ class CMAP_EMAT_Model(FilesCoreModel):
 		self._manipulate_transit_assignment(params)  #uses transit_fares
 		self._manipulate_batch_file(params)
 
+		if self.config.get('retry_policy'):
+			# Note the prepared workspace, so a retry can restore it.
+			self._workspace_manifest = (
+				self.model_copy_path,
+				sources,
+				cmap_retry.workspace_manifest(self.model_copy_path),
+			)
+
 		_logger.info("CMAP EMAT RUN SETUP complete")
 
+	# The templated input files, as the names of the methods that render
+	# them, in the order `setup` writes them.
+	input_renderers = (
+		'_render_EMME_init',
+		'_render_cost_input_files',
+		'_render_transit_skimming',
+		'_render_transit_assignment',
+		'_render_batch_file',
+	)
+
+	@classmethod
+	def render_inputs(cls, params):
+		"""
+		Render every templated input file for an experiment.
+
+		This is the text `setup` writes into the model copy, computed
+		without copying or touching the model itself.
+
+		Args:
+			params (dict): Experiment variables.
+
+		Returns:
+			dict[tuple[str], str]: The text of each file, keyed by its
+			path relative to the model directory.
+
+		Raises:
+			ValueError: If a parameter is missing or not usable.
+		"""
+		result = {}
+		for renderer in cls.input_renderers:
+			result.update(getattr(cls, renderer)(params))
+		return result
+
+	def input_fingerprint(self, params):
+		"""
+		A hash of the model inputs for an experiment.
+
+		The hash covers every templated input file, as rendered, and
+		the land use scenario the model is copied from (its overlay, if
+		it has one).  Experiments
+		with the same fingerprint are the same core model run, even
+		if their parameters differ, for example when nearby fuel costs
+		round to the same operating costs.
+
+		Args:
+			params (dict): Experiment variables.
+
+		Returns:
+			str
+		"""
+		overlays = self.config.get('land_use_overlays')
+		if params['land_use'] == 'base':
+			source = self.config['model_path_land_use_base']
+		elif overlays:
+			source = overlays[params['land_use']]
+		else:
+			source = self.config['model_path_land_use_alt1']
+		sha1 = hashlib.sha1()
+		sha1.update(f"land_use:{os.path.normpath(source)}\0".encode())
+		for relpath, text in sorted(self.render_inputs(params).items()):
+			sha1.update(f"{'/'.join(relpath)}\0{text}\0".encode())
+		return sha1.hexdigest()
+
+	def _write_inputs(self, rendered):
+		for relpath, y in rendered.items():
+			# Write the manipulated text back out to model run folder.  We don't write
+			# to the template file, but to the expected normal filename for our script.
+			macro_filename = join_norm(self.resolved_model_path, *relpath)
+			_logger.debug(f"writing updates to: {macro_filename}")
+			with open(macro_filename, 'wt') as f:
+				f.write(y)
+
 	def _manipulate_batch_file(self, params):
+		token = run_token(self.run_id)
+		self._write_inputs({
+			relpath: text.replace(RUN_TOKEN, token)
+			for relpath, text in self._render_batch_file(params).items()
+		})
+
+	@staticmethod
+	def _render_batch_file(params):
 
 		# Now, we load the text of the EMME initialization macro template into a string in memory
 		with open(template('EMAT_Submit_Full_Regional_Model.template'), 'rt') as f:
@@ -1146,18 +1517,13 @@ class CMAP_EMAT_Model(FilesCoreModel):
 			f"__EMAT_PROVIDES_GLOBAL_LOOPS__",  # the token to replace
 			str(params['global_loops'])  # the value to replace it with (as a string)
 		)
-
-		# Write the manipulated text back out to model run folder.  We don't write
-		# to the template file, but to the expected normal filename for our script.
-		macro_filename = join_norm(
-			self.resolved_model_path,
-			'Database', 'EMAT_Submit_Full_Regional_Model.bat'
-		)
-		_logger.debug(f"writing updates to: {macro_filename}")
-		with open(macro_filename, 'wt') as f:
-			f.write(y)
+		return {('Database', 'EMAT_Submit_Full_Regional_Model.bat'): y}
 
 	def _manipulate_EMME_init (self, params):
+		self._write_inputs(self._render_EMME_init(params))
+
+	@staticmethod
+	def _render_EMME_init(params):
 
 		# the `params` dictionary here will have keys corresponding to cmap-trip-scope, so:
 		#     - highway_cap
@@ -1211,25 +1577,18 @@ class CMAP_EMAT_Model(FilesCoreModel):
 				# save us the trouble of having the error crop up later, because it will.
 				raise ValueError(f'missing required parameter "{n}"')
 
-		# Write the manipulated text back out to model run folder.  We don't write
-		# to the template file, but to the expected normal filename for our script.
-		macro_filename = join_norm(
-			self.resolved_model_path,
-			'Database','prep_macros','initialize_EMAT_variables.mac'
-		)
-		_logger.debug(f"writing updates to: {macro_filename}")
-		with open(macro_filename, 'wt') as f:
-			f.write(y)
+		return {('Database', 'prep_macros', 'initialize_EMAT_variables.mac'): y}
 
 	def peak_tolled_auto_operating_cost(self, params):
-		fuel_cost_within_range = ((params['fuel_cost'] - 2.5) / (6.0-2.5))
-		fuel_economy_min = 0.6
-		fuel_economy_max = 0.8
-		fuel_economy = fuel_economy_min + (fuel_economy_max-fuel_economy_min)*(1.0-fuel_cost_within_range)
-		peak = int(np.round(10000 * (params['fuel_cost']/((1/0.0309) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
+		# the 50-55 MPH speed bin
+		peak = int(auto_operating_costs(params['fuel_cost'], params['vmt_charge'])[10])
 		return peak
 
 	def _manipulate_cost_input_files (self, params):
+		self._write_inputs(self._render_cost_input_files(params))
+
+	@staticmethod
+	def _render_cost_input_files(params):
 		# There are 8 values in this file that need to be edited.
 		tokens_in_file = [
 			'__auto__opt__cost__p1__',
@@ -1252,29 +1611,10 @@ class CMAP_EMAT_Model(FilesCoreModel):
 		# They need to be revised into:
 		computed_params = params.copy()
 
-		# This replaces the perfect negative correlation for fuel economy with fuel cost
-		fuel_cost_within_range = ((params['fuel_cost'] - 2.5) / (6.0-2.5))
-		fuel_economy_min = 0.6
-		fuel_economy_max = 0.8
-		fuel_economy = fuel_economy_min + (fuel_economy_max-fuel_economy_min)*(1.0-fuel_cost_within_range)
-
 		# Opcost_s = [[Fuel Cost]* 1 / ( [1 / inv_fuel_econ_s] * [1 + Fuel Economy Increase] ) ] + [Fixed Tires & Maint] + [VMT Charge]
-		computed_params['__auto__opt__cost__p1__']  = int(np.round(10000 * (params['fuel_cost']/((1/0.0639) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
-		computed_params['__auto__opt__cost__p2__']  = int(np.round(10000 * (params['fuel_cost']/((1/0.0522) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
-		computed_params['__auto__opt__cost__p3__']  = int(np.round(10000 * (params['fuel_cost']/((1/0.0442) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
-		computed_params['__auto__opt__cost__p4__']  = int(np.round(10000 * (params['fuel_cost']/((1/0.0382) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
-		computed_params['__auto__opt__cost__p5__']  = int(np.round(10000 * (params['fuel_cost']/((1/0.0342) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
-		computed_params['__auto__opt__cost__p6__']  = int(np.round(10000 * (params['fuel_cost']/((1/0.0322) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
-		computed_params['__auto__opt__cost__p7__']  = int(np.round(10000 * (params['fuel_cost']/((1/0.0318) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
-		computed_params['__auto__opt__cost__p8__']  = int(np.round(10000 * (params['fuel_cost']/((1/0.0322) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
-		computed_params['__auto__opt__cost__p9__']  = int(np.round(10000 * (params['fuel_cost']/((1/0.0319) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
-		computed_params['__auto__opt__cost__p10__'] = int(np.round(10000 * (params['fuel_cost']/((1/0.0313) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
-		computed_params['__auto__opt__cost__p11__'] = int(np.round(10000 * (params['fuel_cost']/((1/0.0309) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
-		computed_params['__auto__opt__cost__p12__'] = int(np.round(10000 * (params['fuel_cost']/((1/0.0313) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
-		computed_params['__auto__opt__cost__p13__'] = int(np.round(10000 * (params['fuel_cost']/((1/0.0330) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
-		computed_params['__auto__opt__cost__p14__'] = int(np.round(10000 * (params['fuel_cost']/((1/0.0357) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
-		computed_params['__auto__opt__cost__p15__'] = int(np.round(10000 * (params['fuel_cost']/((1/0.0388) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
-		computed_params['__auto__opt__cost__p16__'] = int(np.round(10000 * (params['fuel_cost']/((1/0.0424) * (1 + fuel_economy)) + 0.0533 + params['vmt_charge'])))
+		opcosts = auto_operating_costs(params['fuel_cost'], params['vmt_charge'])
+		for n, opcost in zip(tokens_in_file, opcosts):
+			computed_params[n] = int(opcost)
 
 		base_templates = [
 			'MCHO_M023',
@@ -1285,6 +1625,7 @@ class CMAP_EMAT_Model(FilesCoreModel):
 			'PDNH_M023',
 		]
 
+		result = {}
 		for base_template in base_templates:
 			# Now, we load the text of the template into a string in memory
 			with open(template(f'{base_template}.template'), 'rt') as f:
@@ -1298,17 +1639,15 @@ class CMAP_EMAT_Model(FilesCoreModel):
 					)
 				else:
 					raise ValueError(f'missing required parameter "{n}"')
-			# Write the manipulated text back out to model run folder.
-			macro_filename = join_norm(
-				self.resolved_model_path,
-				'Database', f'{base_template}.txt'
-			)
-			_logger.debug(f"writing updates to: {macro_filename}")
-			with open(macro_filename, 'wt') as f:
-				f.write(y)
+			result[('Database', f'{base_template}.txt')] = y
+		return result
 
 
 	def  _manipulate_transit_skimming (self, params):
+		self._write_inputs(self._render_transit_skimming(params))
+
+	@staticmethod
+	def _render_transit_skimming(params):
 		# There are 4 values in this file that need to be edited.
 		tokens_in_file = [
 			'__base__fare__cta__', # line 119 -122
@@ -1318,10 +1657,7 @@ class CMAP_EMAT_Model(FilesCoreModel):
 		]
 		# They need to be revised into:
 		computed_params = params.copy()
-		computed_params['__base__fare__cta__']   = int(np.round( 150 * params['transit_fares']))
-		computed_params['__base__fare__pace__']  = int(np.round( 150 * params['transit_fares']))
-		computed_params['__base__fare__metra__'] = int(np.round( 136 * params['transit_fares']))
-		computed_params['__base__fare__trans__'] = int(np.round(-120 * params['transit_fares']))
+		computed_params.update(transit_fare_tokens(params))
 
 		with open(template('skim.transit.all.template'), 'rt') as f:
 			y = f.read()
@@ -1335,15 +1671,13 @@ class CMAP_EMAT_Model(FilesCoreModel):
 			else:
 				raise ValueError(f'missing required parameter "{n}"')
 
-		macro_filename = join_norm(
-			self.resolved_model_path,
-			'Database','macros','call','skim.transit.all'
-		)
-		_logger.debug(f"writing updates to: {macro_filename}")
-		with open(macro_filename, 'wt') as f:
-			f.write(y)
+		return {('Database', 'macros', 'call', 'skim.transit.all'): y}
 
 	def  _manipulate_transit_assignment (self, params):
+		self._write_inputs(self._render_transit_assignment(params))
+
+	@staticmethod
+	def _render_transit_assignment(params):
 		# There are 4 values in this file that need to be edited.
 		tokens_in_file = [
 			'__base__fare__cta__', # line 113 -116
@@ -1353,10 +1687,7 @@ class CMAP_EMAT_Model(FilesCoreModel):
 		]
 		# It need to be revised into
 		computed_params = params.copy()
-		computed_params['__base__fare__cta__']   = int(np.round( 150 * params['transit_fares']))
-		computed_params['__base__fare__pace__']  = int(np.round( 150 * params['transit_fares']))
-		computed_params['__base__fare__metra__'] = int(np.round( 136 * params['transit_fares']))
-		computed_params['__base__fare__trans__'] = int(np.round(-120 * params['transit_fares']))
+		computed_params.update(transit_fare_tokens(params))
 
 		with open(template('assign_transit.v2.template'), 'rt') as f:
 			y = f.read()
@@ -1370,13 +1701,7 @@ class CMAP_EMAT_Model(FilesCoreModel):
 			else:
 				raise ValueError(f'missing required parameter "{n}"')
 
-		macro_filename = join_norm(
-			self.resolved_model_path,
-			'Database','transit_asmt_macros','assign_transit.v2.mac'
-		)
-		_logger.debug(f"writing updates to: {macro_filename}")
-		with open(macro_filename, 'wt') as f:
-			f.write(y)
+		return {('Database', 'transit_asmt_macros', 'assign_transit.v2.mac'): y}
 
 
 	def run(self):
@@ -1399,9 +1724,15 @@ class CMAP_EMAT_Model(FilesCoreModel):
 		the model directory should be in a state that is ready to run the
 		`post_process` command next.
 
+		If the configuration sets `stage_runner`, the model stages are
+		run from Python by `run_stages` instead of by the batch file.
+
 		Raises:
 			UserWarning: If model is not properly setup
 		"""
+		if self.config.get('stage_runner'):
+			return self.run_stages()
+
 		_logger.info("CMAP EMAT Model RUN ...")
 
 		cmd = 'EMAT_Submit_Full_Regional_Model.bat'
@@ -1409,84 +1740,185 @@ class CMAP_EMAT_Model(FilesCoreModel):
 		_logger.debug(f"cmd = {cmd}")
 		_logger.debug(f"exists = {os.path.exists(join_norm(self.resolved_model_path, 'Database', cmd))}")
 
-		import subprocess
+		import cmap_logwatch
+		from cmap_process import kill_process_tree
 
-		babysitter = None
-		try:
-			# The subprocess.run command runs a command line tool. The
-			# name of the command line tool, plus all the command line arguments
-			# for the tool, are given as a list of strings, not one string.
+		database_dir = join_norm(self.resolved_model_path, "Database")
+		# The batch output goes to a file, not a pipe, so it can be watched
+		# for failures while the model runs, along with the other logs.
+		output_path = join_norm(database_dir, "batch_output.log")
+		watcher = cmap_logwatch.LogWatcher(database_dir, self.config.get('failure_signatures'))
+		failure = None
+		with open(output_path, 'wb') as output:
 			# The `cwd` argument sets the current working directory from which the
-			# command line tool is launched.  Setting `capture_output` to True
-			# will capture both stdout and stderr from the command line tool, and
-			# make these available in the result to facilitate debugging.
+			# command line tool is launched.
 			with subprocess.Popen(
 					cmd,
-					cwd=join_norm(self.resolved_model_path, "Database"),
+					cwd=database_dir,
 					shell=True,
-					stdout=subprocess.PIPE,
-					stderr=subprocess.PIPE,
+					stdout=output,
+					stderr=subprocess.STDOUT,
 			) as process:
-
-				kp = join_norm(self.resolved_model_path, "Database", "killed.txt")
-				dp = join_norm(self.resolved_model_path, "Database")
-				pid = process.pid
-				babysitter_src = f"""
-				while (Test-Path "{dp}") {{
-					if (gci "{dp}" -recurse -Include errors | ? {{ $_.length -gt 50mb }}) {{
-						TASKKILL /F /PID {pid} /T;
-						gci "{dp}" -recurse -Include errors > "{kp}";
-					}}
-					sleep 15;
-				}}
-				"""
-				babysitter_path = join_norm(self.resolved_model_path, "Database", 'babysitter.ps1')
-				with open(babysitter_path, 'wt') as bs:
-					bs.write(babysitter_src)
-				babysitter = subprocess.Popen(
-					['Powershell.exe', '-executionpolicy', 'remotesigned', '-File', babysitter_path]
-				)
-
 				try:
-					stdout, stderr = process.communicate()
-				except:  # Including KeyboardInterrupt, communicate handled that.
+					while True:
+						try:
+							process.wait(timeout=15)
+							break
+						except subprocess.TimeoutExpired:
+							failure = watcher.check()
+							if failure is not None:
+								# Stop the batch file and everything it started.
+								kill_process_tree(process.pid)
+								process.wait()
+								break
+				except:  # Including KeyboardInterrupt
+					kill_process_tree(process.pid)
 					process.kill()
-					# We don't call process.wait() as .__exit__ does that for us.
 					raise
 				retcode = process.poll()
-			self.last_run_result = subprocess.CompletedProcess(process.args, retcode, stdout, stderr)
-
-			# To kill a subprocess and all children of that subprocess...
-			#   from subprocess import Popen
-			#   process = Popen(command, shell=True)
-			#   Popen("TASKKILL /F /PID {pid} /T".format(pid=process.pid))
-
-			if self.last_run_result.returncode:
-				with open("_stdout.log", "a") as f:
-					f.write("=======================\n")
-					stdout = self.last_run_result.stdout
-					if isinstance(stdout, bytes):
-						stdout = stdout.decode()
-					f.write(stdout)
-				with open("_stderr.log", "a") as f:
-					f.write("=======================\n")
-					stderr = self.last_run_result.stderr
-					if isinstance(stderr, bytes):
-						stderr = stderr.decode()
-					f.write(stderr)
-				raise subprocess.CalledProcessError(
-					self.last_run_result.returncode,
-					self.last_run_result.args,
-					self.last_run_result.stdout,
-					self.last_run_result.stderr,
-				)
-
-		finally:
-			if babysitter is not None:
-				babysitter.terminate()
+		with open(output_path, 'rb') as f:
+			stdout = f.read()
+		self.last_run_result = subprocess.CompletedProcess(process.args, retcode, stdout, b'')
+
+		if failure is None:
+			failure = watcher.check(final=True)
+		if failure is None and retcode:
+			failure = cmap_logwatch.RunFailure(
+				'exit_code', f"batch file exited with code {retcode}", cmd=process.args, returncode=retcode,
+			)
+		if failure is not None:
+			with open("_stdout.log", "a") as f:
+				f.write("=======================\n")
+				f.write(stdout.decode(errors='replace'))
+			failure.output = stdout
+			self._record_failure(failure)
+			raise failure
 
 		_logger.info("CMAP EMAT Model RUN complete")
 
+	def run_stages(self, programs=None):
+		"""
+		Run the core model stage by stage, without the batch file.
+
+		The stages are those of `EMAT_Submit_Full_Regional_Model.bat`, run
+		by `cmap_stages.run_stages`, which waits on the parallel Fortran
+		executables by their process handles instead of polling the
+		process table, times out stuck stages, and stops at the first
+		nonzero exit code.  As with the batch file, the logs are watched
+		for known failures while the model runs.
+
+		Configuration keys used:
+			stage_programs: The program to run for `emme`, `python`,
+				`PreDist`, `ModeChoice` or `VehOcc`, if not the defaults.
+			stage_timeouts: Seconds allowed for stages, by stage name.
+			cpu_slots: The number of model programs that may run at
+				once on this machine, across all model runs; by default
+				there is no limit.  See `cmap_budget.CPUBudget`.
+			cpu_slot_directory: Where the slots are kept, if not the
+				default for the machine.
+			cpu_pinning: Pin each program to the core of its slot.
+			adaptive_global_loops: End the global feedback loop once the
+				congested time skims settle, before `global_loops` if
+				they do.  True, or a mapping of `threshold`, `matrices`
+				and `min_loops` for `cmap_convergence.SkimConvergence`.
+
+		Args:
+			programs (dict, optional): Programs to run, overriding
+				`stage_programs`.
+
+		Raises:
+			cmap_logwatch.RunFailure: If the run fails; the class of
+				failure is recorded in the database.
+		"""
+		import cmap_stages
+		import cmap_logwatch
+		_logger.info("CMAP EMAT Model RUN (stages) ...")
+		database_dir = join_norm(self.resolved_model_path, "Database")
+		try:
+			from yaml import safe_load as load
+		except ImportError:
+			from json import load
+		with open(join_norm(self.resolved_model_path, "_emat_parameters_.yml"), 'r') as fstream:
+			params = load(fstream)
+		run_programs = dict(self.config.get('stage_programs') or {})
+		run_programs.update(programs or {})
+		watcher = cmap_logwatch.LogWatcher(database_dir, self.config.get('failure_signatures'))
+
+		budget = None
+		if self.config.get('cpu_slots'):
+			import cmap_budget
+			budget = cmap_budget.CPUBudget(
+				self.config['cpu_slots'],
+				directory=self.config.get('cpu_slot_directory'),
+				pin=self.config.get('cpu_pinning', False),
+			)
+
+		converged = None
+		adaptive = self.config.get('adaptive_global_loops')
+		if adaptive:
+			import cmap_convergence
+			converged = cmap_convergence.SkimConvergence(
+				database_dir, **(adaptive if isinstance(adaptive, dict) else {}),
+			)
+
+		RunFailure = cmap_logwatch.RunFailure
+		try:
+			cmap_stages.run_stages(
+				database_dir,
+				int(params['global_loops']),
+				programs=run_programs,
+				timeouts=self.config.get('stage_timeouts'),
+				watch=watcher,
+				budget=budget,
+				converged=converged,
+			)
+			failure = watcher.check(final=True)
+		except RunFailure as err:
+			failure = err
+		except subprocess.TimeoutExpired as err:
+			failure = RunFailure('timeout', str(err), cmd=err.cmd)
+		except subprocess.CalledProcessError as err:
+			failure = RunFailure('exit_code', str(err), cmd=err.cmd, returncode=err.returncode)
+		except FileNotFoundError as err:
+			failure = RunFailure('missing_inputs', str(err))
+		if failure is not None:
+			self._record_failure(failure)
+			raise failure
+		_logger.info("CMAP EMAT Model RUN (stages) complete")
+
+	def _record_failure(self, failure):
+		"""
+		Record how a run failed, in the killed indicator and the database.
+
+		Args:
+			failure (cmap_logwatch.RunFailure): The failure.
+		"""
+		_logger.error(f"CMAP EMAT Model RUN failed, {failure}")
+		self.last_failure = failure
+		killed = self.config.get('killed_indicator')
+		if killed:
+			with open(join_norm(self.resolved_model_path, killed), 'wt') as f:
+				f.write(f"{failure}\n")
+		db = getattr(self, 'db', None)
+		if db is None or db.readonly:
+			return
+		db.write_run_failure(
+			self.run_id, self._setup_experiment_id(), failure.failure_class, failure.message, failure.source,
+		)
+
+	def _setup_experiment_id(self):
+		"""The experiment_id `setup` wrote into the model copy, or None."""
+		try:
+			# The run_id in this file is a python-tagged UUID, which a safe
+			# yaml loader will not read, so only the experiment_id is parsed.
+			with open(join_norm(self.resolved_model_path, "_emat_experiment_id_.yml"), 'r') as fstream:
+				for line in fstream:
+					if line.startswith('experiment_id:'):
+						return int(line.split(':', 1)[1])
+		except (OSError, ValueError):
+			pass
+		return None
+
 	def last_run_logs(self, output=None):
 		"""
 		Display the logs from the last run.
@@ -1562,6 +1994,165 @@ class CMAP_EMAT_Model(FilesCoreModel):
 		"""
 		pass
 
+	def add_parser(self, parser):
+		super().add_parser(parser)
+		self._measure_index = None
+
+	def measure_sources(self, measure_names=None):
+		"""
+		Find the parsers that some performance measures come from.
+
+		Derived measures are resolved to the parsed measures they are
+		computed from.  The index from measure name to parser is built
+		once, the first time it is needed after a parser is added.
+
+		Args:
+			measure_names (Collection[str], optional): The measures, by
+				default all of them.
+
+		Returns:
+			dict[FileParser, list[str]]: The parsed measures needed from
+			each parser, in parser order.  Each parser's `filename` is the
+			report file it reads, relative to the output directory.
+		"""
+		index = getattr(self, '_measure_index', None)
+		if index is None:
+			index = {}
+			for parser in self._parsers:
+				for name in parser.measure_names:
+					index.setdefault(name, parser)
+			self._measure_index = index
+		if measure_names is None:
+			measure_names = list(index)
+		else:
+			derived = getattr(self, 'derived_measures', None) or DerivedMeasures({})
+			measure_names = list(dict.fromkeys(
+				[i for i in measure_names if i not in derived.expressions]
+				+ derived.dependencies(measure_names)
+			))
+		wanted = {parser: [] for parser in self._parsers}
+		for name in measure_names:
+			if name in index:
+				wanted[index[name]].append(name)
+		return {parser: names for parser, names in wanted.items() if names}
+
+	def load_measures(
+			self,
+			measure_names=None,
+			*,
+			rel_output_path=None,
+			abs_output_path=None,
+			report_values=None,
+	):
+		"""
+		Load performance measures from model outputs.
+
+		The report files are parsed as in `FilesCoreModel.load_measures`,
+		and then the derived measures declared in `cmap_derived` are
+		computed from the parsed measures, in the same pass.
+
+		When the model has a `report_values` store and the outputs are its
+		own, every value the mapping parsers read, whether a measure or
+		not, is also stored there for the current run.
+
+		Args:
+			measure_names (Collection[str], optional): Measures to load, by
+				default all of them.  Only the report files these measures
+				(or the inputs of derived ones) come from are read, and only
+				the requested values are extracted from them.
+			rel_output_path, abs_output_path (str, optional): The location
+				of the model outputs, as for `FilesCoreModel.load_measures`.
+			report_values (dict, optional): Every value the mapping parsers
+				read is put in this, by report file and key, instead of
+				the model's store.  All the mapping report files are read.
+
+		Returns:
+			dict
+		"""
+		if rel_output_path is not None and abs_output_path is not None:
+			raise ValueError("cannot give both `rel_output_path` and `abs_output_path`")
+		elif abs_output_path is not None:
+			output_path = abs_output_path
+		else:
+			output_path = os.path.join(self.resolved_model_path, rel_output_path or self.rel_output_path)
+		if not os.path.isdir(output_path):
+			raise NotADirectoryError(output_path)
+
+		derived = getattr(self, 'derived_measures', None) or DerivedMeasures({})
+		if measure_names is None:
+			sources = {parser: None for parser in self._parsers}
+		else:
+			sources = self.measure_sources(measure_names)
+
+		store = None
+		if report_values is None and rel_output_path is None and abs_output_path is None:
+			store = getattr(self, 'report_values', None) if getattr(self, 'run_id', None) is not None else None
+			if store is not None:
+				report_values = {}
+		if report_values is not None:
+			# Every mapping report file is read, for all its values.
+			sources = {
+				parser: sources.get(parser, [])
+				for parser in self._parsers
+				if parser in sources or isinstance(parser, MappingParser)
+			}
+
+		results = {}
+		for parser, names in sources.items():
+			try:
+				results.update(_read_measures(parser, output_path, names, report_values))
+			except FileNotFoundError as err:
+				for name in (parser.measure_names if names is None else names):
+					warnings.warn(f'{name} unavailable, {err} not found')
+			except Exception as err:
+				for name in (parser.measure_names if names is None else names):
+					warnings.warn(f'{name} unavailable, {err!r}')
+
+		results.update(derived.compute(results, measure_names))
+		if store is not None and report_values:
+			try:
+				n = store.append(self.run_id, self._setup_experiment_id(), report_values)
+				_logger.debug(f"stored {n} report values in {store.directory}")
+			except OSError as err:
+				_logger.warning(f"report values not stored: {err!r}")
+		if measure_names is not None:
+			results = {k: v for k, v in results.items() if k in set(measure_names)}
+		# Also assign to outcomes_output, for ema_workbench compatibility
+		self.outcomes_output = results
+		return results
+
+	def load_archived_measures(self, experiment_id, measure_names=None):
+		"""
+		Load performance measures from an archived model run.
+
+		If the archive is zipped, only the report files the measures come
+		from are extracted, not the whole archive with its emmebank.
+
+		Args:
+			experiment_id (int): The id for the experiment to load.
+			measure_names (Collection, optional): A subset of
+				performance measure names to load.  If not provided,
+				all measures will be loaded.
+		"""
+		experiment_archive_path = self.get_experiment_archive_path(experiment_id)
+		experiment_archive_zip = experiment_archive_path.rstrip("/\\")+".zip"
+		if not os.path.exists(experiment_archive_zip):
+			return super().load_archived_measures(experiment_id, measure_names)
+		import zipfile
+		wanted = {
+			os.path.normpath(os.path.join(self.rel_output_path, parser.filename)).replace(os.sep, '/')
+			for parser in self.measure_sources(measure_names)
+		}
+		_logger.info(f"zipped archive found, extracting {len(wanted)} files from {experiment_archive_zip}")
+		with tempfile.TemporaryDirectory() as tmpdir, zipfile.ZipFile(experiment_archive_zip) as z:
+			for member in z.namelist():
+				if member.replace('\\', '/') in wanted:
+					z.extract(member, tmpdir)
+			return self.load_measures(
+				measure_names,
+				abs_output_path=os.path.join(tmpdir, self.rel_output_path),
+			)
+
 	def archive(self, params, model_results_path=None, experiment_id=None):
 		"""
 		Copies model outputs to archive location.
@@ -1681,11 +2272,255 @@ class CMAP_EMAT_Model(FilesCoreModel):
 		# except:
 		# 	_logger.exception("EXCEPTION IN MODEL DELETE")
 
+	def dry_setup(self, design, staging_dir=None, **kwargs):
+		"""
+		Check the model inputs for every experiment in a design.
+
+		The templated input files are rendered and checked for each
+		experiment, without copying the model.  See
+		`cmap_dry_setup.dry_setup` for the options.
+
+		Args:
+			design (pandas.DataFrame or str): Experiment parameters, or
+				the name of a design in the database.
+			staging_dir (str, optional): Write the rendered files for
+				each experiment to a folder named for it here.
+
+		Returns:
+			pandas.DataFrame: One row per problem found.
+		"""
+		import cmap_dry_setup
+		if isinstance(design, str):
+			design = self.db.read_experiment_parameters(self.scope.name, design)
+		return cmap_dry_setup.dry_setup(self, design, staging_dir, **kwargs)
+
+	def run_distinct_experiments(self, design, evaluator=None):
+		"""
+		Run a design, running each distinct set of model inputs once.
+
+		Fuel cost and the VMT charge only reach the model as rounded
+		operating costs, so nearby experiments are often the same core
+		model run.  Each distinct run is made once, and its results are
+		copied to every equivalent experiment.  See `cmap_lattice`.
+
+		Args:
+			design (pandas.DataFrame or str): Experiment parameters
+				indexed by experiment id, or the name of a design in
+				the database.
+			evaluator (optional): Passed to `run_experiments`.
+
+		Returns:
+			pandas.Series: The lattice point of each experiment;
+			experiments with the same lattice point are the same run.
+		"""
+		import cmap_lattice
+		if isinstance(design, str):
+			design = self.db.read_experiment_parameters(self.scope.name, design)
+		return cmap_lattice.run_distinct(self, design, evaluator)
+
+	def run_experiments_distributed(self, design, executor, workspace, **kwargs):
+		"""
+		Run experiments on several machines that share nothing but the source model.
+
+		Each node keeps cached copies of the source models in its own
+		`workspace`, and returns the measures and a zipped archive of
+		each run, which are stored here.  See `cmap_distributed`.
+
+		Args:
+			design (pandas.DataFrame or str): Experiment parameters
+				indexed by experiment id, or the name of a design in
+				the database.
+			executor: A `dask.distributed` Client or a
+				`concurrent.futures` executor.
+			workspace (str): The workspace directory on each node.
+
+		Returns:
+			pandas.DataFrame: Where, how long and how well each
+			experiment ran.
+		"""
+		import cmap_distributed
+		if isinstance(design, str):
+			design = self.db.read_experiment_parameters(self.scope.name, design)
+		return cmap_distributed.run_distributed(self, design, executor, workspace, **kwargs)
+
+	def queue_experiments(self, design, priority=0, note=None, requeue=False):
+		"""
+		Add experiments to the persistent experiment queue.
+
+		Args:
+			design (pandas.DataFrame or str): Experiment parameters
+				indexed by experiment id, or the name of a design in the
+				database.  New experiments are written to the database
+				as an 'ad hoc' design.
+			priority (int, default 0): Higher priorities run first.
+			note (str, optional): A note kept with the queue entries.
+			requeue (bool, default False): Queue experiments that have
+				already finished again.
+
+		Returns:
+			list[int]: The experiment ids.
+		"""
+		if isinstance(design, str):
+			design = self.db.read_experiment_parameters(self.scope.name, design)
+		if design.index.name != 'experiment':
+			design.index = self.db.write_experiment_parameters(self.scope.name, 'ad hoc', design)
+		self.db.enqueue_experiments(design.index, priority, note, requeue)
+		return list(design.index)
+
+	def run_queue(self, **kwargs):
+		"""
+		Run experiments from the persistent queue, highest priority first.
+
+		See `cmap_queue.run_queue` for the options, including preempting
+		a low priority run when a higher priority experiment is queued.
+
+		Returns:
+			dict: The number of experiments 'done', 'failed' and 'preempted'.
+		"""
+		import cmap_queue
+		return cmap_queue.run_queue(self, **kwargs)
+
+	def plan_experiments(self, n_runs, design_name=None, **kwargs):
+		"""
+		Plan the next core model runs where a meta-model is least certain.
+
+		A meta-model of the key measures (by default `Regionwide_VMT` and
+		the transit shares) is fit to the completed experiments, and the
+		batch is picked from a large candidate pool to most reduce its
+		uncertainty.  See `cmap_planner.plan_experiments` for the options.
+
+		Args:
+			n_runs (int): Number of experiments to plan.
+			design_name (str, optional): Name for the planned design.
+
+		Returns:
+			emat.ExperimentalDesign: The planned experiments, already
+			written to the database.
+		"""
+		import cmap_planner
+		return cmap_planner.plan_experiments(self, n_runs, design_name, **kwargs)
+
+	def run_adaptive(self, n_rounds, n_runs, tolerance=None, evaluator=None, **kwargs):
+		"""
+		Alternate planning and running core model experiments.
+
+		Args:
+			n_rounds (int): Maximum number of plan-and-run rounds.
+			n_runs (int): Core model runs per round.
+			tolerance (float, optional): Stop once the meta-model's scaled
+				standard deviation is below this everywhere.
+			evaluator (optional): Passed to `run_experiments`.
+
+		Returns:
+			list[str]: The names of the designs that were run.
+		"""
+		import cmap_planner
+		return cmap_planner.run_adaptive(self, n_rounds, n_runs, tolerance, evaluator, **kwargs)
+
+	def backfill_derived_measures(self, design_name=None, overwrite=False):
+		"""
+		Compute derived measures for every run already in the database.
+
+		Args:
+			design_name (str or Collection[str], optional): Limit the
+				backfill to these designs.
+			overwrite (bool, default False): Also recompute values that
+				are already stored.
+
+		Returns:
+			int: The number of values written.
+		"""
+		return self.db.write_derived_measures(
+			self.scope, self.derived_measures, design_name, overwrite=overwrite,
+		)
+
+	def backfill_report_measures(self, measures):
+		"""
+		Fill in new measures for every run in the report value store.
+
+		After a value the mapping parsers already read is made a measure,
+		by adding it to a parser and to the scope, this writes it for the
+		runs already done from the stored report values, without parsing
+		their archives again.
+
+		Args:
+			measures (Mapping[str, str or tuple[str, str]]): The report
+				key of each measure, or its report file and key.
+
+		Returns:
+			int: The number of runs written.
+		"""
+		if self.report_values is None:
+			raise ValueError("no report value store, set `report_values` in the configuration")
+		columns = {}
+		for name, report_key in measures.items():
+			source, report_key = report_key if isinstance(report_key, tuple) else (None, report_key)
+			columns[name] = self.report_values.read(report_key, source=source)[report_key]
+		values = pd.DataFrame(columns)
+		values = values[values.index.get_level_values('experiment').notna()]
+		if values.empty:
+			return 0
+		values.index = pd.MultiIndex.from_arrays([
+			values.index.get_level_values('experiment').astype(int),
+			values.index.get_level_values('run'),
+		])
+		self.db.write_experiment_measures(self.scope.name, 0, values)
+		if isinstance(self.db, CMAP_SQLiteDB):
+			self.db.flush_measures()
+		return len(values)
+
 	def invalidate_experiment_runs(self, *queries):
+		"""
+		Invalidate the valid runs matching any of these queries.
+
+		Args:
+			*queries (str): Queries, as for `pandas.DataFrame.query`, on
+				the parameters and measures of each run.
+
+		Returns:
+			list[int]: The number of runs invalidated by each query.
+		"""
+		if isinstance(self.db, CMAP_SQLiteDB):
+			return self.db.invalidate_experiment_runs(queries=list(queries), scope_name=self.scope.name)
+		n_runs_invalidated = []
 		for q in queries:
 			bad_runs = self.db.read_experiment_measures(self.scope.name, runs='valid').query(q)
-			if not bad_runs.empty:
-				self.db.invalidate_experiment_runs(bad_runs)
+			n_runs_invalidated.append(self.db.invalidate_experiment_runs(bad_runs) if not bad_runs.empty else 0)
+		return n_runs_invalidated
+
+
+def _read_measures(parser, from_dir, measure_names=None, capture=None):
+	"""
+	Read some of the measures a parser provides.
+
+	A TableParser or MappingParser reads its file and then runs only the
+	getters for `measure_names`; other parsers read everything.  If a
+	`capture` dict is given, the whole mapping a MappingParser reads is
+	also put in it, under the parser's filename.
+	"""
+	if capture is not None and isinstance(parser, MappingParser):
+		data = capture[parser.filename] = parser.raw(from_dir)
+		if measure_names is None:
+			measure_names = parser.measure_names
+	elif measure_names is None or not isinstance(parser, TableParser):
+		result = parser.read(from_dir)
+		if measure_names is not None:
+			result = {k: result[k] for k in measure_names if k in result}
+		return result
+	else:
+		data = parser.raw(from_dir)
+	result = {}
+	for name in measure_names:
+		try:
+			result[name] = parser.measure_getters[name](data)
+		except:
+			if parser.handle_errors == 'nan':
+				_logger.exception(f"Error in reading {os.path.join(from_dir, parser.filename)}")
+				result[name] = np.nan
+			else:
+				_logger.error(f"Error in reading {os.path.join(from_dir, parser.filename)}")
+				raise
+	return result
 
 
 def _tiered_file_parse(filename, sep):
@@ -1858,3 +2693,30 @@ def double_tap_tiered_file_parse(filename, sep=':'):
 
 
 	return result
+
+
+def global_iterations_parse(filename):
+	"""
+	Parse the global iterations run from `model_run_timestamp.txt`.
+
+	The batch file, the stage runner and the stand-in all write a
+	"Begin Global Iteration N" line as each global iteration starts.
+
+	Args:
+		filename (str): Filename of the timestamp file
+
+	Returns:
+		dict: The last global iteration begun, as 'Global Loops Used'.
+	"""
+	last = None
+	prefix = "Begin Global Iteration"
+	with open(filename, 'rt') as f:
+		for line in f:
+			line = line.strip()
+			if line.startswith(prefix):
+				counter = line[len(prefix):].split(':')[0].strip()
+				if counter.isdigit():
+					last = max(int(counter), -1 if last is None else last)
+	if last is None:
+		raise ValueError(f"no global iterations in {filename}")
+	return {'Global Loops Used': last}
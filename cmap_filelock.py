@@ -0,0 +1,75 @@
+""" cmap_filelock.py - locks on files, shared by the processes of one machine
+
+Several processes on a machine share directories -- CPU slots, a scratch
+tier, the source cache, the report value store -- and take turns with them
+by locking files.  These are the operating system's locks (`flock`, or
+`msvcrt.locking` on Windows), not lock files that must be removed, so a
+lock held by a process that dies, however it is killed, is released with it.
+"""
+import os
+import time
+import contextlib
+
+
+if os.name == 'nt':
+	import msvcrt
+
+	def try_lock(fd):
+		"""Take an exclusive lock on an open file, if no process holds one."""
+		try:
+			msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+			return True
+		except OSError:
+			return False
+
+	def unlock(fd):
+		"""Release a lock taken by `try_lock`."""
+		msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+	import fcntl
+
+	def try_lock(fd):
+		"""Take an exclusive lock on an open file, if no process holds one."""
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			return True
+		except OSError:
+			return False
+
+	def unlock(fd):
+		"""Release a lock taken by `try_lock`."""
+		fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def exclusive_lock(lockfile, timeout=3600, poll=0.5):
+	"""
+	Hold a lock on a file, for processes on one node sharing a directory.
+
+	The lock is the operating system's, so it is released when the
+	process holding it dies, however it is killed.  The lock file itself
+	is left in place.
+
+	Args:
+		lockfile (str): The lock file, created if need be.
+		timeout (float, default 3600): Seconds to wait for the lock,
+			or None to wait as long as it takes.
+		poll (float, default 0.5): Seconds between attempts.
+
+	Raises:
+		TimeoutError: If the lock is not acquired within `timeout`
+			seconds.
+	"""
+	start = time.time()
+	fd = os.open(lockfile, os.O_CREAT | os.O_RDWR)
+	try:
+		while not try_lock(fd):
+			if timeout is not None and time.time() - start > timeout:
+				raise TimeoutError(f"cannot acquire {lockfile}")
+			time.sleep(poll)
+		try:
+			yield
+		finally:
+			unlock(fd)
+	finally:
+		os.close(fd)
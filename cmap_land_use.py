@@ -0,0 +1,198 @@
+""" cmap_land_use.py - land use scenarios as overlays on the base model
+
+Each land use scenario used to be a complete copy of the source model, tens of
+gigabytes of which only the trip generation inputs differ.  A land use
+scenario can instead be an *overlay*: a directory holding only the files that
+differ from the base model, in the same layout, and optionally a list of base
+files the scenario does not have, in `_overlay_removed.txt`.  A model copy for
+the scenario is made from the base model, with the overlay applied on top.
+
+Overlays are given in the configuration, by land use value, relative to the
+model path; the base model is `model_path_land_use_base` as before, and
+without overlays the full `model_path_land_use_alt1` copy is still used:
+
+    land_use_overlays:
+        alt1: ../c20q1_700_20191219_LandUse/alt1
+        alt2: ../c20q1_700_20191219_LandUse/alt2
+
+Use `make_land_use_overlay` to make an overlay from a full copy.  New land
+use values must also be added to the `land_use` values in the scope.
+"""
+import os
+import shutil
+import filecmp
+from distutils.dir_util import copy_tree
+
+from emat.util.loggers import get_module_logger
+
+_logger = get_module_logger(__name__)
+
+REMOVED_LIST = '_overlay_removed.txt'
+
+
+def _join(*args):
+	return os.path.normpath(os.path.join(*args))
+
+
+def land_use_sources(config, model_path):
+	"""
+	The source of each land use scenario.
+
+	Args:
+		config (dict): The core model configuration.
+		model_path (str): The source model path, to which the paths in
+			the configuration are relative.
+
+	Returns:
+		dict[str, tuple[str, str or None]]: For each land use value, the
+		source model directory and the overlay directory, if any.
+	"""
+	base = _join(model_path, config['model_path_land_use_base'])
+	result = {'base': (base, None)}
+	overlays = config.get('land_use_overlays')
+	if overlays:
+		for land_use, overlay in overlays.items():
+			result[land_use] = (base, _join(model_path, overlay))
+	else:
+		result['alt1'] = (_join(model_path, config['model_path_land_use_alt1']), None)
+	return result
+
+
+def land_use_source(config, model_path, land_use):
+	"""
+	The source of one land use scenario.
+
+	Without overlays, every land use other than 'base' is 'alt1'.
+
+	Returns:
+		tuple[str, str or None]: The source model directory, and the
+		overlay directory, if any.
+
+	Raises:
+		ValueError: If there is no overlay for the land use.
+	"""
+	sources = land_use_sources(config, model_path)
+	if land_use == 'base' or not config.get('land_use_overlays'):
+		return sources['base' if land_use == 'base' else 'alt1']
+	try:
+		return sources[land_use]
+	except KeyError:
+		raise ValueError(f"no land use overlay for {land_use!r}") from None
+
+
+def overlay_files(overlay):
+	"""
+	The files of an overlay.
+
+	Returns:
+		changed (list[str]): Files the overlay replaces or adds, relative
+			to the model directory.
+		removed (list[str]): Base model files the overlay removes.
+	"""
+	changed = []
+	for dirpath, _, filenames in os.walk(overlay):
+		for filename in filenames:
+			relpath = os.path.relpath(os.path.join(dirpath, filename), overlay)
+			if relpath != REMOVED_LIST:
+				changed.append(relpath)
+	removed = []
+	try:
+		with open(os.path.join(overlay, REMOVED_LIST), 'rt') as f:
+			removed = [os.path.normpath(line.strip()) for line in f if line.strip()]
+	except FileNotFoundError:
+		pass
+	return changed, removed
+
+
+def source_file(relpath, source, overlay=None):
+	"""The path of a model file in a land use scenario, or None if it has none."""
+	if overlay is not None:
+		changed, removed = overlay_files(overlay)
+		if os.path.normpath(relpath) in removed:
+			return None
+		if os.path.isfile(os.path.join(overlay, relpath)):
+			return os.path.join(overlay, relpath)
+	path = os.path.join(source, relpath)
+	return path if os.path.isfile(path) else None
+
+
+def build_workspace(workspace, source, overlay=None, other_overlays=()):
+	"""
+	Copy the model for a land use scenario into a workspace.
+
+	The source model is copied first, only updating files that are newer
+	in the source, so a workspace used before is quick to refresh.  Any
+	files left by other overlays are then put back as they are in the
+	source, so one workspace can be used for every land use, and the
+	overlay, if any, is applied on top.
+
+	Args:
+		workspace (str): The model copy.
+		source (str): The source model directory.
+		overlay (str, optional): The overlay directory.
+		other_overlays (Iterable[str]): The overlays of the other land
+			use scenarios.
+	"""
+	copy_tree(source, workspace, update=True)
+	for other in other_overlays:
+		if other is None or other == overlay or not os.path.isdir(other):
+			continue
+		changed, _ = overlay_files(other)
+		for relpath in changed:
+			original = os.path.join(source, relpath)
+			target = os.path.join(workspace, relpath)
+			if os.path.isfile(original):
+				shutil.copy2(original, target)
+			elif os.path.exists(target):
+				os.remove(target)
+	if overlay is None:
+		return
+	changed, removed = overlay_files(overlay)
+	for relpath in changed:
+		target = os.path.join(workspace, relpath)
+		os.makedirs(os.path.dirname(target), exist_ok=True)
+		shutil.copy2(os.path.join(overlay, relpath), target)
+	for relpath in removed:
+		target = os.path.join(workspace, relpath)
+		if os.path.exists(target):
+			os.remove(target)
+	_logger.info(f"applied land use overlay {overlay}: {len(changed)} files, {len(removed)} removed")
+
+
+def make_land_use_overlay(base, variant, overlay):
+	"""
+	Make an overlay from a full copy of the model for a land use scenario.
+
+	Args:
+		base (str): The base source model directory.
+		variant (str): The full model directory for the scenario.
+		overlay (str): Where to write the overlay.
+
+	Returns:
+		tuple[int, int]: The number of files in the overlay, and the
+		number removed.
+	"""
+	def files(root):
+		result = set()
+		for dirpath, _, filenames in os.walk(root):
+			for filename in filenames:
+				result.add(os.path.relpath(os.path.join(dirpath, filename), root))
+		return result
+
+	base_files = files(base)
+	variant_files = files(variant)
+	n = 0
+	for relpath in sorted(variant_files):
+		original = os.path.join(base, relpath)
+		if relpath in base_files and filecmp.cmp(original, os.path.join(variant, relpath), shallow=False):
+			continue
+		target = os.path.join(overlay, relpath)
+		os.makedirs(os.path.dirname(target), exist_ok=True)
+		shutil.copy2(os.path.join(variant, relpath), target)
+		n += 1
+	removed = sorted(base_files - variant_files)
+	os.makedirs(overlay, exist_ok=True)
+	if removed:
+		with open(os.path.join(overlay, REMOVED_LIST), 'wt') as f:
+			f.writelines(f"{relpath.replace(os.sep, '/')}\n" for relpath in removed)
+	return n, len(removed)
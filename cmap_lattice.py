@@ -0,0 +1,183 @@
+""" cmap_lattice.py - collapse a design onto the distinct core model runs it needs
+
+Fuel cost and the VMT charge reach the core model only as sixteen auto
+operating costs, rounded to whole hundredths of a cent per mile, so the
+continuous design space collapses onto a finite lattice of actual model
+inputs, and nearby experiments are often the very same core model run.
+The functions here map a whole design onto that lattice at once, count and
+cluster the experiments that share a lattice point, and run each distinct
+point once, copying its results to every equivalent experiment.
+"""
+import numpy as np
+import pandas as pd
+
+from emat.util.loggers import get_module_logger
+
+from cmap_emat import BASE_FARES, auto_operating_costs
+
+_logger = get_module_logger(__name__)
+
+# Parameters the model only sees through rounded operating costs.
+ROUNDED_PARAMETERS = ('fuel_cost', 'vmt_charge')
+
+
+def lattice_points(scope, design):
+	"""
+	Map experiments onto the lattice of core model inputs.
+
+	Args:
+		scope (emat.Scope): The exploratory scope.
+		design (pandas.DataFrame): Experiment parameters, one row per
+			experiment.  Parameters not in the design take the scope
+			default.
+
+	Returns:
+		pandas.DataFrame: One row per experiment, with the parameters
+		written into the model as they are, and the rounded operating
+		costs `opcost_1` to `opcost_16` and fares in place of fuel
+		cost and the VMT charge.  Experiments with equal rows render
+		identical model inputs.  (`transit_fares` is also written as
+		it is, as the fare factor, so its rounded fares do not merge
+		experiments; they are included for reference.)
+	"""
+	def column(name):
+		if name in design.columns:
+			return design[name]
+		return pd.Series(scope[name].default, index=design.index)
+
+	points = {}
+	for name in scope.get_parameter_names():
+		if name not in ROUNDED_PARAMETERS:
+			values = column(name)
+			if isinstance(values.dtype, pd.CategoricalDtype):
+				values = values.astype(object)
+			points[name] = values
+	opcosts = auto_operating_costs(column('fuel_cost'), column('vmt_charge')).astype(np.int64)
+	for j in range(opcosts.shape[1]):
+		points[f'opcost_{j + 1}'] = opcosts[:, j]
+	fares = np.asarray(column('transit_fares'), dtype=np.float64)
+	for token, fare in BASE_FARES.items():
+		points['fare_' + token.strip('_').split('__')[-1]] = np.round(fare * fares).astype(np.int64)
+	return pd.DataFrame(points, index=design.index)
+
+
+def cluster_experiments(scope, design):
+	"""
+	Number the distinct lattice points of a design.
+
+	Returns:
+		pandas.Series: The lattice point of each experiment, numbered
+		from 0 in order of first appearance.
+	"""
+	points = lattice_points(scope, design)
+	return points.groupby(list(points.columns), sort=False, dropna=False).ngroup().rename('lattice_point')
+
+
+def duplicate_clusters(scope, design):
+	"""
+	Find the groups of experiments that are the same core model run.
+
+	Returns:
+		list[list]: The experiment ids of each group of two or more
+		experiments that share a lattice point.
+	"""
+	clusters = cluster_experiments(scope, design)
+	return [
+		list(members)
+		for members in clusters.index.groupby(clusters.to_numpy()).values()
+		if len(members) > 1
+	]
+
+
+def _representatives(clusters, completed):
+	"""The experiment to run for each lattice point, preferring one with results."""
+	members = pd.Series(clusters.index, index=clusters.index)
+	has_results = members.isin(completed)
+	# within each lattice point, sort experiments with results first
+	order = pd.DataFrame({'point': clusters, 'todo': ~has_results}).sort_values(['point', 'todo'], kind='stable')
+	return members[order.index].groupby(order['point']).first()
+
+
+def fan_out_results(model, design, clusters=None):
+	"""
+	Copy results to every experiment sharing a lattice point.
+
+	For each lattice point with stored core model results, the results
+	are written, as a new run, to each experiment at that point that has
+	none, and its input fingerprint is recorded as reused.
+
+	Args:
+		model (CMAP_EMAT_Model): The core model, with its database.
+		design (pandas.DataFrame): Experiment parameters, indexed by
+			experiment id.
+		clusters (pandas.Series, optional): From `cluster_experiments`.
+
+	Returns:
+		int: The number of experiments given results.
+	"""
+	db = model.db
+	if clusters is None:
+		clusters = cluster_experiments(model.scope, design)
+	completed = db.read_completed_experiment_ids(model.scope.name)
+	representatives = _representatives(clusters, completed)
+	m_names = model.scope.get_measure_names()
+	defaults = {p.name: p.default for p in model.scope.get_parameters()}
+	n = 0
+	for point, members in clusters.index.groupby(clusters.to_numpy()).items():
+		rep = representatives[point]
+		todo = [i for i in members if i not in completed]
+		if not todo or rep not in completed:
+			continue
+		stored = db.read_experiment_measures(model.scope, experiment_id=rep, source=0).iloc[0]
+		measures = pd.DataFrame(
+			[[stored.get(k, np.nan) for k in m_names]] * len(todo),
+			index=todo,
+			columns=m_names,
+		)
+		run_ids = [
+			db.new_run_id(model.scope.name, experiment_id=i, source=0)[0]
+			for i in todo
+		]
+		db.write_experiment_measures(model.scope.name, 0, measures, run_ids)
+		params = dict(defaults)
+		params.update(design.loc[rep])
+		fingerprint = model.input_fingerprint(params)
+		db.write_input_fingerprints({rep: fingerprint})
+		db.write_input_fingerprints({i: fingerprint for i in todo}, reused_from=rep)
+		n += len(todo)
+	db.flush_measures()
+	if n:
+		db.log(f"FAN OUT results to {n} experiments with identical model inputs")
+	return n
+
+
+def run_distinct(model, design, evaluator=None):
+	"""
+	Run each distinct lattice point of a design once.
+
+	One experiment per lattice point is run on the core model (none,
+	if an experiment at that point already has results), and then the
+	results are copied to the other experiments at the same point.
+
+	Args:
+		model (CMAP_EMAT_Model): The core model, with its database.
+		design (pandas.DataFrame): Experiment parameters, indexed by
+			experiment id, as read from the database.
+		evaluator (optional): Passed to `run_experiments`.
+
+	Returns:
+		pandas.Series: The lattice point of each experiment.
+	"""
+	clusters = cluster_experiments(model.scope, design)
+	completed = model.db.read_completed_experiment_ids(model.scope.name)
+	representatives = _representatives(clusters, completed)
+	to_run = [i for i in representatives if i not in completed]
+	_logger.info(
+		f"{len(design)} experiments are {len(representatives)} distinct core model runs, "
+		f"{len(to_run)} still to run"
+	)
+	if to_run:
+		model.run_experiments(design.loc[to_run], evaluator=evaluator)
+	n = fan_out_results(model, design, clusters)
+	_logger.info(f"copied results to {n} equivalent experiments")
+	return clusters
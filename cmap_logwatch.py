@@ -0,0 +1,224 @@
+""" cmap_logwatch.py - catch a failing core model run from its logs, as it runs
+
+A run that has already failed can go on for hours before the batch process
+exits: without an Emme license every macro fails in turn, the batch file's
+`filemiss`/`mcmiss` branches quietly skip to the end, and a Fortran runtime
+error only leaves the next stage to work from missing files.  A `LogWatcher`
+follows the model's logs as they are written -- `blog.txt`, the batch and
+stage output, `model_run_timestamp.txt` and the Fortran stage logs -- reading
+only what is new each time it is checked, and matches every new line against
+a library of failure signatures.  The first match raises a `RunFailure`
+naming the class of failure, so the run can be stopped at once and the
+failure recorded in the results database.
+"""
+import os
+import re
+import glob
+import subprocess
+
+from emat.util.loggers import get_module_logger
+
+_logger = get_module_logger(__name__)
+
+# Logs written in the Database directory while the model runs.
+_RUN_LOGS = ['blog.txt', 'batch_output.log', 'stages.log', 'cleanup.rpt', 'model_run_timestamp.txt']
+_FORTRAN_LOGS = ['*_PREDIST_LOG.TXT', '*_MC_LOG.TXT', 'HVOCC_LOGOUT*.TXT']
+# ...which are moved into the report folder when each stage is done.
+_FORTRAN_LOGS += [os.path.join('report', 'iter_*', f) for f in _FORTRAN_LOGS]
+
+# Known failures, in the order they are tried.  Each has a class, the log
+# files it is looked for in (as glob patterns in the Database directory),
+# and a regular expression matched against each line.  A class may have
+# several signatures.  The run logs echo many handled errors, so only
+# output that is fatal to the run is looked for in them.
+FAILURE_SIGNATURES = [
+	dict(
+		failure_class='emme_license',
+		files=_RUN_LOGS,
+		pattern=r"(?i)licen[cs]e.{0,40}(not available|unavailable|expired|invalid|denied|error|fail)"
+				r"|\b(no|cannot|unable to|failed to)\b.{0,40}licen[cs]e",
+	),
+	dict(
+		failure_class='missing_inputs',
+		files=_RUN_LOGS,
+		pattern=r"Missing Files|Missing M01, DISTR or Other Files|missing from Database folder",
+	),
+	dict(
+		failure_class='python_not_found',
+		files=_RUN_LOGS,
+		pattern=r"COULD NOT FIND PYTHON INSTALLED",
+	),
+	dict(
+		failure_class='fortran_runtime',
+		files=_FORTRAN_LOGS,
+		pattern=r"(?i)forrtl: severe|run-?time error|program exception|access violation|stack overflow",
+	),
+	dict(
+		# the Intel Fortran runtime aborting, on the programs' own output
+		failure_class='fortran_runtime',
+		files=['batch_output.log', 'stages.log'],
+		pattern=r"forrtl: severe \(\d+\)",
+	),
+	dict(
+		# the interpreter dying, not a traceback a macro caught and printed
+		failure_class='python_exception',
+		files=['batch_output.log', 'stages.log'],
+		pattern=r"^Fatal Python error:|^(MemoryError|ModuleNotFoundError)\b",
+	),
+	dict(
+		failure_class='disk_full',
+		files=_FORTRAN_LOGS + _RUN_LOGS,
+		pattern=r"(?i)not enough space on the disk|no space left on device",
+	),
+]
+
+
+def merge_signatures(signatures=None):
+	"""
+	Combine configured failure signatures with the library.
+
+	Args:
+		signatures (list[dict], optional): As for `LogWatcher`.
+
+	Returns:
+		list[dict]: The signatures to try, in order.
+	"""
+	by_class = {}
+	for s in signatures or []:
+		by_class.setdefault(s['failure_class'], []).append(s)
+	builtin_files = {}
+	for s in FAILURE_SIGNATURES:
+		builtin_files.setdefault(s['failure_class'], []).extend(s['files'])
+	result = []
+	for failure_class, given in by_class.items():
+		if failure_class not in builtin_files:
+			result.extend(given)
+	done = set()
+	for s in FAILURE_SIGNATURES:
+		failure_class = s['failure_class']
+		if failure_class not in by_class:
+			result.append(s)
+		elif failure_class not in done:
+			done.add(failure_class)
+			given = by_class[failure_class]
+			if any(g.get('disabled') or not g.get('pattern') for g in given):
+				_logger.info(f"failure signatures for {failure_class} disabled")
+				continue
+			files = list(dict.fromkeys(builtin_files[failure_class]))
+			result.extend(dict(g, files=g.get('files') or files) for g in given)
+	return [s for s in result if not s.get('disabled') and s.get('pattern')]
+
+
+class RunFailure(subprocess.CalledProcessError):
+	"""
+	A core model run that failed in a recognized way.
+
+	This is a `CalledProcessError`, so `run_model` records the experiment
+	as failed and goes on to the next one, as it does when the batch
+	file exits with an error.
+
+	Args:
+		failure_class (str): The kind of failure, such as 'emme_license'
+			or 'timeout'.
+		message (str): What was found.
+		source (str, optional): The log file it was found in.
+		cmd (optional): The command that was stopped.
+		returncode (int, default -1): Its exit code, if it exited.
+	"""
+
+	def __init__(self, failure_class, message, source=None, cmd=None, returncode=-1):
+		super().__init__(returncode, cmd or failure_class)
+		self.failure_class = failure_class
+		self.message = message
+		self.source = source
+
+	def __str__(self):
+		where = f" in {self.source}" if self.source else ""
+		return f"{self.failure_class}{where}: {self.message}"
+
+
+class LogWatcher:
+	"""
+	Follow the logs of a core model run, looking for failure signatures.
+
+	Args:
+		database_dir (str): The model's Database directory.
+		signatures (list[dict], optional): Failure signatures, each with
+			`failure_class`, `files` and `pattern`.  Those of a class in
+			`FAILURE_SIGNATURES` replace its signatures there, taking its
+			files if they give none, and one with `disabled: true` or no
+			`pattern` turns the class off.  Those of other classes are
+			tried first.
+		errors_megabytes (float, default 50): The run also fails, as
+			'emme_errors', when an Emme `errors` file grows past this.
+	"""
+
+	def __init__(self, database_dir, signatures=None, errors_megabytes=50):
+		self.database_dir = database_dir
+		self.signatures = [
+			(s['failure_class'], list(s['files']), re.compile(s['pattern']))
+			for s in merge_signatures(signatures)
+		]
+		self.errors_megabytes = errors_megabytes
+		self._offsets = {}
+		self._partial = {}
+
+	def _new_lines(self, filename, final=False):
+		"""The complete lines added to a file since it was last read."""
+		try:
+			size = os.path.getsize(filename)
+		except OSError:
+			return []
+		offset = self._offsets.get(filename, 0)
+		if size < offset:
+			# the file was started again
+			offset = 0
+			self._partial[filename] = b''
+		if size == offset:
+			if final and self._partial.get(filename):
+				return [self._partial.pop(filename).decode(errors='replace')]
+			return []
+		with open(filename, 'rb') as f:
+			f.seek(offset)
+			data = self._partial.get(filename, b'') + f.read(size - offset)
+		self._offsets[filename] = size
+		lines = data.split(b'\n')
+		self._partial[filename] = b'' if final else lines.pop()
+		return [line.decode(errors='replace').rstrip('\r') for line in lines]
+
+	def check(self, final=False):
+		"""
+		Read what has been added to the logs since the last check.
+
+		Args:
+			final (bool, default False): The run is over, so also check
+				the last line of each log, if it has no line ending.
+
+		Returns:
+			RunFailure or None: The first failure found.
+		"""
+		patterns = {}
+		for failure_class, files, regex in self.signatures:
+			for pattern in files:
+				for filename in glob.glob(os.path.join(self.database_dir, pattern)):
+					patterns.setdefault(filename, []).append((failure_class, regex))
+		for filename, signatures in patterns.items():
+			for line in self._new_lines(filename, final):
+				for failure_class, regex in signatures:
+					if regex.search(line):
+						return RunFailure(failure_class, line.strip(), os.path.basename(filename))
+		limit = self.errors_megabytes * 2**20
+		for dirpath, _, filenames in os.walk(self.database_dir):
+			for filename in filenames:
+				if filename.lower() == 'errors':
+					path = os.path.join(dirpath, filename)
+					if os.path.getsize(path) > limit:
+						return RunFailure('emme_errors', f"errors file over {self.errors_megabytes} MB", path)
+		return None
+
+	def __call__(self):
+		"""Check the logs, for `cmap_stages.run_stages`; raise any failure found."""
+		failure = self.check()
+		if failure is not None:
+			_logger.error(f"run failed: {failure}")
+			raise failure
@@ -0,0 +1,371 @@
+""" cmap_metamodel.py - meta-models fitted to an independent basis of measures
+
+The scope has some 600 performance measures, and most of them are not
+independent: each `*_Total_District_VMT` is the sum of the Expressway,
+Arterial, RampToll and Centroid VMT for that district, each `*_Total_VHT_*`
+is the sum over vehicle classes, the regionwide measures are sums of district
+totals, and so on.  Fitting a Gaussian process to every one of them costs
+time and disk in the meta-model tables for no gain in information.
+
+The functions here find, from the stored results, which measures are
+constant and which are (to within report rounding) a linear combination of
+a few others.  A meta-model is fitted only to the remaining independent
+basis, and the other measures are derived from its predictions.
+"""
+import re
+import warnings
+import numpy as np
+import pandas as pd
+
+import emat
+from emat.model.core_python import PythonCoreModel
+from emat.model.meta_model import MetaModel
+from emat.exceptions import ReadOnlyDatabaseError
+from emat.util.loggers import get_module_logger
+
+from cmap_derived import DERIVED_MEASURES
+
+_logger = get_module_logger(__name__)
+
+# Measures with names like these are tried last when building the basis,
+# so that sums are derived from their parts rather than the other way round.
+AGGREGATE_PATTERN = re.compile(r"Total|Regionwide|Overall|Full_Region")
+
+
+class MeasureBasis:
+	"""
+	How to derive a full set of measures from an independent basis.
+
+	Attributes:
+		basis (list[str]): The independent measures.
+		constants (dict[str, float]): Measures that did not vary.
+		derived (list[str]): Measures that are a linear function of the
+			basis.
+		coefficients (numpy.ndarray): A (len(derived), len(basis)) array,
+			mostly zeros, giving each derived measure in terms of the basis.
+		intercepts (numpy.ndarray): The constant term of each derived
+			measure.
+		formulas (dict[str, str]): Measures computed by evaluating a
+			formula on the others, as for formula measures in the scope.
+		measures (list[str]): All the measures, in their original order.
+	"""
+
+	def __init__(self, measures, basis, constants, derived, coefficients, intercepts, formulas=None):
+		self.measures = list(measures)
+		self.basis = list(basis)
+		self.constants = dict(constants)
+		self.derived = list(derived)
+		self.coefficients = np.asarray(coefficients, dtype=np.float64).reshape(len(self.derived), len(self.basis))
+		self.intercepts = np.asarray(intercepts, dtype=np.float64).reshape(len(self.derived))
+		self.formulas = dict(formulas or {})
+
+	def __repr__(self):
+		return (
+			f"<MeasureBasis: {len(self.basis)} basis, {len(self.derived)} derived, "
+			f"{len(self.constants)} constant, {len(self.formulas)} formula measures>"
+		)
+
+	def formula(self, name):
+		"""A readable formula for a derived measure."""
+		if name in self.formulas:
+			return self.formulas[name]
+		i = self.derived.index(name)
+		terms = [
+			f"{c:+.6g} * {b}"
+			for b, c in zip(self.basis, self.coefficients[i])
+			if c != 0
+		]
+		if abs(self.intercepts[i]) > 0:
+			terms.insert(0, f"{self.intercepts[i]:.6g}")
+		return " ".join(terms)
+
+	def derive(self, frame, intercepts=True):
+		"""
+		Add the derived and constant measures to a frame of basis measures.
+
+		Args:
+			frame (pandas.DataFrame): Values of every basis measure.
+			intercepts (bool, default True): Include the constant terms.
+				Set to False when deriving residuals rather than values;
+				formula measures are then left out, as they need not be
+				linear.
+
+		Returns:
+			pandas.DataFrame: All the measures, in their original order,
+			followed by any other columns of `frame`.
+		"""
+		values = frame[self.basis].to_numpy(dtype=np.float64) @ self.coefficients.T
+		if intercepts:
+			values += self.intercepts
+		derived = pd.DataFrame(values, index=frame.index, columns=self.derived)
+		for name, value in self.constants.items():
+			derived[name] = value if intercepts else 0.0
+		result = pd.concat([frame, derived], axis=1)
+		if intercepts:
+			for name, formula in self.formulas.items():
+				result[name] = result.eval(formula)
+		order = [i for i in self.measures if i in result.columns]
+		return result[order + [i for i in result.columns if i not in self.measures]]
+
+
+def completed_experiments(experiments, measures):
+	"""The experiments with a value for any of `measures`, leaving out those not run."""
+	measures = [i for i in measures if i in experiments.columns]
+	return experiments.dropna(subset=measures, how='all')
+
+
+def find_measure_basis(experiments, measures, rtol=1e-6, max_terms=8, formulas=None):
+	"""
+	Split measures into constant, independent and derived groups.
+
+	Measures are taken in the order given, except that those matching
+	`AGGREGATE_PATTERN` go last.  A measure is constant if it does not vary
+	beyond `rtol` of its magnitude.  Otherwise it is tested against the
+	basis found so far: up to `max_terms` basis measures are chosen
+	greedily (orthogonal matching pursuit), and if a linear combination of
+	them reproduces the measure in every experiment to within `rtol` of its
+	magnitude, the measure is derived; if not, it joins the basis.
+
+	Only sparse combinations are accepted, as with fewer experiments than
+	measures any measure is trivially a linear combination of enough
+	others.  For the same reason there must be comfortably more
+	experiments than `max_terms`.
+
+	Args:
+		experiments (pandas.DataFrame): Completed experiments.  Rows
+			with none of the `measures`, like planned experiments that
+			have not been run, are left out.
+		measures (Collection[str]): Measures to consider.  Measures that
+			are not columns of `experiments`, or that have missing values
+			in the experiments that were run, are left out.
+		rtol (float, default 1e-6): Tolerance for both tests, relative to
+			the largest absolute value of the measure.  Reports round
+			their values, so this cannot be much tighter.
+		max_terms (int, default 8): The most basis measures one derived
+			measure may depend on.
+		formulas (Mapping[str, str], optional): Formulas for measures
+			that are defined in terms of the others, such as the formula
+			measures in the scope.  These are not searched, but computed
+			from their formula, so regionwide sums need not be sparse.
+
+	Returns:
+		MeasureBasis
+
+	Raises:
+		ValueError: If there are too few experiments, or no measure has
+			a value in every one.
+	"""
+	experiments = completed_experiments(experiments, measures)
+	measures = [i for i in measures if i in experiments.columns and experiments[i].notna().all()]
+	if not measures:
+		raise ValueError(f"no measure has a value in all {len(experiments)} completed experiments")
+	formulas = {
+		k: v for k, v in (formulas or {}).items()
+		if k in measures and all(i in measures for i in re.findall(r"[A-Za-z_]\w*", v))
+	}
+	n = len(experiments)
+	if n < 2 * (max_terms + 1):
+		raise ValueError(
+			f"{n} completed experiments are too few to find dependencies with max_terms={max_terms}"
+		)
+	searched = [i for i in measures if i not in formulas]
+	ordered = (
+		[i for i in searched if not AGGREGATE_PATTERN.search(i)]
+		+ [i for i in searched if AGGREGATE_PATTERN.search(i)]
+	)
+	values = experiments[ordered].to_numpy(dtype=np.float64)
+
+	basis, basis_columns, constants, derived = [], [], {}, {}
+	# Centered and unit-normalized basis columns, for the greedy search.
+	unit = np.empty((n, 0))
+	for j, name in enumerate(ordered):
+		y = values[:, j]
+		tol = rtol * np.abs(y).max()
+		if np.ptp(y) <= tol:
+			constants[name] = float(y.mean())
+			continue
+		fit = _sparse_fit(y, values[:, basis_columns], unit, tol, max_terms)
+		if fit is not None:
+			derived[name] = fit
+			continue
+		col = y - y.mean()
+		unit = np.column_stack([unit, col / np.linalg.norm(col)])
+		basis.append(name)
+		basis_columns.append(j)
+
+	coefficients = np.zeros((len(derived), len(basis)))
+	intercepts = np.zeros(len(derived))
+	for i, (terms, coef, intercept) in enumerate(derived.values()):
+		coefficients[i, terms] = coef
+		intercepts[i] = intercept
+	result = MeasureBasis(measures, basis, constants, derived, coefficients, intercepts, formulas)
+	_logger.info(f"measure basis from {n} experiments: {result}")
+	return result
+
+
+def _sparse_fit(y, B, unit, tol, max_terms):
+	"""Greedily express `y` with a few columns of `B`, or return None."""
+	if B.shape[1] == 0:
+		return None
+	y_c = y - y.mean()
+	residual = y_c
+	terms = []
+	# Orthonormal basis of the chosen columns.  Each step picks the column
+	# that most reduces the residual once made orthogonal to those already
+	# chosen (orthogonal least squares), which copes with the strongly
+	# correlated measures here far better than plain matching pursuit.
+	Q = np.empty((len(y), 0))
+	for _ in range(min(max_terms, B.shape[1])):
+		R = unit - Q @ (Q.T @ unit)
+		norms = np.linalg.norm(R, axis=0)
+		norms[terms] = np.inf
+		norms[norms < 1e-9] = np.inf
+		j = int(np.argmax(np.abs(R.T @ residual) / norms))
+		if not np.isfinite(norms[j]):
+			break
+		terms.append(j)
+		q = R[:, j] / norms[j]
+		Q = np.column_stack([Q, q])
+		residual = residual - q * (q @ residual)
+		if np.abs(residual).max() <= tol:
+			B_c = B[:, terms] - B[:, terms].mean(axis=0)
+			coef, *_ = np.linalg.lstsq(B_c, y_c, rcond=None)
+			# Snap near-integer coefficients, as sums and differences are by
+			# far the commonest case, then check the fit still holds.
+			snapped = np.where(np.abs(coef - np.round(coef)) < 1e-4, np.round(coef), coef)
+			if np.abs(y_c - B_c @ snapped).max() <= tol:
+				coef = snapped
+			intercept = float(np.mean(y - B[:, terms] @ coef))
+			return terms, coef, intercept
+	return None
+
+
+class BasisMetaModel(MetaModel):
+	"""
+	A meta-model of the basis measures that also returns derived measures.
+
+	It is constructed from a fitted MetaModel of the basis measures, and
+	otherwise behaves like one: `predict` and calling it return every
+	measure, while methods such as `compute_std` and `cross_val_scores`
+	report on the fitted basis measures only.
+
+	Args:
+		metamodel (emat.MetaModel): A meta-model of the basis measures.
+		measure_basis (MeasureBasis): How to derive the others.
+	"""
+
+	def __init__(self, metamodel, measure_basis):
+		self.__dict__.update(metamodel.__dict__)
+		self.measure_basis = measure_basis
+		provided = set(measure_basis.derived) | set(measure_basis.constants) | set(measure_basis.formulas)
+		self.disabled_outputs = [i for i in (metamodel.disabled_outputs or []) if i not in provided]
+
+	def __call__(self, *args, **kwargs):
+		result = super().__call__(*args, **kwargs)
+		if isinstance(result, pd.DataFrame):
+			# each row has been through this method already
+			return result
+		return self._derive_one(result)
+
+	def predict(self, *args, trend_only=False, residual_only=False, **kwargs):
+		result = super().predict(*args, trend_only=trend_only, residual_only=residual_only, **kwargs)
+		if isinstance(result, pd.DataFrame):
+			return self.measure_basis.derive(result, intercepts=not residual_only)
+		return self._derive_one(result, intercepts=not residual_only)
+
+	def _derive_one(self, result, intercepts=True):
+		frame = pd.DataFrame([{k: result[k] for k in self.measure_basis.basis}])
+		derived = self.measure_basis.derive(frame, intercepts=intercepts).iloc[0]
+		result.update(derived.to_dict())
+		return result
+
+
+def fit_metamodel(
+		scope,
+		experiments,
+		db=None,
+		include_measures=None,
+		exclude_measures=None,
+		*,
+		rtol=1e-6,
+		max_terms=8,
+		name=None,
+		**kwargs,
+):
+	"""
+	Create a meta-model, fitting only an independent basis of measures.
+
+	This is a drop-in alternative to `emat.create_metamodel`.  Constant and
+	linearly dependent measures are found with `find_measure_basis`, the
+	emat meta-model is fitted to the rest, and the result derives the
+	skipped measures from the fitted ones.  The derived measures of
+	`cmap_derived`, and any formula measures in the scope, are computed
+	from their formulas.
+
+	Args:
+		scope (emat.Scope): The exploratory scope.
+		experiments (pandas.DataFrame): Experiment inputs and outputs.
+			Experiments without results, like those planned but not
+			yet run, are left out.
+		db (emat.Database, optional): If given, the meta-model is stored
+			in it.
+		include_measures, exclude_measures (Collection[str], optional):
+			Restrict the measures modeled, as for `emat.create_metamodel`.
+		rtol, max_terms: Passed to `find_measure_basis`.
+		name (str, optional): A descriptive name for the meta-model.
+		**kwargs: Passed to `emat.create_metamodel`.
+
+	Returns:
+		emat.PythonCoreModel: The meta-model, whose function is a
+		`BasisMetaModel` with the `MeasureBasis` in `measure_basis`.
+
+	Raises:
+		ValueError: If no measure can be fitted.
+	"""
+	measures = [
+		i for i in scope.get_measure_names()
+		if (include_measures is None or i in include_measures)
+		and (exclude_measures is None or i not in exclude_measures)
+	]
+	formulas = dict(DERIVED_MEASURES)
+	formulas.update({m.name: m.formula for m in scope.get_measures() if getattr(m, 'formula', None)})
+	experiments = completed_experiments(experiments, measures)
+	measure_basis = find_measure_basis(
+		experiments, measures, rtol=rtol, max_terms=max_terms, formulas=formulas,
+	)
+	if not measure_basis.basis:
+		raise ValueError(
+			f"none of the {len(measure_basis.measures)} measures varies independently "
+			f"in {len(experiments)} experiments, so there is nothing to fit"
+		)
+	basis_model = emat.create_metamodel(
+		scope,
+		experiments,
+		include_measures=measure_basis.basis,
+		**kwargs,
+	)
+	func = BasisMetaModel(basis_model.function, measure_basis)
+	metamodel_id = db.get_new_metamodel_id(scope.name) if db is not None else basis_model.metamodel_id
+	with warnings.catch_warnings():
+		warnings.simplefilter("ignore")
+		scope_ = scope.duplicate(
+			strip_measure_transforms=True,
+			include_measures=[i for i in measures if i in measure_basis.measures],
+		)
+	result = PythonCoreModel(
+		func,
+		configuration=None,
+		scope=scope_,
+		safe=True,
+		db=db,
+		name=name or f"MetaModel{metamodel_id}",
+		metamodel_id=metamodel_id,
+	)
+	if db is not None:
+		try:
+			db.write_metamodel(result)
+		except ReadOnlyDatabaseError:
+			pass
+		except Exception:
+			_logger.exception("exception in storing metamodel in database")
+	return result
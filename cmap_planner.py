@@ -0,0 +1,276 @@
+""" cmap_planner.py - surrogate-first planning of core model experiments
+
+Every core model run takes hours and 15 GB of disk, but the response of most
+measures to the eight exploratory inputs is smooth.  The planner fits an EMAT
+meta-model (a linear trend plus a Gaussian process on the residuals) to the
+experiments already completed, then picks the next batch of core model runs
+from a large pool of candidate points, where the meta-model is least certain
+about a few key measures.  Points are picked one at a time, and after each
+pick the Gaussian process covariance is conditioned on that point, so a batch
+spreads out over the uncertain region instead of clustering at its peak.
+"""
+import numpy as np
+from sklearn.gaussian_process import GaussianProcessRegressor
+
+import emat
+from emat.experiment.experimental_design import design_experiments
+from emat.util.loggers import get_module_logger
+
+from cmap_database import CMAP_SQLiteDB
+
+_logger = get_module_logger(__name__)
+
+# The measures the planner reduces uncertainty on by default.
+PLANNER_MEASURES = [
+	'Regionwide_VMT',
+	'ENTIRE_NETWORK_Transit_Share_HW_Transit_Share',
+	'ENTIRE_NETWORK_Transit_Share_HO_Transit_Share',
+	'ENTIRE_NETWORK_Transit_Share_NH_Transit_Share',
+	'ENTIRE_NETWORK_Transit_Share_Overall_Transit_Share',
+]
+
+
+def completed_experiments(db, scope, design_names=None, measures=None):
+	"""
+	Read the experiments that have results for every measure given.
+
+	Args:
+		db (emat.Database): The results database.
+		scope (emat.Scope): The exploratory scope.
+		design_names (str or Collection[str], optional): Designs to read,
+			by default all of them.
+		measures (Collection[str], optional): Measures to read, by
+			default `PLANNER_MEASURES`.
+
+	Returns:
+		pandas.DataFrame: Parameters and measures, one row per experiment.
+	"""
+	if measures is None:
+		measures = PLANNER_MEASURES
+	columns = scope.get_parameter_names() + list(measures)
+	if isinstance(db, CMAP_SQLiteDB):
+		experiments = db.read_experiment_all(scope, design_names, columns=columns)
+	else:
+		experiments = db.read_experiment_all(scope.name, design_names)
+	experiments = experiments[[i for i in columns if i in experiments.columns]]
+	return experiments.dropna(subset=[i for i in measures if i in experiments.columns])
+
+
+def fit_surrogate(db, scope, experiments, measures=None, random_state=None, store=True):
+	"""
+	Fit a meta-model of the planner measures.
+
+	Args:
+		db (emat.Database): The results database.  If `store` is True
+			the meta-model is written to its meta_model tables.
+		scope (emat.Scope): The exploratory scope.
+		experiments (pandas.DataFrame): Completed experiments, from
+			`completed_experiments`.
+		measures (Collection[str], optional): Measures to model, by
+			default `PLANNER_MEASURES`.
+		random_state (int, optional): For the regression fitting.
+		store (bool, default True): Store the meta-model in `db`.
+
+	Returns:
+		emat.PythonCoreModel: The meta-model.
+	"""
+	if measures is None:
+		measures = PLANNER_MEASURES
+	return emat.create_metamodel(
+		scope,
+		experiments,
+		db=db if store else None,
+		include_measures=list(measures),
+		random_state=random_state,
+		suppress_converge_warnings=True,
+		name='planner',
+	)
+
+
+def surrogate_covariance(metamodel, candidates, measures=None):
+	"""
+	The meta-model's posterior covariance over a set of candidate points.
+
+	Covariances are those of the Gaussian process on the detrended
+	outputs, scaled by the variance of each output in the training data,
+	so that the uncertainty on measures with different units (VMT and
+	mode shares, say) can be compared and added up.
+
+	Args:
+		metamodel (emat.PythonCoreModel): A meta-model with the default
+			linear-and-Gaussian regression.
+		candidates (pandas.DataFrame): Candidate experiment inputs.
+		measures (Collection[str], optional): Measures to include, by
+			default all those in the meta-model.
+
+	Returns:
+		dict[str, numpy.ndarray]: A (n_candidates, n_candidates)
+		covariance matrix for each measure.
+
+	Raises:
+		ValueError: If the meta-model has no Gaussian process component.
+	"""
+	func = metamodel.function
+	try:
+		gpr = func.regression.gpr
+	except AttributeError:
+		raise ValueError("the planner needs a meta-model with a Gaussian process ('gpr') stage") from None
+	X = func.preprocess_raw_input(candidates, float)
+	result = {}
+	for name, estimator in zip(func.output_sample.columns, gpr.estimators_):
+		if measures is not None and name not in measures:
+			continue
+		# The emat regressor cannot return a covariance, so call the
+		# scikit-learn one, and undo emat's standardization ourselves.
+		_, cov = GaussianProcessRegressor.predict(estimator, X, return_cov=True)
+		cov = cov * np.square(getattr(estimator, 'standardize_Y', None) or 1.0)
+		scale = func.output_sample[name].var()
+		result[name] = cov / scale if scale > 0 else np.zeros_like(cov)
+	return result
+
+
+def pick_batch(covariance, n_picks, weights=None):
+	"""
+	Greedily pick the points with the highest remaining uncertainty.
+
+	After each pick, every covariance matrix is conditioned on an
+	observation at that point.  The posterior variance of a Gaussian
+	process does not depend on the observed value, so this is the exact
+	variance the batch would leave behind once it is run.
+
+	Args:
+		covariance (dict[str, numpy.ndarray]): From `surrogate_covariance`.
+		n_picks (int): Batch size.
+		weights (Mapping[str, float], optional): Relative weight of each
+			measure, by default equal.
+
+	Returns:
+		picks (list[int]): Positions of the picked points.
+		scores (list[float]): The weighted standard deviation at each
+			pick, before it was made.
+	"""
+	covariance = {k: np.array(v, dtype=np.float64, copy=True) for k, v in covariance.items()}
+	if weights is None:
+		weights = {k: 1.0 for k in covariance}
+	picks = []
+	scores = []
+	for _ in range(n_picks):
+		score = sum(
+			weights.get(k, 0.0) * np.sqrt(np.clip(np.diag(cov), 0, None))
+			for k, cov in covariance.items()
+		)
+		if picks:
+			score[picks] = -np.inf
+		p = int(np.argmax(score))
+		picks.append(p)
+		scores.append(float(score[p]))
+		for cov in covariance.values():
+			c_p = cov[:, p].copy()
+			var_p = c_p[p]
+			if var_p > 1e-12:
+				cov -= np.outer(c_p, c_p) / var_p
+	return picks, scores
+
+
+def plan_experiments(
+		model,
+		n_runs,
+		design_name=None,
+		*,
+		n_candidates=2000,
+		measures=None,
+		weights=None,
+		training_designs=None,
+		metamodel=None,
+		random_seed=None,
+		tolerance=None,
+):
+	"""
+	Choose the next batch of core model runs.
+
+	Args:
+		model (CMAP_EMAT_Model): The core model, with its database.
+		n_runs (int): Number of experiments to plan.
+		design_name (str, optional): Name for the planned design in the
+			database, by default 'adaptive', 'adaptive_2', ...
+		n_candidates (int, default 2000): Size of the Latin hypercube
+			pool the batch is picked from.
+		measures (Collection[str], optional): Measures to focus on, by
+			default `PLANNER_MEASURES`.
+		weights (Mapping[str, float], optional): Relative weight of each
+			measure, by default equal.
+		training_designs (str or Collection[str], optional): Designs to
+			fit the meta-model to, by default every design in the scope.
+		metamodel (emat.PythonCoreModel, optional): Use this meta-model
+			instead of fitting a new one.
+		random_seed (int, optional): For the candidate pool and fitting.
+		tolerance (float, optional): If the weighted surrogate standard
+			deviation is below this everywhere in the pool, plan nothing.
+
+	Returns:
+		emat.ExperimentalDesign or None: The planned experiments, already
+		written to the database, with the weighted surrogate standard
+		deviation at each pick in the `planner_score` attribute; or None
+		if the surrogate is already within `tolerance`.
+	"""
+	if measures is None:
+		measures = [i for i in PLANNER_MEASURES if i in model.scope.get_measure_names()]
+	if metamodel is None:
+		experiments = completed_experiments(model.db, model.scope, training_designs, measures)
+		_logger.info(f"fitting planner meta-model to {len(experiments)} completed experiments")
+		metamodel = fit_surrogate(model.db, model.scope, experiments, measures, random_state=random_seed)
+	candidates = design_experiments(
+		model.scope,
+		n_samples=n_candidates,
+		random_seed=random_seed if random_seed is not None else 0,
+	)
+	covariance = surrogate_covariance(metamodel, candidates, measures)
+	picks, scores = pick_batch(covariance, n_runs, weights)
+	if tolerance is not None and scores[0] < tolerance:
+		_logger.info(f"surrogate std {scores[0]:.4f} is below {tolerance}, nothing to plan")
+		return None
+	design = candidates.iloc[picks].copy()
+
+	if design_name is None:
+		existing = set(model.db.read_design_names(model.scope.name))
+		design_name = 'adaptive'
+		n = 2
+		while design_name in existing:
+			design_name = f'adaptive_{n}'
+			n += 1
+	design.index = model.db.write_experiment_parameters(model.scope.name, design_name, design)
+	design.index.name = 'experiment'
+	design = emat.ExperimentalDesign(design)
+	design.design_name = design_name
+	design.planner_score = scores
+	_logger.info(
+		f"planned {design_name}: surrogate std {scores[0]:.4f} at the first pick, "
+		f"{scores[-1]:.4f} at the last"
+	)
+	return design
+
+
+def run_adaptive(model, n_rounds, n_runs, tolerance=None, evaluator=None, **kwargs):
+	"""
+	Alternate planning and running core model experiments.
+
+	Args:
+		model (CMAP_EMAT_Model): The core model, with its database.
+		n_rounds (int): Maximum number of plan-and-run rounds.
+		n_runs (int): Core model runs per round.
+		tolerance (float, optional): Stop once the weighted surrogate
+			standard deviation at the first pick falls below this.
+		evaluator (optional): Passed to `run_experiments`.
+		**kwargs: Passed to `plan_experiments`.
+
+	Returns:
+		list[str]: The names of the designs that were run.
+	"""
+	design_names = []
+	for _ in range(n_rounds):
+		design = plan_experiments(model, n_runs, tolerance=tolerance, **kwargs)
+		if design is None:
+			break
+		model.run_experiments(design, evaluator=evaluator, design_name=design.design_name)
+		design_names.append(design.design_name)
+	return design_names
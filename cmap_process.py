@@ -0,0 +1,61 @@
+""" cmap_process.py - helpers for the processes of core model runs
+
+Core model runs are started as process trees -- a batch file, its Emme and
+Fortran programs, a spawned worker -- that sometimes must be stopped as a
+whole, and the workspaces and queue entries of a run are tagged with the
+process that owns them, so they can be cleaned up once it is gone.  These
+helpers are shared by the queue, the stage runner and the scratch tier.
+"""
+import os
+import signal
+import platform
+import subprocess
+
+
+def worker_is_alive(worker):
+	"""
+	Whether a process is still running.
+
+	Args:
+		worker (str): The process, as '<node>:<pid>', like the workers
+			named by `cmap_queue.worker_name`.
+
+	Returns:
+		bool or None: None if the worker is on another machine, or if
+		this cannot be known here.
+	"""
+	node, _, pid = (worker or "").rpartition(':')
+	if node != platform.node() or not pid.isdigit():
+		return None
+	try:
+		import psutil
+	except ImportError:
+		if os.name == 'nt':
+			return None
+		try:
+			os.kill(int(pid), 0)
+		except ProcessLookupError:
+			return False
+		except PermissionError:
+			pass
+		return True
+	return psutil.pid_exists(int(pid))
+
+
+def kill_process_tree(pid):
+	"""
+	Stop a process and everything it started.
+
+	On Linux, the process should lead a process group; if it does not
+	(yet), only the process itself is stopped.
+	"""
+	if os.name == 'nt':
+		subprocess.run(['TASKKILL', '/F', '/T', '/PID', str(pid)], capture_output=True)
+	else:
+		try:
+			os.killpg(pid, signal.SIGTERM)
+		except ProcessLookupError:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError:
+				pass
@@ -0,0 +1,138 @@
+""" cmap_queue.py - a persistent, prioritized queue of core model experiments
+
+Experiments are queued in a table in the results database, each with a
+priority, and queue workers take the highest priority experiment waiting
+each time they start a run.  A few urgent what-if experiments can be queued
+at a high priority in the middle of a long design and will run next, without
+restarting anything; since the queue lives in the database, it survives
+notebook restarts, and any number of worker processes can share it.
+
+A worker runs each experiment in a child process.  With `preempt` set, it
+watches the queue while the run is in progress, and if a higher priority
+experiment arrives it stops the run and puts it back on the queue.  The core
+model cannot resume part way through, so a preempted run starts again from
+the beginning when it is next claimed, and the model copy it was using is
+removed.
+"""
+import os
+import time
+import pickle
+import shutil
+import platform
+import tempfile
+import multiprocessing
+
+from emat.util.loggers import get_module_logger
+
+from cmap_process import worker_is_alive, kill_process_tree
+
+_logger = get_module_logger(__name__)
+
+
+def worker_name():
+	"""The name queue entries are claimed under by this process."""
+	return f"{platform.node()}:{os.getpid()}"
+
+
+def _workspace_record(pid):
+	"""The file where the run in process `pid` notes its model copies."""
+	return os.path.join(tempfile.gettempdir(), f"cmap-queue-{pid}.workspaces")
+
+
+def _remove_workspaces(pid):
+	"""Remove the model copies noted by a stopped run, and the note."""
+	record = _workspace_record(pid)
+	try:
+		with open(record, 'rt') as f:
+			paths = [line.strip() for line in f if line.strip()]
+	except FileNotFoundError:
+		return
+	for path in dict.fromkeys(paths):
+		if os.path.isdir(path):
+			_logger.info(f"queue: removing the model copy of a stopped run: {path}")
+			shutil.rmtree(path, ignore_errors=True)
+	os.remove(record)
+
+
+def _run_experiment(pickled_model, design):
+	if os.name != 'nt':
+		# lead a process group, so the whole model run can be stopped,
+		# before the slow unpickling of the model
+		os.setsid()
+	model = pickle.loads(pickled_model)
+	# a run of its own, registered now, not one carried over in the pickle
+	model.run_id = None
+	model.workspace_record = _workspace_record(os.getpid())
+	model.run_experiments(design)
+
+
+def run_queue(model, *, preempt=False, poll=5.0, max_runs=None, wait=False, recover=True):
+	"""
+	Run experiments from the queue, highest priority first.
+
+	Args:
+		model (CMAP_EMAT_Model): The core model, with its database.
+		preempt (bool, default False): Stop a run, and queue it again,
+			when a higher priority experiment is queued.
+		poll (float, default 5): Seconds between checks of the queue
+			while a run is in progress, or while waiting.
+		max_runs (int, optional): Stop after this many runs.
+		wait (bool, default False): When the queue is empty, wait for
+			more experiments instead of returning.
+		recover (bool, default True): First queue again any experiment
+			left running by a worker on this machine that has died.
+
+	Returns:
+		dict: The number of experiments 'done', 'failed' and 'preempted'.
+	"""
+	db = model.db
+	worker = worker_name()
+	if recover:
+		orphans = db.requeue_orphaned_experiments(worker_is_alive)
+		if orphans:
+			_logger.warning(f"queued again experiments left running by dead workers: {orphans}")
+	counts = dict(done=0, failed=0, preempted=0)
+	context = multiprocessing.get_context('spawn')
+	n_runs = 0
+	while max_runs is None or n_runs < max_runs:
+		claimed = db.claim_queued_experiment(worker)
+		if claimed is None:
+			if not wait:
+				break
+			time.sleep(poll)
+			continue
+		experiment_id, priority = claimed
+		claimed_at = time.time()
+		n_runs += 1
+		design = db.read_experiment_parameters(model.scope.name)
+		design = design.loc[[experiment_id]]
+		_logger.info(f"queue: running experiment {experiment_id} at priority {priority}")
+		# The model is unpickled by _run_experiment, not by the spawned
+		# process before it starts, so there is no time it cannot be stopped.
+		process = context.Process(target=_run_experiment, args=(pickle.dumps(model), design))
+		process.start()
+		status = None
+		while process.is_alive():
+			process.join(poll)
+			if preempt and process.is_alive():
+				top = db.top_queued_priority()
+				if top is not None and top > priority:
+					_logger.warning(
+						f"queue: preempting experiment {experiment_id} (priority {priority}) "
+						f"for priority {top}"
+					)
+					kill_process_tree(process.pid)
+					process.join()
+					_remove_workspaces(process.pid)
+					status = 'preempted'
+		if status is None:
+			# older results of the experiment do not count
+			completed = db.read_completed_experiment_ids(model.scope.name, since=claimed_at)
+			status = 'done' if experiment_id in completed else 'failed'
+		try:
+			os.remove(_workspace_record(process.pid))
+		except FileNotFoundError:
+			pass
+		db.finish_queued_experiment(experiment_id, status)
+		counts[status] += 1
+	return counts
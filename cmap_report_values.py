@@ -0,0 +1,241 @@
+""" cmap_report_values.py - keep every value parsed from the report files
+
+The mapping parsers of `CMAP_EMAT_Model` each read a whole report file, and
+then pick out the few hundred values that are measures in the scope; the rest
+were thrown away, so a new measure meant parsing every archived run again.
+A `ReportValueStore` keeps every value the mapping parsers read, for every
+run, in a columnar sidecar to the results database:
+
+- `keys.txt` is the dictionary of report keys, one report file and key per
+  line, and the line number is the key's code;
+- `key.i4` and `value.f8` are the columns, one row per value: the code of
+  its key, as a 32-bit integer, and the value, as a 64-bit float;
+- `runs.txt` gives the run id and experiment id of each run stored, and the
+  rows it holds.
+
+Runs are appended under an operating system lock, released if the process
+holding it dies, so every process using the results database can share the
+store.  A run's line in `runs.txt` is written last, and rows
+not covered by it are dropped by the next append, so a store is not
+corrupted by a process that dies while writing.  Reading one key for every
+run touches nothing but the key column, and the values of that key.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from emat.util.loggers import get_module_logger
+
+from cmap_filelock import exclusive_lock
+
+_logger = get_module_logger(__name__)
+
+KEYS_FILE = 'keys.txt'
+RUNS_FILE = 'runs.txt'
+KEY_COLUMN = 'key.i4'
+VALUE_COLUMN = 'value.f8'
+
+
+def _truncate_lines(filename):
+	"""Drop a partly written last line, and return the whole lines."""
+	try:
+		with open(filename, 'rb') as f:
+			content = f.read()
+	except FileNotFoundError:
+		return []
+	end = content.rfind(b'\n') + 1
+	if end < len(content):
+		with open(filename, 'r+b') as f:
+			f.truncate(end)
+	return content[:end].decode('utf-8').splitlines()
+
+
+class ReportValueStore:
+	"""
+	Every value parsed from the report files of each run.
+
+	Args:
+		directory (str): The store directory.
+	"""
+
+	def __init__(self, directory):
+		self.directory = os.path.abspath(directory)
+		os.makedirs(self.directory, exist_ok=True)
+		self._codes = {}
+		self._keys_size = None
+
+	def __repr__(self):
+		return f"<ReportValueStore {self.directory}>"
+
+	@classmethod
+	def from_config(cls, value, database_path=None):
+		"""
+		The store set by the `report_values` configuration key.
+
+		Args:
+			value (bool or str): True for a store beside the results
+				database, or the store directory.
+			database_path (str, optional): The results database file.
+
+		Returns:
+			ReportValueStore or None
+		"""
+		if not value:
+			return None
+		if value is True:
+			if not database_path or database_path == ':memory:':
+				_logger.warning("report_values needs a results database file, or a directory")
+				return None
+			value = f"{os.path.splitext(database_path)[0]}-report-values"
+		return cls(value)
+
+	def _path(self, filename):
+		return os.path.join(self.directory, filename)
+
+	def _runs(self):
+		"""The runs stored, as (run_id, experiment_id, start, count) tuples."""
+		result = []
+		for line in _truncate_lines(self._path(RUNS_FILE)):
+			run_id, experiment_id, start, count = line.split('\t')
+			result.append((run_id, int(experiment_id) if experiment_id else None, int(start), int(count)))
+		return result
+
+	def _key_codes(self):
+		"""The code of each (report file, key), reading new keys from disk."""
+		try:
+			size = os.path.getsize(self._path(KEYS_FILE))
+		except FileNotFoundError:
+			size = 0
+		if size != self._keys_size:
+			self._codes = {
+				tuple(line.split('\t', 1)): code
+				for code, line in enumerate(_truncate_lines(self._path(KEYS_FILE)))
+			}
+			self._keys_size = size
+		return self._codes
+
+	def append(self, run_id, experiment_id, values):
+		"""
+		Store the report values of a run.
+
+		Args:
+			run_id (str or UUID): The run.
+			experiment_id (int or None): The experiment it ran.
+			values (Mapping[str, Mapping[str, float]]): By report file,
+				every key parsed from it and its value.
+
+		Returns:
+			int: The number of values stored.
+		"""
+		items = []
+		for source, mapping in values.items():
+			source = os.path.basename(source)
+			for key, value in mapping.items():
+				try:
+					items.append(((source, str(key).replace('\t', ' ')), float(value)))
+				except (TypeError, ValueError):
+					pass
+		# An append takes moments, and the lock is released if its holder
+		# dies, so wait for it as long as it takes rather than lose the run.
+		with exclusive_lock(self._path('.lock'), timeout=None, poll=0.05):
+			codes = self._key_codes()
+			new = [k for k, _ in items if k not in codes]
+			if new:
+				new = list(dict.fromkeys(new))
+				with open(self._path(KEYS_FILE), 'ab') as f:
+					f.write(''.join(f"{s}\t{k}\n" for s, k in new).encode('utf-8'))
+				codes = self._key_codes()
+			runs = self._runs()
+			start = runs[-1][2] + runs[-1][3] if runs else 0
+			columns = {
+				KEY_COLUMN: np.asarray([codes[k] for k, _ in items], dtype='<i4'),
+				VALUE_COLUMN: np.asarray([v for _, v in items], dtype='<f8'),
+			}
+			for filename, column in columns.items():
+				with open(self._path(filename), 'ab') as f:
+					# Rows of a run that was not finished are dropped.
+					f.truncate(start * column.itemsize)
+					f.write(column.tobytes())
+			with open(self._path(RUNS_FILE), 'ab') as f:
+				f.write(f"{run_id}\t{'' if experiment_id is None else int(experiment_id)}\t{start}\t{len(items)}\n".encode())
+		return len(items)
+
+	def runs(self):
+		"""
+		The runs stored.
+
+		Returns:
+			pandas.DataFrame: The `run_id` and `experiment_id` of each
+			run, with the number of values stored for it.
+		"""
+		return pd.DataFrame(
+			[(r, e, n) for r, e, _, n in self._runs()],
+			columns=['run_id', 'experiment_id', 'values'],
+		)
+
+	def keys(self):
+		"""
+		The report keys stored.
+
+		Returns:
+			pandas.DataFrame: The `source` report file and `key` of each,
+			indexed by code.
+		"""
+		codes = self._key_codes()
+		return pd.DataFrame(
+			sorted(((code, source, key) for (source, key), code in codes.items())),
+			columns=['code', 'source', 'key'],
+		).set_index('code')
+
+	def read(self, keys, source=None):
+		"""
+		Read some report values for every run stored.
+
+		Args:
+			keys (str or Collection[str]): The report keys, as the parsers
+				name them, like 'Chicago.Expressway VMT'.
+			source (str, optional): The report file, like
+				'run_vmt_statistics.rpt', when a key is in several files.
+
+		Returns:
+			pandas.DataFrame: A column for each key, indexed by
+			`experiment` and `run` id, as `read_experiment_measures`.  A
+			run of an experiment stored more than once has its last values.
+
+		Raises:
+			KeyError: If a key is not stored.
+			ValueError: If a key is in several report files and `source`
+				is not given.
+		"""
+		if isinstance(keys, str):
+			keys = [keys]
+		by_key = {}
+		for (s, k), code in self._key_codes().items():
+			if source is None or s == os.path.basename(source):
+				by_key.setdefault(k, []).append((s, code))
+		wanted = {}
+		for k in keys:
+			if k not in by_key:
+				raise KeyError(k)
+			if len(by_key[k]) > 1:
+				raise ValueError(f"{k!r} is in {', '.join(s for s, _ in by_key[k])}, give a source")
+			wanted[by_key[k][0][1]] = k
+		runs = self._runs()
+		n = runs[-1][2] + runs[-1][3] if runs else 0
+		codes = np.fromfile(self._path(KEY_COLUMN), dtype='<i4', count=n) if n else np.empty(0, '<i4')
+		rows = np.flatnonzero(np.isin(codes, list(wanted)))
+		values = np.memmap(self._path(VALUE_COLUMN), dtype='<f8', mode='r', shape=(n,))[rows] if n else []
+		starts = np.asarray([r[2] for r in runs], dtype=np.int64)
+		which = np.searchsorted(starts, rows, side='right') - 1
+		stored = list(dict.fromkeys((e, r) for r, e, _, _ in runs))
+		values = pd.Series(values, index=pd.MultiIndex.from_arrays([
+			[runs[i][1] for i in which],
+			[runs[i][0] for i in which],
+			[wanted[c] for c in codes[rows]],
+		]), dtype=np.float64)
+		table = values.groupby(level=[0, 1, 2], sort=False).last().unstack()
+		table = table.reindex(index=pd.MultiIndex.from_tuples(stored), columns=list(keys))
+		table.index.names = ['experiment', 'run']
+		table.columns.name = None
+		return table
@@ -0,0 +1,182 @@
+""" cmap_retry.py - run a failed experiment again, when the failure is worth it
+
+Each failed core model run is recorded with a class of failure (see
+`cmap_logwatch`), and each class is of one of three kinds:
+
+- 'infrastructure': the machine or its software let the run down -- no Emme
+  license, a full disk, a stage stopped by the watchdog -- and the same
+  experiment may well run to completion if tried again a little later;
+- 'model': the model itself failed on these inputs, and will fail again;
+- 'parse': the model finished, but its results could not be read.
+
+A `RetryPolicy` says which kinds are tried again, how many times, and how
+long to wait first, the wait growing with each attempt.  A retry reuses the
+workspace already prepared for the failed run when it is still intact: files
+written by the failed run are removed, files it changed are copied again from
+the source model, and the rest of the copy is left alone, instead of copying
+the whole model over again.
+"""
+import os
+import shutil
+
+from emat.util.loggers import get_module_logger
+
+_logger = get_module_logger(__name__)
+
+# The kind of each class of failure.  Classes not listed are 'model' failures.
+FAILURE_KINDS = {
+	'emme_license': 'infrastructure',
+	'disk_full': 'infrastructure',
+	'python_not_found': 'infrastructure',
+	'timeout': 'infrastructure',
+	'emme_errors': 'infrastructure',
+	'killed': 'infrastructure',
+	'missing_inputs': 'model',
+	'fortran_runtime': 'model',
+	'python_exception': 'model',
+	'exit_code': 'model',
+	'no_success': 'model',
+	'parse_error': 'parse',
+}
+
+# How emat's `run_model` describes a run that failed after `run` returned,
+# in `comment_on_run`, and the class of failure that is.
+_COMMENT_CLASSES = [
+	("NON-SUCCESSFUL EXPERIMENT", 'no_success'),
+	("KILLED EXPERIMENT", 'killed'),
+	("PROBLEM IN EXPERIMENT", 'parse_error'),
+	("FAILED EXPERIMENT", 'exit_code'),
+]
+
+
+def failure_kind(failure_class):
+	"""The kind of a class of failure: 'infrastructure', 'model' or 'parse'."""
+	return FAILURE_KINDS.get(failure_class, 'model')
+
+
+def comment_failure_class(comment):
+	"""The class of failure described by emat's `comment_on_run`, or None."""
+	for prefix, failure_class in _COMMENT_CLASSES:
+		if (comment or "").startswith(prefix):
+			return failure_class
+	return None
+
+
+class RetryPolicy:
+	"""
+	Which failed runs are tried again, and when.
+
+	Args:
+		max_attempts (int, default 3): The most times one experiment is
+			run, including the first.
+		retry (Collection[str], default ('infrastructure',)): The kinds of
+			failure, or particular classes of failure, that are retried.
+		backoff (float, default 60): Seconds to wait before the first retry.
+		factor (float, default 2): Each later wait is this much longer.
+		max_backoff (float, default 1800): The longest wait, in seconds.
+	"""
+
+	def __init__(self, max_attempts=3, retry=('infrastructure',), backoff=60, factor=2, max_backoff=1800):
+		self.max_attempts = int(max_attempts)
+		self.retry = set(retry)
+		self.backoff = backoff
+		self.factor = factor
+		self.max_backoff = max_backoff
+
+	def __repr__(self):
+		return f"<RetryPolicy {self.max_attempts} attempts, retry {sorted(self.retry)}>"
+
+	@classmethod
+	def from_config(cls, value):
+		"""
+		The policy set by the `retry_policy` configuration key.
+
+		Args:
+			value (bool, int or dict): True for the default policy, a
+				number of attempts, or the arguments of `RetryPolicy`.
+
+		Returns:
+			RetryPolicy or None: None when failed runs are not retried.
+		"""
+		if not value:
+			return None
+		if value is True:
+			return cls()
+		if isinstance(value, int):
+			return cls(max_attempts=value)
+		return cls(**value)
+
+	def should_retry(self, failure_class, attempt):
+		"""Whether to run again after `attempt` attempts ended in this failure."""
+		if attempt >= self.max_attempts:
+			return False
+		return failure_class in self.retry or failure_kind(failure_class) in self.retry
+
+	def delay(self, attempt):
+		"""Seconds to wait after `attempt` attempts, before the next one."""
+		return min(self.backoff * self.factor ** (attempt - 1), self.max_backoff)
+
+
+def workspace_manifest(workspace):
+	"""
+	The size and modification time of every file in a workspace.
+
+	Returns:
+		dict[str, tuple[int, int]]: Keyed by path relative to the workspace.
+	"""
+	result = {}
+	for dirpath, _, filenames in os.walk(workspace, followlinks=True):
+		for filename in filenames:
+			path = os.path.join(dirpath, filename)
+			stat = os.stat(path)
+			result[os.path.relpath(path, workspace)] = (stat.st_size, stat.st_mtime_ns)
+	return result
+
+
+def restore_workspace(workspace, source, manifest):
+	"""
+	Put a workspace back as it was before a failed run.
+
+	Files that are not in the manifest are removed, and files that are
+	missing or have changed are copied again from the source model, or
+	the first of the source directories that has them.
+	Changed files that are not in the source are left as they are; these
+	are the inputs `setup` writes, and it writes them again.
+
+	Args:
+		workspace (str): The model copy the failed run used.
+		source (str or list[str]): The model it was copied from, or the
+			directories it was made from, such as a land use overlay and
+			the base model.
+		manifest (dict): From `workspace_manifest`, taken when the
+			workspace was prepared.
+
+	Returns:
+		bool: Whether the workspace could be restored; if not, it is not
+		intact and should be prepared again from scratch.
+	"""
+	if not manifest or not os.path.isdir(workspace):
+		return False
+	sources = [source] if isinstance(source, str) else list(source)
+	current = workspace_manifest(workspace)
+	removed = copied = 0
+	try:
+		for relpath in current.keys() - manifest.keys():
+			os.remove(os.path.join(workspace, relpath))
+			removed += 1
+		for relpath, stat in manifest.items():
+			if current.get(relpath) == stat:
+				continue
+			original = next(
+				(os.path.join(s, relpath) for s in sources if os.path.isfile(os.path.join(s, relpath))), None,
+			)
+			if original is not None:
+				shutil.copy2(original, os.path.join(workspace, relpath))
+				copied += 1
+			elif relpath not in current:
+				return False
+	except OSError as err:
+		_logger.warning(f"could not restore workspace {workspace}: {err}")
+		return False
+	_logger.info(f"restored workspace {workspace}: removed {removed} files, copied {copied} again")
+	return True
@@ -0,0 +1,226 @@
+""" cmap_scratch.py - put the busiest parts of an ephemeral model copy on fast storage
+
+An ephemeral model copy is made in a temporary directory, wherever TMP points,
+and all of Emme's intermediate reading and writing goes to that same disk.
+Most of that traffic is to a few places: the emmebank, the `emmemat` matrix
+files and the Fortran intermediates.  A `ScratchTier` is a directory on fast
+storage -- a RAM disk or a local SSD -- where these hot paths of each
+ephemeral copy are put instead, linked into the copy so the model finds them
+where it expects; the cold inputs stay in the temporary directory.
+
+The scratch tier has a capacity, shared by every run on the machine that uses
+the same directory.  A run that would not fit is simply not staged, and runs
+on ordinary storage.  Nothing is copied back from the scratch tier: the
+archive step reads the outputs it keeps through the links, and the rest is
+discarded with the run.
+"""
+import os
+import uuid
+import shutil
+import weakref
+import platform
+
+from emat.util.loggers import get_module_logger
+
+from cmap_filelock import exclusive_lock
+from cmap_process import worker_is_alive
+
+_logger = get_module_logger(__name__)
+
+# The emmebank, the matrices and the Fortran intermediates.
+HOT_PATHS = ('Database/emmebank', 'Database/emmemat', 'Database/tg/fortran')
+
+_RESERVATION = '_reserved'
+
+
+def path_size(path):
+	"""The size in bytes of a file, or of all the files in a directory."""
+	if os.path.isfile(path):
+		return os.path.getsize(path)
+	total = 0
+	for dirpath, _, filenames in os.walk(path):
+		for filename in filenames:
+			total += os.path.getsize(os.path.join(dirpath, filename))
+	return total
+
+
+def _link(target, link):
+	"""Link `link` to `target`; directories are junctions on Windows."""
+	if os.name == 'nt' and os.path.isdir(target):
+		import _winapi
+		_winapi.CreateJunction(target, link)
+	else:
+		# on Windows, a link to a file needs the privilege to create
+		# symbolic links, or developer mode
+		os.symlink(target, link, target_is_directory=os.path.isdir(target))
+
+
+def _unlink(link):
+	if os.name == 'nt' and os.path.isdir(link):
+		os.rmdir(link)  # a junction
+	else:
+		os.unlink(link)
+
+
+class ScratchWorkspace:
+	"""
+	The hot paths of one model copy, staged on a scratch tier.
+
+	The staged files are removed by `release`, or when this is
+	garbage collected.
+	"""
+
+	def __init__(self, path, staged, reserved):
+		self.path = path
+		self.staged = staged
+		self.reserved = reserved
+		self._finalizer = weakref.finalize(self, shutil.rmtree, path, ignore_errors=True)
+
+	def __repr__(self):
+		return f"<ScratchWorkspace {self.path}, {len(self.staged)} paths>"
+
+	def __getstate__(self):
+		# A copy sent to another process does not own the files.
+		state = self.__dict__.copy()
+		state['_finalizer'] = None
+		return state
+
+	def release(self):
+		"""Remove the staged files and give back their space."""
+		if self._finalizer is not None:
+			self._finalizer()
+
+
+class ScratchTier:
+	"""
+	A directory on fast storage for the hot paths of ephemeral model copies.
+
+	Args:
+		directory (str): The scratch directory.  Every run sharing it
+			shares its capacity.
+		capacity_gigabytes (float, optional): The most space the runs
+			staged here may take together.  Runs are also only staged
+			while the disk has room for them.
+		paths (Collection[str], optional): The hot paths, relative to the
+			model directory, default `HOT_PATHS`.
+		growth (float, default 1.25): Space is reserved for the hot paths
+			of the source model times this, as the run adds matrices and
+			intermediates.
+		reserve_gigabytes (float, default 1): Space always left free on
+			the disk.
+	"""
+
+	def __init__(self, directory, capacity_gigabytes=None, paths=HOT_PATHS, growth=1.25, reserve_gigabytes=1):
+		self.directory = directory
+		self.capacity = None if capacity_gigabytes is None else int(capacity_gigabytes * 2**30)
+		self.paths = list(paths)
+		self.growth = growth
+		self.reserve = int(reserve_gigabytes * 2**30)
+		os.makedirs(self.directory, exist_ok=True)
+
+	def __repr__(self):
+		return f"<ScratchTier {self.directory}>"
+
+	@classmethod
+	def from_config(cls, value):
+		"""
+		The scratch tier set by the `scratch` configuration key.
+
+		Args:
+			value (str or dict): The scratch directory, or the arguments
+				of `ScratchTier`.
+
+		Returns:
+			ScratchTier or None
+		"""
+		if not value:
+			return None
+		if isinstance(value, str):
+			return cls(value)
+		return cls(**value)
+
+	def _workspaces(self):
+		"""The staged workspaces here, as {path: bytes reserved}, clearing those of dead runs."""
+		result = {}
+		for name in os.listdir(self.directory):
+			path = os.path.join(self.directory, name)
+			pid = name.partition('-')[0]
+			if not os.path.isdir(path) or not pid.isdigit():
+				continue
+			if worker_is_alive(f"{platform.node()}:{pid}") is False:
+				_logger.info(f"removing scratch workspace of a dead run: {path}")
+				shutil.rmtree(path, ignore_errors=True)
+				continue
+			try:
+				with open(os.path.join(path, _RESERVATION), 'rt') as f:
+					result[path] = int(f.read())
+			except (OSError, ValueError):
+				result[path] = path_size(path)
+		return result
+
+	def used(self):
+		"""The space reserved by the runs staged here, in bytes."""
+		return sum(self._workspaces().values())
+
+	def stage(self, source, workspace):
+		"""
+		Put the hot paths of a new model copy on the scratch tier.
+
+		Call this before copying the rest of the model into `workspace`;
+		the hot paths are copied from `source` to the scratch tier, and
+		linked into `workspace`.
+
+		Args:
+			source (str): The source model directory.
+			workspace (str): The new, empty, model copy.
+
+		Returns:
+			ScratchWorkspace or None: None if the hot paths do not fit.
+		"""
+		hot = [p for p in self.paths if os.path.exists(os.path.join(source, p))]
+		needed = int(sum(path_size(os.path.join(source, p)) for p in hot) * self.growth)
+		with exclusive_lock(os.path.join(self.directory, '.lock'), timeout=None, poll=0.05):
+			available = shutil.disk_usage(self.directory).free - self.reserve
+			if self.capacity is not None:
+				available = min(available, self.capacity - self.used())
+			if needed > available:
+				_logger.info(
+					f"not staging on {self.directory}: need {needed / 2**20:.0f} MB, "
+					f"{max(available, 0) / 2**20:.0f} MB available"
+				)
+				return None
+			path = os.path.join(self.directory, f"{os.getpid()}-{uuid.uuid4().hex[:8]}")
+			os.makedirs(path)
+			with open(os.path.join(path, _RESERVATION), 'wt') as f:
+				f.write(str(needed))
+
+		result = ScratchWorkspace(path, [], needed)
+		for relpath in hot:
+			original = os.path.join(source, relpath)
+			staged = os.path.join(path, relpath)
+			link = os.path.join(workspace, relpath)
+			os.makedirs(os.path.dirname(staged), exist_ok=True)
+			os.makedirs(os.path.dirname(link), exist_ok=True)
+			try:
+				if os.path.isdir(original):
+					shutil.copytree(original, staged)
+				else:
+					shutil.copy2(original, staged)
+			except OSError as err:
+				_logger.warning(f"cannot stage on {self.directory}, using ordinary storage: {err}")
+				for done in result.staged:
+					_unlink(os.path.join(workspace, done))
+				result.release()
+				return None
+			try:
+				_link(staged, link)
+			except OSError as err:
+				_logger.warning(f"cannot link {link} to scratch, leaving it on ordinary storage: {err}")
+				if os.path.isdir(staged):
+					shutil.rmtree(staged, ignore_errors=True)
+				else:
+					os.remove(staged)
+				continue
+			result.staged.append(relpath)
+		_logger.info(f"staged {', '.join(result.staged) or 'nothing'} on {path}")
+		return result
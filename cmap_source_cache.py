@@ -0,0 +1,241 @@
+""" cmap_source_cache.py - a local read-through cache of the source models
+
+The source models usually live on a network share, and every `setup` copies a
+whole model tree across the network.  A `SourceCache` keeps a local copy of
+each source model directory instead, shared by every process on the machine
+that uses the same cache directory, and model copies are made from that.
+
+Each cached copy has a manifest: the size and modification time of every file
+on the share, as of the last refresh.  When the cache is used it lists the
+share again (at most every `check_seconds`), and copies only the files that
+are new or have changed since, and removes those that are gone, so the
+network transfer happens once per version of the model rather than once per
+experiment.  If the share cannot be reached, the cached copy is used as it is.
+
+A process copying from a cached copy holds it with `reading`, and a refresh
+that would change the copy waits for every such reader to finish first, so a
+model copy never mixes two versions of the source.  Each reader holds a lock
+on a file of its own, so one that dies does not hold up the refresh.
+"""
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import contextlib
+
+from emat.util.loggers import get_module_logger
+
+from cmap_filelock import exclusive_lock, try_lock, unlock
+
+_logger = get_module_logger(__name__)
+
+
+def source_manifest(directory):
+	"""
+	The size and modification time of every file in a directory.
+
+	Returns:
+		dict[str, list[int]]: Keyed by path relative to the directory,
+		with '/' separators.
+	"""
+	result = {}
+	for dirpath, _, filenames in os.walk(directory):
+		for filename in filenames:
+			path = os.path.join(dirpath, filename)
+			stat = os.stat(path)
+			relpath = os.path.relpath(path, directory).replace(os.sep, '/')
+			result[relpath] = [stat.st_size, stat.st_mtime_ns]
+	return result
+
+
+def _is_cached_copy(directory):
+	return os.path.isfile(os.path.normpath(directory) + '.manifest.json')
+
+
+@contextlib.contextmanager
+def reading(*directories):
+	"""
+	Hold cached copies unchanged while copying from them.
+
+	A refresh of a cached copy waits until no process is reading it.
+	Directories that are not cached copies, or are None, are passed over,
+	so this can wrap any copy from the source models.
+
+	Args:
+		*directories (str): The directories being read.
+	"""
+	held = []
+	try:
+		for directory in sorted({os.path.normpath(d) for d in directories if d is not None}):
+			if not _is_cached_copy(directory):
+				continue
+			readers = directory + '.readers'
+			# Readers join while no refresh is in progress.
+			with exclusive_lock(directory + '.lock'):
+				os.makedirs(readers, exist_ok=True)
+				path = os.path.join(readers, f"{os.getpid()}-{uuid.uuid4().hex[:8]}")
+				fd = os.open(path, os.O_CREAT | os.O_RDWR)
+				try_lock(fd)
+			held.append((fd, path))
+		yield
+	finally:
+		for fd, path in held:
+			unlock(fd)
+			os.close(fd)
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+
+def _wait_for_readers(directory, poll=1.0):
+	"""Wait until no process is reading a cached copy; call holding its lock."""
+	readers = directory + '.readers'
+	waited = False
+	while True:
+		try:
+			names = os.listdir(readers)
+		except FileNotFoundError:
+			return
+		busy = 0
+		for name in names:
+			path = os.path.join(readers, name)
+			try:
+				fd = os.open(path, os.O_RDWR)
+			except OSError:
+				continue
+			try:
+				free = try_lock(fd)
+				if free:
+					unlock(fd)
+			finally:
+				os.close(fd)
+			if free:
+				# left by a reader that died
+				try:
+					os.remove(path)
+				except OSError:
+					pass
+			else:
+				busy += 1
+		if not busy:
+			return
+		if not waited:
+			_logger.info(f"waiting for {busy} processes copying from {directory} before refreshing it")
+			waited = True
+		time.sleep(poll)
+
+
+class SourceCache:
+	"""
+	A local cache of source model directories.
+
+	Args:
+		directory (str): The cache directory, on local disk.  Processes
+			share the cache by using the same directory.
+		check_seconds (float, default 300): How long a cached copy is
+			used before the share is listed again for changes.
+	"""
+
+	def __init__(self, directory, check_seconds=300):
+		self.directory = os.path.abspath(directory)
+		self.check_seconds = check_seconds
+		os.makedirs(self.directory, exist_ok=True)
+
+	def __repr__(self):
+		return f"<SourceCache {self.directory}>"
+
+	@classmethod
+	def from_config(cls, value):
+		"""
+		The cache set by the `source_cache` configuration key.
+
+		Args:
+			value (str or dict): The cache directory, or the arguments of
+				`SourceCache`.
+
+		Returns:
+			SourceCache or None
+		"""
+		if not value:
+			return None
+		if isinstance(value, str):
+			return cls(value)
+		return cls(**value)
+
+	def path(self, source):
+		"""The cached copy of a source directory."""
+		source = os.path.normpath(os.path.abspath(source))
+		key = hashlib.sha1(os.path.normcase(source).encode()).hexdigest()[:8]
+		return os.path.join(self.directory, f"{os.path.basename(source)}-{key}")
+
+	def _read_manifest(self, local):
+		try:
+			with open(local + '.manifest.json', 'rt') as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return None
+
+	def _write_manifest(self, local, manifest):
+		with open(local + '.manifest.json.partial', 'wt') as f:
+			json.dump(manifest, f)
+		os.replace(local + '.manifest.json.partial', local + '.manifest.json')
+
+	def refresh(self, source):
+		"""
+		Bring the cached copy of a source directory up to date.
+
+		Changes wait until no process is reading the cached copy; copy
+		from it inside `reading`.
+
+		Args:
+			source (str): The source directory, on the share.
+
+		Returns:
+			str: The cached copy, to read from instead.
+		"""
+		local = self.path(source)
+		with exclusive_lock(local + '.lock'):
+			stored = self._read_manifest(local)
+			if stored is not None and time.time() - stored['checked'] < self.check_seconds:
+				return local
+			t = time.time()
+			try:
+				current = source_manifest(source)
+				if not current and not os.path.isdir(source):
+					raise FileNotFoundError(source)
+			except OSError as err:
+				if stored is None:
+					raise
+				_logger.warning(f"cannot list {source}, using the cached copy as it is: {err}")
+				return local
+			files = {} if stored is None else stored['files']
+			if files != current:
+				_wait_for_readers(local)
+			copied = removed = 0
+			for relpath in files.keys() - current.keys():
+				target = os.path.join(local, relpath)
+				if os.path.exists(target):
+					os.remove(target)
+				removed += 1
+			for relpath, stat in current.items():
+				target = os.path.join(local, relpath)
+				try:
+					intact = files.get(relpath) == stat and os.path.getsize(target) == stat[0]
+				except OSError:
+					intact = False
+				if intact:
+					continue
+				os.makedirs(os.path.dirname(target), exist_ok=True)
+				shutil.copy2(os.path.join(source, relpath), target + '.partial')
+				os.replace(target + '.partial', target)
+				copied += 1
+			self._write_manifest(local, dict(source=source, checked=time.time(), files=current))
+			if copied or removed:
+				_logger.info(
+					f"refreshed cache of {source}: copied {copied} files, removed {removed} "
+					f"({time.time() - t:.0f}s)"
+				)
+		return local
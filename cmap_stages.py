@@ -0,0 +1,409 @@
+""" cmap_stages.py - run the core model stage by stage from Python
+
+`EMAT_Submit_Full_Regional_Model.bat` starts the parallel PreDist, ModeChoice
+and VehOcc executables with `start` and then waits for them by polling
+`tasklist | findstr` every 20 seconds, which keeps a core busy for every run
+waiting on them and scans the whole process table, and it ignores the exit
+code of every step.  Here the same model run is written down as a list of
+stages, and each stage's commands are started directly and waited on by their
+process handles: a stage's parallel commands run together and the stage ends
+when they have all exited, each stage has a timeout, and a nonzero exit code
+stops the run.
+
+Programs are looked up by name in a mapping (`emme`, `python`, `PreDist`,
+`ModeChoice`, `VehOcc`), so the whole sequence can be exercised on any
+machine with stub executables in their place.
+"""
+import os
+import glob
+import time
+import shutil
+import subprocess
+
+from emat.util.loggers import get_module_logger
+
+from cmap_process import kill_process_tree
+
+_logger = get_module_logger(__name__)
+
+# Log files from the parallel Fortran stages, moved into report/iter_<n>.
+_PREDIST_LOGS = ['HW{counter}_PREDIST_LOG.TXT', 'HO{counter}_PREDIST_LOG.TXT', 'NH{counter}_PREDIST_LOG.TXT']
+_MC_LOGS = ['HWlow{counter}_MC_LOG.TXT', 'HWhigh{counter}_MC_LOG.TXT', 'HO{counter}_MC_LOG.TXT', 'NH{counter}_MC_LOG.TXT']
+_VEHOCC_LOGS = [f'HVOCC_LOGOUT{i}_iter{{counter}}.TXT' for i in range(1, 5)]
+
+# Files the batch file checks for before it starts.
+REQUIRED_FILES = [
+	*[f'data/tod_factors.p{i}' for i in range(1, 9)],
+	*[f'data/tod_occ.p{i}' for i in range(1, 9)],
+	'data/directional.splits',
+	*[f'{p}_{k}.TXT' for p in ['MCHO', 'MCHW', 'MCNH', 'PDHO', 'PDHW', 'PDNH'] for k in ['DISTR', 'M01', 'M023']],
+	'MCHW_CBDPARK.TXT',
+	'MCHW_HH.TXT',
+	'PDHW_CBDPARK.TXT',
+	'HH_VTYPE_TRIPS_IN.TXT',
+	'TG_HHENUM_OUTPUT.TXT',
+]
+
+
+class Stage:
+	"""
+	One step of a core model run.
+
+	Args:
+		name (str): The stage name, used in logs and in the timestamp file.
+		commands (list[list[str]]): Command lines to run, all at once.
+			The first item of each names a program, and every item is
+			formatted with the run settings (`scenario`, `counter`, `prev`,
+			`iter1`, `iter2`), so `'{counter}'` is the global iteration.
+		timeout (float, optional): Seconds the stage may take.
+		when (callable, optional): Called with the global iteration; the
+			stage is skipped when it returns False.
+		output (str, optional): File in the Database directory to which
+			the commands' output is appended.  Output of commands without
+			one goes to `stages.log`.
+		logs (list[str], optional): Files the commands write, moved to
+			`report/iter_<counter>` once the stage is done.
+		check (bool, default True): Stop the run on a nonzero exit code.
+	"""
+
+	def __init__(self, name, commands, timeout=None, when=None, output=None, logs=(), check=True):
+		self.name = name
+		self.commands = [list(c) for c in commands]
+		self.timeout = timeout
+		self.when = when
+		self.output = output
+		self.logs = list(logs)
+		self.check = check
+
+	def __repr__(self):
+		return f"<Stage {self.name}: {len(self.commands)} command(s)>"
+
+
+def _emme(macro, *args, output='blog.txt', **kwargs):
+	return Stage(
+		kwargs.pop('name'),
+		[['emme', '-ng', '000', '-m', macro, *args]],
+		output=output,
+		**kwargs,
+	)
+
+
+# Run once, before the global iterations.
+PREPARATION_STAGES = [
+	_emme(r'useful_macros\cleanup.for.rerun', '{scenario}', '2', name='cleanup', output='cleanup.rpt', timeout=3600),
+	_emme(r'prep_macros\initialize_EMAT_variables.mac', '{scenario}', name='emat_init', timeout=3600),
+	_emme(r'prep_macros\free.skim.mac', '{scenario}', '2', name='highway_skims', timeout=3 * 3600),
+]
+
+# Run in each global iteration, 0 to `global_loops`.
+ITERATION_STAGES = [
+	_emme(
+		r'macros\call\skim.transit.all', '{scenario}', '{counter}', '{python}',
+		name='transit_skims', timeout=4 * 3600,
+	),
+	_emme(r'macros\init_HOVsim_databk.mac', '{scenario}', name='prepare_emmebank', timeout=3600),
+	Stage(
+		'update_namelist', [['python', 'update_Namelist.py', '{iter1}']],
+		when=lambda counter: counter == 0, timeout=600,
+	),
+	Stage(
+		'update_namelist', [['python', 'update_Namelist.py', '{iter2}']],
+		when=lambda counter: counter == 4, timeout=600,
+	),
+	Stage(
+		'pre_distribution',
+		[
+			['PreDist', 'PDHW_NAMELIST.TXT', 'HW{counter}_PREDIST_LOG.TXT', 'hwlow_seeds.csv'],
+			['PreDist', 'PDHO_NAMELIST.TXT', 'HO{counter}_PREDIST_LOG.TXT', 'ho_seeds.csv'],
+			['PreDist', 'PDNH_NAMELIST.TXT', 'NH{counter}_PREDIST_LOG.TXT', 'nh_seeds.csv'],
+		],
+		when=lambda counter: counter <= 2, logs=_PREDIST_LOGS, timeout=4 * 3600,
+	),
+	_emme(
+		r'macros\four_purpose_IOM.mac', '{scenario}',
+		name='distribution', when=lambda counter: counter <= 2, timeout=4 * 3600,
+	),
+	Stage(
+		'mode_choice',
+		[
+			['ModeChoice', 'MC_HWlow_NAMELIST.TXT', 'HWlow{counter}_MC_LOG.TXT', 'hwlow_seeds.csv'],
+			['ModeChoice', 'MC_HWhigh_NAMELIST.TXT', 'HWhigh{counter}_MC_LOG.TXT', 'hwhigh_seeds.csv'],
+			['ModeChoice', 'MC_HO_NAMELIST.TXT', 'HO{counter}_MC_LOG.TXT', 'ho_seeds.csv'],
+			['ModeChoice', 'MC_NH_NAMELIST.TXT', 'NH{counter}_MC_LOG.TXT', 'nh_seeds.csv'],
+		],
+		logs=_MC_LOGS, timeout=6 * 3600,
+	),
+	_emme(r'macros\nonwork_vehocc_setup.mac', '1', name='vehicle_occupancy_setup', timeout=3600),
+	Stage(
+		'vehicle_occupancy',
+		[['VehOcc', f'VEHOCC_NAMELIST_{i}.TXT', f'HVOCC_LOGOUT{i}_iter{{counter}}.TXT'] for i in range(1, 5)],
+		logs=_VEHOCC_LOGS, timeout=4 * 3600,
+	),
+	_emme(r'macros\nonwork_vehocc_setup.mac', '2', name='vehicle_occupancy_finish', timeout=3600),
+	_emme(
+		r'macros\toll_mode_choice.mac', '{scenario}', '{counter}',
+		name='toll_mode_choice', when=lambda counter: counter >= 1, timeout=4 * 3600,
+	),
+	_emme(r'macros\iter.master7c.mac', '{scenario}', name='assignment', timeout=8 * 3600),
+]
+
+# Run once, after the global iterations.
+FINAL_STAGES = [
+	_emme(r'macros\Daily.Total.Asmt5I_7c.mac', '{scenario}', name='daily_accumulation', timeout=4 * 3600),
+	_emme(r'extra_macros\final_run_statistics2.mac', '{scenario}', name='final_run_statistics', timeout=3600),
+	_emme(r'extra_macros\run_vmt_statistics2.mac', '{scenario}', name='vmt_statistics', timeout=3600),
+	_emme(r'extra_macros\transit_stats.v3.mac', '{scenario}', name='transit_statistics', timeout=3600),
+	_emme(r'extra_macros\C1_expressways.txt', name='expressways_summary', timeout=3600),
+	_emme(r'extra_macros\export_times.txt', name='corridor_times', timeout=3600),
+	_emme(r'extra_macros\D8_ej_final_run_statistics.mac', '{scenario}', name='ej_statistics', timeout=3600),
+	_emme(r'extra_macros\run_vht_statistics.mac', '{scenario}', name='vht_statistics', timeout=3600),
+]
+
+
+def find_emme_python():
+	"""
+	Find the Python 2.7 that the model's Emme macros call, as the batch file does.
+
+	Returns:
+		str or None
+	"""
+	if os.name != 'nt':
+		return None
+	for drive in 'CDE':
+		for pattern in [rf"{drive}:\Python27\**\*python.exe", rf"{drive}:\Program Files\INRO\**\*python.exe"]:
+			found = sorted(glob.glob(pattern, recursive=True))
+			if found:
+				return found[0]
+	return None
+
+
+def default_programs(database_dir):
+	"""
+	The program run for each program name in the stage commands.
+
+	Args:
+		database_dir (str): The model's Database directory, holding the
+			Fortran executables.
+
+	Returns:
+		dict
+	"""
+	return {
+		'emme': shutil.which('emme') or 'emme',
+		'python': find_emme_python() or 'python',
+		'PreDist': os.path.join(database_dir, 'PreDist_RnSeed.exe'),
+		'ModeChoice': os.path.join(database_dir, 'ModeChoice_RnSeed.exe'),
+		'VehOcc': os.path.join(database_dir, 'VehOcc.exe'),
+	}
+
+
+def _launch(command, cwd, output):
+	kwargs = {}
+	if os.name == 'nt':
+		kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+	else:
+		# lead a process group, so the command and its children can be stopped
+		kwargs['start_new_session'] = True
+	return subprocess.Popen(
+		command, cwd=cwd, stdin=subprocess.DEVNULL, stdout=output, stderr=subprocess.STDOUT, **kwargs,
+	)
+
+
+def _stop(processes):
+	for process in processes:
+		if process.poll() is None:
+			kill_process_tree(process.pid)
+	for process in processes:
+		try:
+			process.wait(timeout=30)
+		except subprocess.TimeoutExpired:
+			process.kill()
+			process.wait()
+
+
+def run_stage(stage, database_dir, settings, programs, *, watch=None, poll=15.0, budget=None):
+	"""
+	Run the commands of one stage together and wait for all of them.
+
+	Args:
+		stage (Stage): The stage.
+		database_dir (str): The model's Database directory.
+		settings (dict): Values to format into the commands.
+		programs (dict): The program to run for each program name.
+		watch (callable, optional): Called every `poll` seconds while the
+			stage runs; if it returns a message, the stage is stopped and
+			the run fails with that message.
+		poll (float, default 15): Seconds between calls to `watch`.
+		budget (cmap_budget.CPUBudget, optional): Each command takes a
+			slot from this budget to run, waiting for one if need be,
+			and gives it back when it exits.
+
+	Raises:
+		subprocess.TimeoutExpired: If the stage runs over its timeout.
+		subprocess.CalledProcessError: If a command exits with a nonzero
+			code, and the stage is checked.
+		RuntimeError: If `watch` stops the stage.
+	"""
+	commands = [
+		[programs.get(c[0], c[0]), *(str(a).format(**settings) for a in c[1:])]
+		for c in stage.commands
+	]
+	output_name = stage.output or 'stages.log'
+	deadline = None if stage.timeout is None else time.monotonic() + stage.timeout
+	processes = []
+	slots = {}
+
+	def give_back():
+		for process in processes:
+			if process.pid in slots and process.poll() is not None:
+				budget.release(slots.pop(process.pid))
+
+	with open(os.path.join(database_dir, output_name), 'ab') as output:
+		try:
+			for command in commands:
+				_logger.debug(f"stage {stage.name}: {subprocess.list2cmdline(command)}")
+				if budget is None:
+					processes.append(_launch(command, database_dir, output))
+					continue
+				wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+				slot = budget.acquire(timeout=wait, while_waiting=give_back)
+				if slot is None:
+					raise subprocess.TimeoutExpired(command, stage.timeout)
+				try:
+					process = _launch(command, database_dir, output)
+				except BaseException:
+					budget.release(slot)
+					raise
+				processes.append(process)
+				slots[process.pid] = slot
+				budget.assign(slot, process.pid)
+			for process in processes:
+				while True:
+					wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+					if watch is not None:
+						wait = poll if wait is None else min(wait, poll)
+					try:
+						process.wait(timeout=wait)
+						break
+					except subprocess.TimeoutExpired:
+						if deadline is not None and time.monotonic() >= deadline:
+							raise subprocess.TimeoutExpired(process.args, stage.timeout) from None
+						problem = watch()
+						if problem:
+							raise RuntimeError(f"stage {stage.name} stopped: {problem}")
+				if budget is not None:
+					give_back()
+		finally:
+			_stop(processes)
+			for slot in slots.values():
+				budget.release(slot)
+	if stage.check:
+		for process in processes:
+			if process.returncode:
+				raise subprocess.CalledProcessError(process.returncode, process.args)
+	report_dir = os.path.join(database_dir, 'report', f"iter_{settings['counter']}")
+	for log in stage.logs:
+		log = os.path.join(database_dir, log.format(**settings))
+		if os.path.exists(log):
+			os.makedirs(report_dir, exist_ok=True)
+			shutil.move(log, os.path.join(report_dir, os.path.basename(log)))
+
+
+def run_stages(
+		database_dir,
+		global_loops,
+		*,
+		programs=None,
+		scenario=700,
+		iter1=100,
+		iter2=100,
+		timeouts=None,
+		keep_paths=False,
+		watch=None,
+		poll=15.0,
+		budget=None,
+		converged=None,
+):
+	"""
+	Run the full regional model, as the batch file does.
+
+	Args:
+		database_dir (str): The Database directory of a model copy that
+			`setup` has prepared.
+		global_loops (int): The last global iteration, as in the
+			`global_loops` parameter.
+		programs (dict, optional): The program to run for each program
+			name, updating `default_programs`.
+		scenario (int, default 700): The 3-digit Emme scenario number.
+		iter1, iter2 (int, default 100): Pre-distribution and mode choice
+			simulations in global iterations 0-3, and in iteration 4.
+		timeouts (dict, optional): Seconds allowed for stages, by name,
+			in place of their own timeouts.
+		keep_paths (bool, default False): Keep the path files of each
+			global iteration's assignment.
+		watch (callable, optional): Checked while each stage runs, see
+			`run_stage`.
+		poll (float, default 15): Seconds between calls to `watch`.
+		budget (cmap_budget.CPUBudget, optional): The CPU slots shared by
+			the programs of every model run on this machine.
+		converged (callable, optional): Called with the global iteration
+			after each one before `global_loops`; if it returns True, the
+			feedback loop ends there.  See `cmap_convergence`.
+
+	Raises:
+		FileNotFoundError: If input files the model needs are missing.
+		subprocess.TimeoutExpired, subprocess.CalledProcessError,
+		RuntimeError: If a stage fails, see `run_stage`.
+	"""
+	database_dir = os.path.abspath(database_dir)
+	hhenum = os.path.join(database_dir, 'tg', 'fortran', 'TG_HHENUM_OUTPUT.TXT')
+	if os.path.exists(hhenum):
+		shutil.copyfile(hhenum, os.path.join(database_dir, 'TG_HHENUM_OUTPUT.TXT'))
+	missing = [f for f in REQUIRED_FILES if not os.path.exists(os.path.join(database_dir, f))]
+	if missing:
+		raise FileNotFoundError(f"missing model input files: {', '.join(missing)}")
+	run_programs = default_programs(database_dir)
+	run_programs.update(programs or {})
+	timeouts = timeouts or {}
+	settings = dict(scenario=scenario, iter1=iter1, iter2=iter2, counter=0, prev=-1, python=run_programs['python'])
+
+	for f in ['blog.txt', 'model_run_timestamp.txt', 'stages.log']:
+		if os.path.exists(os.path.join(database_dir, f)):
+			os.remove(os.path.join(database_dir, f))
+
+	def timestamp(message):
+		with open(os.path.join(database_dir, 'model_run_timestamp.txt'), 'at') as f:
+			f.write(f"{message}: {time.strftime('%m/%d/%Y %H:%M:%S')}\n")
+
+	def run(stage):
+		if stage.when is not None and not stage.when(settings['counter']):
+			return
+		if stage.name in timeouts:
+			stage = Stage(
+				stage.name, stage.commands, timeouts[stage.name], stage.when, stage.output, stage.logs, stage.check,
+			)
+		timestamp(f"-- Begin {stage.name}")
+		t = time.time()
+		run_stage(stage, database_dir, settings, run_programs, watch=watch, poll=poll, budget=budget)
+		timestamp(f"   -- End {stage.name}")
+		_logger.info(f"stage {stage.name} (iteration {settings['counter']}) done in {time.time() - t:.0f}s")
+
+	timestamp(f"BEGIN CMAP REGIONAL MODEL RUN - SCENARIO {scenario} - Model Run Start Time")
+	for stage in PREPARATION_STAGES:
+		run(stage)
+	for counter in range(global_loops + 1):
+		settings.update(counter=counter, prev=counter - 1)
+		timestamp(f"Begin Global Iteration {counter}")
+		for stage in ITERATION_STAGES:
+			run(stage)
+		if not keep_paths:
+			for path_file in glob.glob(os.path.join(database_dir, f"PATHS_s{scenario}{counter - 1}*")):
+				os.remove(path_file)
+		timestamp(f"End Global Iteration {counter}")
+		if converged is not None and counter < global_loops and converged(counter):
+			timestamp(f"Feedback converged after Global Iteration {counter}")
+			_logger.info(f"feedback converged after global iteration {counter} of {global_loops}")
+			break
+	for stage in FINAL_STAGES:
+		run(stage)
+	timestamp(f"END CMAP REGIONAL MODEL RUN - SCENARIO {scenario} - Model Run End Time")
@@ -0,0 +1,242 @@
+""" cmap_standin.py - a synthetic stand-in for the CMAP trip-based model
+
+The real core model needs Windows, Emme and about 15 GB of files, so none of
+the `setup -> run -> load_measures -> archive` path can be exercised on an
+ordinary Linux box.  This module builds a small synthetic model tree with the
+same layout, realistic file counts and (scaled) file sizes, and provides a
+model class that runs the fake batch runner in `cmap_standin_batch` in place
+of the Emme batch file.  Everything else -- template rendering, copying,
+parsing and archiving -- is the real `CMAP_EMAT_Model` code.
+"""
+import os
+import sys
+import subprocess
+import numpy as np
+
+from cmap_emat import CMAP_EMAT_Model, SOURCE_FILE_HASHES, join_norm, filehash, _logger
+import cmap_standin_batch
+
+STANDIN_MODEL_NAME = "standin_20191219_Clean"
+
+# Small input files the real batch file checks for, or that setup touches.
+_DATABASE_FILES = [
+	*[('data', f'tod_factors.p{i}') for i in range(1, 9)],
+	*[('data', f'tod_occ.p{i}') for i in range(1, 9)],
+	('data', 'directional.splits'),
+	('data', 'toll_system_flag.csv'),
+	*[(f'{p}_{k}.TXT',) for p in ['MCHO', 'MCHW', 'MCNH', 'PDHO', 'PDHW', 'PDNH'] for k in ['DISTR', 'M01', 'M023']],
+	('MCHW_CBDPARK.TXT',),
+	('MCHW_HH.TXT',),
+	('PDHW_CBDPARK.TXT',),
+	('HH_VTYPE_TRIPS_IN.TXT',),
+	('macros', 'call', 'amhwIOM_H.mac'),
+	('macros', 'call', 'amhwIOM_L.mac'),
+	('macros', 'call', 'skim5I_7c.mac'),
+	('macros', 'call', 'net5I_7c.mac'),
+	('macros', 'call', 'skim.transit.all'),
+	('prep_macros', 'initialize_EMAT_variables.mac'),
+	('transit_asmt_macros', 'assign_transit.v2.mac'),
+	('EMAT_Submit_Full_Regional_Model.bat',),
+	('PreDist_RnSeed.exe',),
+	('ModeChoice_RnSeed.exe',),
+	('VehOcc.exe',),
+]
+
+
+def _write_random(filename, nbytes, rng):
+	os.makedirs(os.path.dirname(filename), exist_ok=True)
+	with open(filename, 'wb') as f:
+		remaining = int(nbytes)
+		while remaining > 0:
+			chunk = min(remaining, 2**22)
+			f.write(rng.bytes(chunk))
+			remaining -= chunk
+
+
+def make_standin_model(
+		directory,
+		*,
+		n_bulk_files=400,
+		bulk_megabytes=64,
+		emmebank_megabytes=32,
+		matrix_megabytes=0.5,
+		seed=0,
+):
+	"""
+	Create a synthetic CMAP model tree, with base and alt1 land use copies.
+
+	The real model is about 15 GB in roughly 4,000 files, most of it in the
+	emmebank, the emmemat matrices and the trip generation / Fortran
+	intermediates.  The defaults here keep the same shape at a size that
+	fits comfortably in a temporary directory; scale them up to benchmark
+	disk-bound behavior.
+
+	Args:
+		directory (str): Parent directory, in which the base model
+			directory and the `_AltLandUse` directory are created.
+		n_bulk_files (int): Number of bulk input files.
+		bulk_megabytes (float): Total size of the bulk input files.
+		emmebank_megabytes (float): Size of the emmebank file.
+		matrix_megabytes (float): Size of each emx matrix file.
+		seed (int): Random seed for the file contents.
+
+	Returns:
+		str: The path to the base land use model directory.
+	"""
+	rng = np.random.default_rng(seed)
+	base = join_norm(directory, STANDIN_MODEL_NAME)
+	alt = base + "_AltLandUse"
+	shared = {}
+	for relpath in _DATABASE_FILES:
+		shared[relpath] = rng.bytes(int(rng.integers(256, 8192)))
+	for model_dir in (base, alt):
+		database = join_norm(model_dir, 'Database')
+		for relpath, content in shared.items():
+			filename = join_norm(database, *relpath)
+			os.makedirs(os.path.dirname(filename), exist_ok=True)
+			with open(filename, 'wb') as f:
+				f.write(content)
+		for d in ['report', 'emmemat', os.path.join('tg', 'fortran')]:
+			os.makedirs(join_norm(database, d), exist_ok=True)
+		for counter in range(5):
+			os.makedirs(join_norm(database, 'report', f'iter_{counter}'), exist_ok=True)
+		_write_random(join_norm(database, 'emmebank'), emmebank_megabytes * 2**20, rng)
+		for filenum in cmap_standin_batch.OUTPUT_MATRICES:
+			_write_random(join_norm(database, 'emmemat', f'mf{filenum}.emx'), matrix_megabytes * 2**20, rng)
+		bulk_size = bulk_megabytes * 2**20 / max(n_bulk_files, 1)
+		for i in range(n_bulk_files):
+			subdir = ['tg', 'tg/fortran', 'data', 'emmemat', 'defaults'][i % 5]
+			_write_random(join_norm(database, subdir, f'bulk_{i:05d}.dat'), bulk_size, rng)
+	# Only the land use differs between the two source models.
+	_write_random(join_norm(alt, 'Database', 'tg', 'fortran', 'TG_HHENUM_OUTPUT.TXT'), 2**16, rng)
+	_write_random(join_norm(base, 'Database', 'tg', 'fortran', 'TG_HHENUM_OUTPUT.TXT'), 2**16, rng)
+	return base
+
+
+_STUB_PROGRAM = """\
+import os, sys, time
+name, seconds, exit_code, args = sys.argv[1], float(sys.argv[2]), int(sys.argv[3]), sys.argv[4:]
+with open('stub_calls.log', 'a') as f:
+	f.write(' '.join([name, *args]) + '\\n')
+for arg in args:
+	if 'LOG' in arg.upper():
+		with open(arg, 'w') as f:
+			f.write(name + ' log\\n')
+time.sleep(seconds)
+sys.exit(exit_code)
+"""
+
+
+def make_stub_programs(directory, *, seconds=None, exit_codes=None):
+	"""
+	Write stub executables for the programs the model stages run.
+
+	Each stub appends its name and arguments to `stub_calls.log` in the
+	directory it is run from, writes any log file named in its arguments,
+	waits, and exits.  With these in place of Emme and the Fortran
+	executables, `cmap_stages.run_stages` can run the whole stage sequence
+	of the real model on any machine.
+
+	Args:
+		directory (str): Where to write the stubs.
+		seconds (dict, optional): Seconds each program waits, by name.
+		exit_codes (dict, optional): The exit code of each program, by name.
+
+	Returns:
+		dict: The stub to run for each program name, for the `programs`
+		argument of `cmap_stages.run_stages`.
+	"""
+	os.makedirs(directory, exist_ok=True)
+	script = os.path.join(directory, 'stub_program.py')
+	with open(script, 'wt') as f:
+		f.write(_STUB_PROGRAM)
+	programs = {}
+	for name in ['emme', 'python', 'PreDist', 'ModeChoice', 'VehOcc']:
+		wait = (seconds or {}).get(name, 0)
+		code = (exit_codes or {}).get(name, 0)
+		if os.name == 'nt':
+			stub = os.path.join(directory, f'{name}.cmd')
+			with open(stub, 'wt') as f:
+				f.write(f'@"{sys.executable}" "{script}" {name} {wait} {code} %*\n')
+		else:
+			stub = os.path.join(directory, name)
+			with open(stub, 'wt') as f:
+				f.write(f'#!/bin/sh\nexec "{sys.executable}" "{script}" {name} {wait} {code} "$@"\n')
+			os.chmod(stub, 0o755)
+		programs[name] = stub
+	return programs
+
+
+def standin_configuration(model_path, archive_path=None):
+	"""The core model configuration for a stand-in created by `make_standin_model`."""
+	model_path = os.path.abspath(model_path)
+	if archive_path is None:
+		archive_path = join_norm(model_path, '..', 'EMAT-ARCHIVE-standin')
+	return {
+		'model_path': model_path,
+		'model_archive': os.path.abspath(archive_path),
+		'rel_output_path': '.',
+		'model_path_land_use_base': '.',
+		'model_path_land_use_alt1': f'../{os.path.basename(model_path)}_AltLandUse',
+		'killed_indicator': 'Database/killed.txt',
+	}
+
+
+class CMAP_EMAT_StandIn(CMAP_EMAT_Model):
+	"""
+	A `CMAP_EMAT_Model` that runs against a synthetic stand-in model.
+
+	Args:
+		model_path (str): The base model directory from `make_standin_model`.
+			Not needed if a `configuration` is given.
+		runtime (float): Seconds the fake batch runner spends per run.
+		archive_path (str, optional): Where archives are written.
+		matrix_megabytes (float): Size of each output emx matrix.
+		**kwargs: Passed through to `CMAP_EMAT_Model`.
+	"""
+
+	def __init__(self, model_path=None, runtime=0.0, archive_path=None, matrix_megabytes=0.5, **kwargs):
+		self.runtime = runtime
+		self.matrix_megabytes = matrix_megabytes
+		if model_path is not None:
+			kwargs.setdefault('configuration', standin_configuration(model_path, archive_path))
+		super().__init__(**kwargs)
+		# The stand-in files are random, so check them against themselves.
+		self.source_file_hashes = {
+			relpath: filehash(join_norm(self.source_model_path, *relpath))
+			for relpath in SOURCE_FILE_HASHES
+		}
+
+	def run(self):
+		"""
+		Run the fake batch runner in place of the Emme batch file.
+
+		If the configuration sets `stage_runner`, the stages of the real
+		model are run first, with the `stage_programs` from
+		`make_stub_programs`, and the fake batch runner then only writes
+		the model outputs.
+		"""
+		if self.config.get('stage_runner'):
+			self.run_stages()
+			cmap_standin_batch.run_batch(
+				join_norm(self.resolved_model_path, 'Database'),
+				matrix_megabytes=self.matrix_megabytes,
+				outputs_only=True,
+			)
+			return
+		_logger.info("CMAP EMAT STAND-IN Model RUN ...")
+		cmd = [
+			sys.executable, cmap_standin_batch.__file__,
+			join_norm(self.resolved_model_path, 'Database'),
+			'--runtime', str(self.runtime),
+			'--matrix-megabytes', str(self.matrix_megabytes),
+		]
+		self.last_run_result = subprocess.run(cmd, capture_output=True)
+		if self.last_run_result.returncode:
+			raise subprocess.CalledProcessError(
+				self.last_run_result.returncode,
+				self.last_run_result.args,
+				self.last_run_result.stdout,
+				self.last_run_result.stderr,
+			)
+		_logger.info("CMAP EMAT STAND-IN Model RUN complete")
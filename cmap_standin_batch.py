@@ -0,0 +1,389 @@
+""" cmap_standin_batch.py - a fake batch runner for the CMAP stand-in model
+
+This script plays the part of `EMAT_Submit_Full_Regional_Model.bat` for the
+synthetic stand-in model created by `cmap_standin`.  Instead of running Emme
+and the Fortran executables, it waits for a configurable amount of time and
+then writes the same report, matrix and log files that the real model run
+leaves behind, with values that respond smoothly to the experiment inputs.
+
+It deliberately imports nothing from EMAT, so that launching it as a
+subprocess costs about as much as launching the real batch file does.
+
+	python cmap_standin_batch.py <Database directory> [--runtime SECONDS]
+"""
+import os
+import sys
+import time
+import zlib
+import argparse
+import numpy as np
+
+COUNTIES = [
+	'Chicago',
+	'Cook balance',
+	'DuPage',
+	'Kane',
+	'Kendall',
+	'Lake',
+	'McHenry',
+	'Will',
+	'Illinois balance',
+	'Indiana',
+	'Wisconsin',
+]
+
+FACILITIES = ['Expressway', 'Arterial', 'Ramp/Toll', 'Centroid']
+
+VEHICLE_CLASSES = ['Autos', 'B-plate Trucks', 'Light Trucks', 'Medium Trucks', 'Heavy Trucks']
+
+PURPOSES = ['HW', 'HO', 'NH']
+
+AREAS = ['ENTIRE NETWORK', 'NON-ATTAINMENT AREA']
+
+# Interchange zones.  The first nine origins are the ones in the scope, the
+# remainder stand in for the rest of the corridor report.
+INTERCHANGE_ORIGINS = [
+	311, 384, 623, 1636, 2004, 2203, 2290, 2507, 2796,
+	102, 155, 208, 261, 437, 490, 543, 596, 702, 755,
+	808, 861, 914, 967, 1020, 1073, 1126, 1179, 1232, 1285,
+]
+INTERCHANGE_DESTINATIONS = [24, 125, 511, 2049]
+INTERCHANGE_MATRICES = [
+	('mf44', 'amtime'),
+	('mf45', 'amdist'),
+	('mf46', 'mdtime'),
+	('mf47', 'mddist'),
+]
+
+# The emx matrices written by a model run; the archive copies a subset.
+OUTPUT_MATRICES = [
+	1,2,3,4,5,6,7,8,9,10,14,22,23,24,25,26,27,36,37,40,41,42,43,44,45,46,47,48,49,
+	101,102,103,104,105,106,107,108,109,834,842,843,844,845,846,847,934,
+	11,12,13,15,16,17,18,19,20,21,28,29,30,31,32,33,34,35,
+]
+
+
+def _base_value(name, low=3.0, high=7.0):
+	"""A stable, name-dependent base magnitude between 10**low and 10**high."""
+	u = (zlib.crc32(name.encode()) % 100003) / 100003
+	return 10 ** (low + (high-low) * u)
+
+
+def _response(params):
+	"""
+	Smooth multiplicative responses of the stand-in outputs to the inputs.
+
+	These are not meant to be realistic elasticities, only to give outputs
+	that vary with every input in a plausible direction, so that anything
+	fit to stand-in results has something to learn.
+	"""
+	highway_cap = float(params.get('highway_cap', 1.0))
+	park_price = float(params.get('park_price', 0.5))
+	transit_fares = float(params.get('transit_fares', 1.0))
+	telecommuting = float(params.get('telecommuting', 0.1))
+	fuel_cost = float(params.get('fuel_cost', 3.0))
+	vmt_charge = float(params.get('vmt_charge', 0.0))
+	expressway_toll = float(params.get('expressway_toll', 0.0))
+	vot_sensitivity = float(params.get('vot_sensitivity', 0.8))
+	land_use = 1.03 if params.get('land_use', 'base') != 'base' else 1.0
+
+	trips = land_use * (1 - 0.25 * telecommuting)
+	transit = trips * (fuel_cost / 3.0) ** 0.3 * (1 + 0.2 * park_price) / (0.6 + 0.4 * transit_fares)
+	vmt = (
+		trips
+		* highway_cap ** 0.12
+		* (fuel_cost / 3.0) ** -0.15
+		* (1 - 1.5 * vmt_charge)
+		* (1 - 0.2 * park_price)
+	)
+	expressway = vmt * (1 - 0.6 * expressway_toll)
+	speed = highway_cap ** 0.4 * (1 + 0.1 * (vot_sensitivity - 0.8))
+	return dict(
+		trips=trips,
+		transit=transit,
+		vmt=vmt,
+		expressway=expressway,
+		time=vmt / speed,
+	)
+
+
+def _noise(params, seed=0):
+	"""A small deterministic perturbation keyed on the input values."""
+	token = repr(sorted((k, str(v)) for k, v in params.items())).encode()
+	return np.random.default_rng([zlib.crc32(token), seed])
+
+
+def vmt_statistics(params, seed=0):
+	"""Values for run_vmt_statistics.rpt, as {county: {facility VMT: value}}."""
+	r = _response(params)
+	rng = _noise(params, seed)
+	result = {}
+	for county in COUNTIES:
+		block = {}
+		for facility in FACILITIES:
+			factor = r['expressway'] if facility == 'Expressway' else r['vmt']
+			block[f'{facility} VMT'] = _base_value(f'{county}.{facility}', 4, 7) * factor * rng.normal(1, 0.002)
+		block['Total District VMT'] = sum(block.values())
+		result[county] = block
+	return result
+
+
+def vht_statistics(params, seed=0):
+	"""Values for run_vht_statistics.rpt, as {(county, class): {name: value}}."""
+	r = _response(params)
+	rng = _noise(params, seed + 1)
+	result = {}
+	for county in COUNTIES:
+		for vclass in VEHICLE_CLASSES:
+			block = {}
+			for facility in FACILITIES:
+				factor = r['expressway'] if facility == 'Expressway' else r['vmt']
+				block[f'{facility} VMT'] = _base_value(f'{county}.{vclass}.{facility}', 3, 6) * factor * rng.normal(1, 0.002)
+			block['Total District VMT'] = sum(block.values())
+			result[(county, vclass)] = block
+		block = {}
+		for facility in FACILITIES:
+			block[f'{facility} VHT'] = _base_value(f'{county}.VHT.{facility}', 3, 5) * r['time'] * rng.normal(1, 0.002)
+		block['Total District VHT'] = sum(block.values())
+		result[(county, 'Total VHT')] = block
+	return result
+
+
+def final_run_statistics(params, seed=0):
+	"""Values for final_run_statistics.rpt, as {area: {section: {name: value}}}."""
+	r = _response(params)
+	rng = _noise(params, seed + 2)
+	result = {}
+	for area in AREAS:
+		scale = 1.0 if area == 'ENTIRE NETWORK' else 0.93
+		person_trips = {}
+		transit_share = {}
+		total_auto = total_transit = 0.0
+		for purpose in PURPOSES:
+			auto = _base_value(f'{purpose}.auto', 6, 7) * scale * r['trips'] * rng.normal(1, 0.002)
+			transit = _base_value(f'{purpose}.transit', 5, 6) * scale * r['transit'] * rng.normal(1, 0.002)
+			person_trips[f'{purpose} Total Person Trips'] = auto + transit
+			person_trips[f'{purpose} Auto Person Trips'] = auto
+			person_trips[f'{purpose} Transit Person Trips'] = transit
+			transit_share[f'{purpose} Transit Share'] = 100 * transit / (auto + transit)
+			total_auto += auto
+			total_transit += transit
+		transit_share['Overall Transit Share'] = 100 * total_transit / (total_auto + total_transit)
+		distance = {
+			f'{p} Trip Average Miles': _base_value(f'{p}.miles', 0.5, 1.2) * r['vmt'] / r['trips']
+			for p in PURPOSES
+		}
+		duration = {
+			f'{p} Trip Average Minutes': _base_value(f'{p}.minutes', 1.0, 1.6) * r['time'] / r['trips']
+			for p in PURPOSES
+		}
+		other = {
+			f'{name} Trips': _base_value(f'{area}.{name}', 4, 6) * r['trips']
+			for name in ['B-Plate Truck', 'Light Truck', 'Medium Truck', 'Heavy Truck', 'POE Auto', 'POE Truck', 'POE Airport']
+		}
+		vehicle_vmt = {
+			f'{name} VMT': _base_value(f'{area}.{name}.vmt', 6, 8) * r['vmt'] * scale
+			for name in ['Auto', 'B-Plate Truck', 'Light Truck', 'Medium Truck', 'Heavy Truck', 'Bus']
+		}
+		vehicle_vmt['All VMT'] = sum(vehicle_vmt.values())
+		result[area] = {
+			'Person Trips': person_trips,
+			'Transit Share': transit_share,
+			'Trip Distance': distance,
+			'Trip Duration': duration,
+			'Other Trips': other,
+			'Vehicle Class VMT': vehicle_vmt,
+		}
+	return result
+
+
+def ej_statistics(params, seed=0):
+	"""Values for report_ej.txt, as {section: {name: value}}."""
+	r = _response(params)
+	rng = _noise(params, seed + 3)
+	person_trips = {}
+	transit_share = {}
+	for purpose in PURPOSES:
+		auto = _base_value(f'{purpose}ej.auto', 5, 6) * r['trips'] * rng.normal(1, 0.002)
+		transit = _base_value(f'{purpose}ej.transit', 4, 5) * r['transit'] * rng.normal(1, 0.002)
+		person_trips[f'{purpose}ej_Tot_Per_Trips'] = auto + transit
+		person_trips[f'{purpose}ej_Aut_Per_Trips'] = auto
+		person_trips[f'{purpose}ej_Tra_Per_Trips'] = transit
+		transit_share[f'{purpose}ej_Tran_Shr'] = 100 * transit / (auto + transit)
+	transit_share['Totej_Tran_Shr'] = np.mean(list(transit_share.values()))
+	return {
+		'EJ_Person_Trips': person_trips,
+		'EJ_Transit_Share': transit_share,
+		'EJ_Average_Trip_Time_': {
+			f'{p}ej_Aut_Avg_Min': _base_value(f'{p}ej.aut.min', 1.0, 1.6) * r['time'] / r['trips']
+			for p in PURPOSES
+		},
+		'Average_EJ_TRANSIT_Trip_Time': {
+			'HWej_Trn_Avg_Min': _base_value('HWej.trn.min', 1.4, 1.8) / r['transit'],
+			'HOej_Trn_Avg_Min': _base_value('HOej.trn.min', 1.4, 1.8) / r['transit'],
+			'NHej_trn_Avg_Min': _base_value('NHej.trn.min', 1.4, 1.8) / r['transit'],
+		},
+	}
+
+
+def interchange_times(params, seed=0):
+	"""Values for interchange_times.txt, as {(matrix, name): {origin: [values]}}."""
+	r = _response(params)
+	rng = _noise(params, seed + 4)
+	result = {}
+	for matrix, name in INTERCHANGE_MATRICES:
+		factor = r['time'] / r['trips'] if 'time' in name else 1.0
+		result[(matrix, name)] = {
+			o: [
+				_base_value(f'{matrix}.{o}.{d}', 0.5, 2.0) * factor * rng.normal(1, 0.001)
+				for d in INTERCHANGE_DESTINATIONS
+			]
+			for o in INTERCHANGE_ORIGINS
+		}
+	return result
+
+
+def write_reports(report_dir, params, seed=0):
+	"""
+	Write all five parsed report files into a report directory.
+
+	Args:
+		report_dir (str): The `Database/report` directory of a model.
+		params (dict): The experiment inputs the values respond to.
+		seed (int): Offsets the small noise added to every value.
+	"""
+	os.makedirs(report_dir, exist_ok=True)
+
+	with open(os.path.join(report_dir, 'run_vmt_statistics.rpt'), 'wt') as f:
+		f.write("CMAP REGIONAL MODEL - DAILY VMT BY DISTRICT AND FACILITY TYPE\n\n")
+		for county, block in vmt_statistics(params, seed).items():
+			f.write(f"== {county} ==\n")
+			for k, v in block.items():
+				f.write(f"  {k}: {v:.2f}\n")
+			f.write("\n")
+
+	with open(os.path.join(report_dir, 'run_vht_statistics.rpt'), 'wt') as f:
+		f.write("CMAP REGIONAL MODEL - DAILY VMT AND VHT BY DISTRICT AND VEHICLE CLASS\n\n")
+		for (county, vclass), block in vht_statistics(params, seed).items():
+			f.write(f"== {county} ==\n")
+			f.write(f"-- {vclass} --\n")
+			for k, v in block.items():
+				f.write(f"  {k}: {v:.2f}\n")
+			f.write("\n")
+
+	with open(os.path.join(report_dir, 'final_run_statistics.rpt'), 'wt') as f:
+		f.write("CMAP REGIONAL MODEL - FINAL RUN STATISTICS\n\n")
+		for area, sections in final_run_statistics(params, seed).items():
+			f.write(f"== {area} ==\n")
+			for section, block in sections.items():
+				f.write(f"-- {section} --\n")
+				for k, v in block.items():
+					f.write(f"  {k}: {v:.4f}\n")
+			f.write("\n")
+
+	with open(os.path.join(report_dir, 'report_ej.txt'), 'wt') as f:
+		for section, block in ej_statistics(params, seed).items():
+			f.write(f"=={section}==\n")
+			for k, v in block.items():
+				f.write(f"{k} {v:.4f}\n")
+
+	with open(os.path.join(report_dir, 'interchange_times.txt'), 'wt') as f:
+		for (matrix, name), rows in interchange_times(params, seed).items():
+			f.write(f"Matrix {matrix} {name} punched interchange values\n")
+			for o, values in rows.items():
+				cells = "".join(f" {d:>6}: {v:9.4f}" for d, v in zip(INTERCHANGE_DESTINATIONS, values))
+				f.write(f" {o:>6}{cells}\n")
+			f.write("\n")
+
+
+def write_matrices(emmemat_dir, params, megabytes=0.5, seed=0):
+	"""Write the output emx matrix files, each of about `megabytes` size."""
+	os.makedirs(emmemat_dir, exist_ok=True)
+	rng = _noise(params, seed + 5)
+	n = max(1, int(megabytes * 2**20) // 4)
+	for filenum in OUTPUT_MATRICES:
+		rng.random(n, dtype=np.float32).tofile(os.path.join(emmemat_dir, f"mf{filenum}.emx"))
+
+
+def read_parameters(model_dir):
+	"""Read the experiment inputs that `setup` wrote into the model directory."""
+	filename = os.path.join(model_dir, "_emat_parameters_.yml")
+	if not os.path.exists(filename):
+		return {}
+	with open(filename, 'rt') as f:
+		try:
+			import yaml
+		except ImportError:
+			import json
+			return json.load(f)
+		return yaml.safe_load(f)
+
+
+def run_batch(database_dir, runtime=0.0, global_loops=None, matrix_megabytes=0.5, seed=0, outputs_only=False):
+	"""
+	Pretend to run the full regional model in a `Database` directory.
+
+	Args:
+		database_dir (str): The `Database` directory of a stand-in model copy.
+		runtime (float): Total seconds to spend "running", spread evenly over
+			the global iterations.
+		global_loops (int, optional): Override the number of feedback loops;
+			by default this is read from the experiment parameters.
+		matrix_megabytes (float): Size of each output emx matrix.
+		seed (int): Offsets the small noise added to every reported value.
+		outputs_only (bool): Only write the output files, leaving the
+			logs and timestamps of a run made some other way.
+	"""
+	params = read_parameters(os.path.dirname(os.path.abspath(database_dir)))
+	if outputs_only:
+		_write_outputs(database_dir, params, matrix_megabytes, seed)
+		return
+	if global_loops is None:
+		global_loops = int(params.get('global_loops', 4))
+
+	blog = os.path.join(database_dir, 'blog.txt')
+	stamp = os.path.join(database_dir, 'model_run_timestamp.txt')
+	for f in (blog, stamp):
+		if os.path.exists(f):
+			os.remove(f)
+
+	def timestamp(message):
+		with open(stamp, 'at') as f:
+			f.write(f"{message}: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+
+	timestamp("BEGIN CMAP REGIONAL MODEL RUN - Model Run Start Time")
+	n_iter = global_loops + 1
+	for counter in range(n_iter):
+		timestamp(f"Begin Global Iteration {counter}")
+		time.sleep(runtime / n_iter)
+		with open(blog, 'at') as f:
+			f.write(f"stand-in global iteration {counter} complete\n")
+		timestamp(f"End Global Iteration {counter}")
+	timestamp("END CMAP REGIONAL MODEL RUN - Model Run End Time")
+	_write_outputs(database_dir, params, matrix_megabytes, seed)
+
+
+def _write_outputs(database_dir, params, matrix_megabytes, seed):
+	write_reports(os.path.join(database_dir, 'report'), params, seed)
+	write_matrices(os.path.join(database_dir, 'emmemat'), params, matrix_megabytes, seed)
+	with open(os.path.join(database_dir, 'emmebank'), 'r+b') as f:
+		f.seek(0)
+		f.write(b'STANDIN-EMMEBANK-RUN-COMPLETE')
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="fake CMAP batch runner")
+	parser.add_argument('database_dir')
+	parser.add_argument('--runtime', type=float, default=0.0)
+	parser.add_argument('--global-loops', type=int, default=None)
+	parser.add_argument('--matrix-megabytes', type=float, default=0.5)
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+	run_batch(
+		args.database_dir,
+		runtime=args.runtime,
+		global_loops=args.global_loops,
+		matrix_megabytes=args.matrix_megabytes,
+		seed=args.seed,
+	)
+	sys.exit(0)
@@ -0,0 +1,231 @@
+""" cmap_sweep.py - bulk evaluation of meta-models over dense input grids
+
+A meta-model is cheap to evaluate, but calling it one experiment at a time,
+or building one DataFrame of a few million rows by ~700 measures, is not.
+The functions here evaluate a meta-model over a NumPy design matrix (or a
+lazily generated grid) in chunks, optionally in a process pool, and stream
+the predictions to a columnar store on disk: a directory holding one `.npy`
+file per measure.  Each worker writes its chunk straight into the memory
+mapped column files, so no results pass back through the parent process,
+and a column can later be read on its own without touching the others.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from emat.util.loggers import get_module_logger
+
+_logger = get_module_logger(__name__)
+
+SWEEP_INDEX_FILE = "sweep.json"
+
+
+class InputGrid:
+	"""
+	A full factorial grid over some scope inputs, generated lazily.
+
+	Args:
+		scope (emat.Scope): The exploratory scope.
+		points (int or Mapping[str, int or array-like]): Grid points per
+			input.  An int gives that many evenly spaced points across the
+			range of every numeric uncertainty and lever; a mapping gives a
+			number of points, or explicit values, by input name, and only
+			those inputs are varied.
+	"""
+
+	def __init__(self, scope, points=5):
+		if isinstance(points, int):
+			points = {
+				p.name: points
+				for p in scope.get_uncertainties() + scope.get_levers()
+				if p.dtype in ('real', 'int')
+			}
+		self.names = list(points)
+		self.values = []
+		for name in self.names:
+			v = points[name]
+			if np.ndim(v) == 0:
+				p = scope[name]
+				v = np.linspace(p.min, p.max, int(v))
+			self.values.append(np.asarray(v, dtype=np.float64))
+		self.shape = tuple(len(v) for v in self.values)
+
+	def __len__(self):
+		return int(np.prod(self.shape))
+
+	def rows(self, start, stop):
+		"""The grid points from `start` to `stop`, as a 2-d array."""
+		idx = np.unravel_index(np.arange(start, min(stop, len(self))), self.shape)
+		return np.column_stack([v[i] for v, i in zip(self.values, idx)])
+
+
+def _input_frame(metamodel, X, names, fixed):
+	"""The raw input DataFrame the meta-model expects, for a block of X."""
+	frame = pd.DataFrame(X, columns=names)
+	for name in metamodel.function.raw_input_columns:
+		if name not in frame.columns:
+			frame[name] = fixed[name]
+	return frame[metamodel.function.raw_input_columns]
+
+
+def _open_columns(output_dir, all_columns, subset=None, n_rows=None):
+	"""Memory map column files, numbered by position in `all_columns`."""
+	return {
+		name: np.lib.format.open_memmap(
+			os.path.join(output_dir, f"{i:04d}.npy"),
+			mode='r+' if n_rows is None else 'w+',
+			dtype=np.float64,
+			shape=None if n_rows is None else (n_rows,),
+		)
+		for i, name in enumerate(all_columns)
+		if subset is None or name in subset
+	}
+
+
+_worker = {}
+
+
+def _init_worker(metamodel, names, fixed, output_dir, columns):
+	_worker['metamodel'] = metamodel
+	_worker['names'] = names
+	_worker['fixed'] = fixed
+	_worker['columns'] = _open_columns(output_dir, names + columns, subset=columns)
+
+
+def _evaluate_chunk(start, X):
+	metamodel = _worker['metamodel']
+	predicted = metamodel.function.predict(
+		_input_frame(metamodel, X, _worker['names'], _worker['fixed'])
+	)
+	stop = start + len(X)
+	for name, column in _worker['columns'].items():
+		column[start:stop] = predicted[name].to_numpy(dtype=np.float64)
+	for column in _worker['columns'].values():
+		column.flush()
+	return stop - start
+
+
+def evaluate_metamodel(
+		metamodel,
+		X,
+		output_dir,
+		names=None,
+		*,
+		fixed=None,
+		measures=None,
+		chunk_size=50_000,
+		n_workers=None,
+):
+	"""
+	Evaluate a meta-model over many points, streaming results to disk.
+
+	Args:
+		metamodel (emat.PythonCoreModel): The meta-model.
+		X (numpy.ndarray or InputGrid): The design matrix, one row per
+			point and one column per name in `names`, or a grid.
+		output_dir (str): Directory for the column store.  It is
+			created, and any existing store in it is overwritten.
+		names (Sequence[str], optional): The input names of the columns
+			of `X`.  Not needed for an InputGrid.
+		fixed (Mapping, optional): Values for model inputs that are not
+			columns of `X`.  Inputs given in neither take the scope
+			default.
+		measures (Collection[str], optional): Measures to store, by
+			default every measure the meta-model predicts.
+		chunk_size (int, default 50,000): Points per prediction call.
+		n_workers (int, optional): Number of worker processes.  By
+			default one per CPU; 0 or 1 evaluates in this process.
+
+	Returns:
+		str: `output_dir`, for `read_sweep`.
+	"""
+	if isinstance(X, InputGrid):
+		names = X.names
+		n_rows = len(X)
+		get_rows = X.rows
+	else:
+		X = np.asarray(X, dtype=np.float64)
+		if names is None or len(names) != X.shape[1]:
+			raise ValueError("give one name per column of X")
+		n_rows = X.shape[0]
+		get_rows = lambda start, stop: X[start:stop]
+	names = list(names)
+
+	scope = metamodel.scope
+	defaults = {p.name: p.default for p in scope.get_parameters()}
+	defaults.update(fixed or {})
+	missing = [i for i in metamodel.function.raw_input_columns if i not in names and i not in defaults]
+	if missing:
+		raise ValueError(f"no values for inputs {missing}")
+
+	probe = metamodel.function.predict(_input_frame(metamodel, get_rows(0, 1), names, defaults))
+	columns = [i for i in probe.columns if measures is None or i in measures]
+
+	os.makedirs(output_dir, exist_ok=True)
+	with open(os.path.join(output_dir, SWEEP_INDEX_FILE), 'wt') as f:
+		json.dump({
+			'n_rows': n_rows,
+			'inputs': names,
+			'fixed': {k: defaults[k] for k in metamodel.function.raw_input_columns if k not in names},
+			'columns': names + columns,
+		}, f, indent=1, default=str)
+	# The inputs are stored too, so each row of the store is self-describing.
+	inputs = _open_columns(output_dir, names + columns, n_rows=n_rows)
+	inputs = {k: v for k, v in inputs.items() if k in names}
+
+	if n_workers is None:
+		n_workers = os.cpu_count() or 1
+	chunks = ((start, min(start + chunk_size, n_rows)) for start in range(0, n_rows, chunk_size))
+	initargs = (metamodel, names, defaults, output_dir, columns)
+
+	def store_inputs(start, rows):
+		for j, name in enumerate(names):
+			inputs[name][start:start + len(rows)] = rows[:, j]
+
+	done = 0
+	if n_workers <= 1:
+		_init_worker(*initargs)
+		for start, stop in chunks:
+			rows = get_rows(start, stop)
+			store_inputs(start, rows)
+			done += _evaluate_chunk(start, rows)
+	else:
+		with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=initargs) as pool:
+			futures = []
+			for start, stop in chunks:
+				rows = get_rows(start, stop)
+				store_inputs(start, rows)
+				futures.append(pool.submit(_evaluate_chunk, start, rows))
+				# keep a bounded number of chunks in flight
+				while len(futures) > 2 * n_workers:
+					done += futures.pop(0).result()
+			for fut in futures:
+				done += fut.result()
+	for column in inputs.values():
+		column.flush()
+	_logger.info(f"evaluated {done} points x {len(columns)} measures into {output_dir}")
+	return output_dir
+
+
+def read_sweep(output_dir, columns=None):
+	"""
+	Read a column store written by `evaluate_metamodel`.
+
+	Args:
+		output_dir (str): The store directory.
+		columns (Collection[str], optional): Inputs and measures to read,
+			by default all of them.  Only these column files are opened.
+
+	Returns:
+		pandas.DataFrame: Backed by read-only memory maps where pandas
+		allows it, so reading a few columns of a large store is cheap.
+	"""
+	with open(os.path.join(output_dir, SWEEP_INDEX_FILE), 'rt') as f:
+		index = json.load(f)
+	return pd.DataFrame({
+		name: np.load(os.path.join(output_dir, f"{i:04d}.npy"), mmap_mode='r')
+		for i, name in enumerate(index['columns'])
+		if columns is None or name in columns
+	})